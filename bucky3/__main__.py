@@ -29,12 +29,14 @@ import bucky3.module as module
 
 MODULES = {
     'influxdb_client': ('bucky3.influxdb', 'InfluxDBClient'),
+    'influxdb_http_client': ('bucky3.influxdb', 'InfluxDBHTTPClient'),
     'elasticsearch_client': ('bucky3.elasticsearch', 'ElasticsearchClient'),
     'prometheus_exporter': ('bucky3.prometheus', 'PrometheusExporter'),
     'statsd_server': ('bucky3.statsd', 'StatsDServer'),
     'jsond_server': ('bucky3.jsond', 'JsonDServer'),
     'linux_stats': ('bucky3.linux', 'LinuxStatsCollector'),
     'docker_stats': ('bucky3.docker', 'DockerStatsCollector'),
+    'process_stats': ('bucky3.process', 'ProcessStatsCollector'),
     'systemd_journal': ('bucky3.journal', 'SystemdJournal'),
     'debug_output': ('bucky3.debug', 'DebugOutput'),
 }
@@ -105,12 +105,13 @@ metadata = {
 # - Optional, default: 300
 # - In source modules it defines the max size of the batch sent out to destination modules.
 #   It is a balance between too granular and too "bursty" IPC. 100 - 1000 looks reasonable.
-#   In influxdb_client it defines the number of metrics sent out in single UDP packet,
-#   if you want to keep the UDP packets within MTU, the chunk_size should be low, i.e. 5-15.
+#   In influxdb_client it defines the number of metrics handed over in one go to the UDP
+#   sender which packs them into as few packets as max_packet_size allows.
 #   In prometheus_exporter it defines the number of metrics going into one TCP socket write,
 #   the default 300 seems to be a good value here.
-#   In elasticsearch_client it defines a number of entries in one bulk upload. Bigger bulk
-#   calls are significantly more efficient in Elasticsearch. The default 300 or bigger is fine.
+#   In elasticsearch_client it defines the max number of entries in one bulk upload, see also
+#   max_batch_size there. Bigger bulk calls are significantly more efficient in Elasticsearch.
+#   The default 300 or bigger is fine.
 #   In any case, chunk_size is enforced to be at least 1.
 # - Example: chunk_size = 10
 
@@ -157,6 +158,30 @@ metadata = {
 #   control over traffic generated and data retention.
 
 
+# adaptive_push
+# - bool, if chunk_size and push_count_limit should adapt to the destination
+# - Optional, default: False
+# - Only applicable to influxdb_client, influxdb_http_client and elasticsearch_client.
+#   The configured chunk_size and push_count_limit are the starting points. After every push
+#   that is fast (see target_push_latency) and clean, chunk_size grows by 1/10 of its configured
+#   value (up to max_chunk_size), push_count_limit grows by chunk_size (up to its configured value).
+#   On errors, throttling (i.e. Elasticsearch 429 rejections) or slow pushes, both are halved.
+#   The current values are self reported.
+# - Example: adaptive_push = True
+
+
+# target_push_latency
+# - float, push latency (in seconds) above which adaptive_push backs off
+# - Optional, default: = push_time_limit / 4
+# - Example: target_push_latency = 0.5
+
+
+# max_chunk_size
+# - int, the limit adaptive_push grows chunk_size to
+# - Optional, default: = 10 * chunk_size
+# - Example: max_chunk_size = 5000
+
+
 # metric_postprocessor
 # - callback, custom metric postprocessor
 # - Optional, default: None
@@ -230,6 +255,40 @@ linuxstats = {
     # - Optional, default: None
     # - See the disk_whitelist, disk_blacklist for details
     # - Example: 'interface_blacklist': {"lo", "veth.+"},
+
+    # pressure_whitelist, pressure_blacklist
+    # - set of str, pressure stall information (cpu, memory, io) to include/exclude
+    # - Optional, default: None
+    # - See the disk_whitelist, disk_blacklist for details. The system_pressure metrics come
+    #   from /proc/pressure/*, which needs a kernel 4.20+ with PSI enabled.
+    # - Example: 'pressure_whitelist': {"memory", "io"},
+
+    # vmstat_whitelist, vmstat_blacklist
+    # - set of str, /proc/vmstat fields to include/exclude
+    # - Optional, default: None
+    # - See the disk_whitelist, disk_blacklist for details. If neither is defined, the
+    #   system_vmstat metrics are pgfault, pgmajfault, pswpin, pswpout and oom_kill.
+    # - Example: 'vmstat_whitelist': {"pg.*fault", "pswp.+", "oom_kill", "nr_dirty"},
+
+    # procfs_root
+    # - str, where the proc filesystem is mounted
+    # - Optional, default: '/proc'
+    # - When Bucky3 runs in a container, the host /proc can be mounted elsewhere. Note, that
+    #   the filesystems are still looked up (statvfs) at the paths listed in procfs_root/mounts.
+    # - Example: 'procfs_root': '/host/proc',
+
+    # counter_mode
+    # - str, one of 'raw', 'delta' or 'rate'
+    # - Optional, default: 'raw'
+    # - By default, the counters in system_activity, system_cpu, system_disk, system_interface,
+    #   system_protocol, system_pressure and system_vmstat are sent raw, monotonically increasing,
+    #   and it is up to the queries to turn them into rates. With 'delta', the increase since
+    #   the previous flush is sent instead, with 'rate' the increase per second. Counters wrapping
+    #   around (32 bit) and being reset are accounted for. Gauges in these buckets (i.e. load,
+    #   in_progress, conn_count, PSI averages, nr_* vmstat fields) are sent as they are.
+    #   In both modes, system_cpu is sent as percentages of the CPU time. Note, that the first
+    #   flush has nothing to compare against, so it sends out only the gauges.
+    # - Example: 'counter_mode': 'rate',
 }
 
 
@@ -266,6 +325,88 @@ dockerstats = {
     #   precedence over the ENV variables. See:
     #      https://docs.docker.com/engine/userguide/labels-custom-metadata/
     # - Example: 'env_mapping': {'TEAM_NAME': 'team'},
+
+    # cgroup_root
+    # - str, where the cgroup filesystem is mounted
+    # - Optional, default: '/sys/fs/cgroup'
+    # - Both cgroup v1 and v2 (the unified hierarchy, detected by cgroup.controllers in cgroup_root)
+    #   are supported. Container cgroups are looked up, and cached, per container. On cgroup v2,
+    #   CPU usage is reported as a whole (name=cpu) rather than per CPU.
+    # - Example: 'cgroup_root': '/host/sys/fs/cgroup',
+
+    # inspect_cache_ttl
+    # - float, max age of cached container inspect info (in seconds)
+    # - Optional, default: 300
+    # - Containers are inspected once and the info is cached. Docker events for a container,
+    #   which the module subscribes to in the background, invalidate its cache entry. The TTL
+    #   is a safety net.
+    # - Example: 'inspect_cache_ttl': 60,
+
+    # inspect_concurrency, inspect_timeout
+    # - int / float
+    # - Optional, default: 4 / flush_interval / 2
+    # - Containers missing in the inspect cache are inspected concurrently, over keep-alive
+    #   connections. Those not inspected within inspect_timeout (in seconds) are left out of
+    #   the current flush and picked up from the cache later on, so a slow docker daemon
+    #   doesn't stretch the scan beyond flush_interval.
+    # - Example: 'inspect_concurrency': 8,
+
+    # filesystem_interval
+    # - float, how often container filesystem sizes are collected (in seconds)
+    # - Optional, default: 60
+    # - Getting the sizes makes docker walk the container filesystem, which is slow and expensive.
+    #   So it is done in the background, with containers spread over the interval. The flushes
+    #   report the most recent sizes collected. It is enforced to be at least 1 sec.
+    # - Example: 'filesystem_interval': 300,
+
+    # max_cached_handles
+    # - int, max number of cgroup and /proc files kept open across flushes
+    # - Optional, default: 512
+    # - Every container has 5 (cgroup v1) to 8 (cgroup v2) files read on every flush. Keeping them
+    #   open makes the scans cheaper, but every one of them is a file descriptor. Files beyond
+    #   the limit are opened and closed on every flush. It is capped at half of the soft
+    #   RLIMIT_NOFILE (see "ulimit -n"), the rest is left to sockets and pipes.
+    # - Example: 'max_cached_handles': 2000,
+}
+
+
+# This module only works on linux as it uses /proc to collect per process metrics.
+# Set "module_inactive=False" (or remove the line) to enable it.
+processstats = {
+    'module_type': "process_stats",
+    'module_inactive': True,
+
+    # top_processes
+    # - int, how many top consumers to report
+    # - Optional, default: 10
+    # - On each flush, the top_processes processes with the highest CPU usage since the previous
+    #   flush and the top_processes processes with the highest RSS are reported. Metrics come in
+    #   process_cpu, process_memory and process_io buckets with "name" and "pid" metadata.
+    #   Set it to 0 to only report the whitelisted processes.
+    # - Example: 'top_processes': 5,
+
+    # process_whitelist
+    # - set of str, process names to always report
+    # - Optional, default: None
+    # - The process names (as in /proc/<pid>/comm, up to 15 chars) matching any of these
+    #   are reported regardless of their ranking. The strings are used as fully anchored
+    #   regular expressions.
+    # - Example: 'process_whitelist': {"nginx", "postgres.*"},
+
+    # max_cached_handles
+    # - int, max number of /proc/<pid>/* files kept open across flushes
+    # - Optional, default: 256
+    # - Keeping the files open makes the scans cheaper, but every one of them is a file
+    #   descriptor. Files beyond the limit are opened and closed on every flush. It is capped
+    #   at half of the soft RLIMIT_NOFILE (see "ulimit -n"), the rest is left to sockets and pipes.
+    #   On hosts with thousands of processes, raise both the limit and this setting.
+    # - Example: 'max_cached_handles': 5000,
+
+    # procfs_root
+    # - str, where the proc filesystem is mounted
+    # - Optional, default: '/proc'
+    # - When Bucky3 runs in a container, the host /proc can be mounted elsewhere.
+    # - Example: 'procfs_root': '/host/proc',
 }
 
 
@@ -458,20 +599,116 @@ influxdb = {
     # remote_hosts, InfluxDB endpoints
     # - tuple of str
     # - Required
-    # - This module fans out metrics to all configured endpoints. Also, the remote_hosts are
-    #   resolved every 3min, so DNS changes are automatically picked up. Like for local_host,
-    #   you can use IPs or hostnames but port number has to be numeric. If you don't specify
-    #   the port, it defaults to 8086.
+    # - This module distributes metrics across all configured endpoints, see distribution below.
+    #   Also, the remote_hosts are resolved every 3min, so DNS changes are automatically picked up.
+    #   Like for local_host, you can use IPs or hostnames but port number has to be numeric.
+    #   If you don't specify the port, it defaults to 8086.
     # - Example: 'remote_hosts': ("influxdb1", "influxdb2:1234"),
     'remote_hosts': (
         "localhost",
     ),
 
+    # distribution, how packets are distributed across the resolved remote_hosts
+    # - str
+    # - Optional, default: 'broadcast'
+    # - 'broadcast' sends every packet to every host, 'round_robin' sends every packet to the next
+    #   host in turn and 'hash' sends every series (measurement and tags) always to the same host.
+    #   The latter two are meant for a pool of InfluxDB relays / shards that shouldn't all ingest
+    #   everything. Packets and bytes sent to each host are self reported (with destination metadata).
+    # - Example: 'distribution': 'hash',
+
+    # series_cache_size, number of cached series keys
+    # - int
+    # - Optional, default: 10000
+    # - The escaped measurement and tags part of lines is cached, as tag sets hardly change between
+    #   flushes. The cache is cleared when it gets full, 0 disables it. Also applies to influxdb_http_client.
+    # - Example: 'series_cache_size': 50000,
+
     # flush_interval should be short for this module so it overrides the value from
     # the global context. Also, flush_interval<=3 implies randomize_startup=False
     'flush_interval': 1,
-    # As describe above, this module should use small chunk_size
-    'chunk_size': 5,
+
+    # max_packet_size, UDP payload size budget (in bytes)
+    # - int
+    # - Optional, default: 1400
+    # - Lines are packed into UDP packets until the next line would exceed this budget, so that
+    #   packets are full but stay within MTU (and don't get fragmented). A line longer than
+    #   max_packet_size is sent in a packet on its own. It is enforced to be at least 100.
+    #   Packets and bytes sent as well as the average packet fill are self reported.
+    # - Example: 'max_packet_size': 8192,
+}
+
+
+# The HTTP flavour of InfluxDB module, unlike UDP, it doesn't lose data silently under load.
+influxdb_http = {
+    'module_type': "influxdb_http_client",
+    'module_inactive': True,
+
+    # remote_hosts, InfluxDB endpoints
+    # - tuple of str
+    # - Required
+    # - See remote_hosts in Elasticsearch module. Data is written to a randomly picked endpoint,
+    #   the connection is kept alive across flushes and recycled every 3min. The default port is 8086.
+    # - Example: 'remote_hosts': ("influxdb1", "influxdb2:1234"),
+    'remote_hosts': (
+        "localhost",
+    ),
+
+    # api_version, InfluxDB write API version
+    # - int
+    # - Optional, default: 1
+    # - With 1, data is POSTed to /write, with 2 it is POSTed to /api/v2/write.
+    # - Example: 'api_version': 2,
+
+    # database
+    # - str
+    # - Required
+    # - The database to write to, in API v2 it is the destination bucket.
+    'database': "metrics",
+
+    # org
+    # - str
+    # - Required in API v2, ignored in API v1
+    # - Example: 'org': "myorg",
+
+    # retention_policy
+    # - str
+    # - Optional, default: None
+    # - Only used with API v1, if None, the default retention policy of the database applies.
+    # - Example: 'retention_policy': "one_week",
+
+    # auth_token
+    # - str
+    # - Optional, default: None
+    # - If provided, it is sent in "Authorization: Token ..." header. InfluxDB 1.8+ accepts
+    #   "username:password" as a token in API v1.
+    # - Example: 'auth_token': "my-secret-token",
+
+    # precision, timestamps precision
+    # - str
+    # - Optional, default: 'ns'
+    # - One of 'ns', 'us', 'ms', 's'. Lower precision means shorter lines. API v1 gets them
+    #   as 'n', 'u', 'ms', 's' respectively.
+    # - Example: 'precision': 'ms',
+
+    # max_batch_size, size limit of a single write (in bytes, before compression)
+    # - int
+    # - Optional, default: 1048576
+    # - Writes are closed at max_batch_size bytes or chunk_size lines, whichever comes first.
+    #   It is enforced to be at least 1024.
+    # - Example: 'max_batch_size': 262144,
+
+    # compression, compression_level
+    # - str / int
+    # - Optional, default: 'gzip' / 6
+    # - Only 'gzip' is accepted by InfluxDB, set compression to None to disable it.
+    # - Example: 'compression': None,
+
+    # Writes answered with 429 or 503 are retried, respecting the Retry-After header if present.
+    # Writes rejected with 400 or 413 are dropped, as resending them wouldn't help.
+
+    'flush_interval': 1,
+    'chunk_size': 5000,
 }
 
 
@@ -533,26 +770,87 @@ elasticsearch = {
     #   known as epoch_millis. See: https://www.elastic.co/guide/en/elasticsearch/reference/current/date.html
     # - Example: 'timestamp_field_name': '@timestamp',
 
+    # id_mode, how document ids are produced
+    # - str
+    # - Optional, default: 'uuid5'
+    # - 'uuid5' - ids are UUID5 of the doc content, so that resending a doc doesn't duplicate it.
+    #   'hash' - ids are (cheaper to compute) 128 bit BLAKE2 hashes of the doc content, same purpose.
+    #   'none' - no ids are sent, Elasticsearch generates them (the cheapest option, and keys
+    #   in docs don't need sorting), but docs resent after a failure can get duplicated.
+    # - Example: 'id_mode': 'hash',
+
     # remote_hosts, Elasticsearch endpoints
     # - tuple of str
     # - Required
     # - See remote_hosts in InfluxDB module. Elasticsearch endpoints are TCP and this
-    #   client sends data to a randomly picked one from the pool of resolved endpoints.
-    #   The connection is recycled every 3min. This is to provide load balancing that
-    #   follows topology changes. The default port is 9200.
+    #   client keeps a pool of keep-alive connections to the resolved endpoints, new connections
+    #   go to the least used endpoint. Connections are recycled every 3min. This is to provide
+    #   load balancing that follows topology changes. The default port is 9200.
     # - Example: 'remote_hosts': ("es1", "es2:1234"),
     'remote_hosts': (
         "localhost",
     ),
 
+    # pool_size, number of idle keep-alive connections kept between bulk uploads
+    # - int
+    # - Optional, default: 2
+    # - Connections beyond this are closed after use. It is enforced to be at least 1.
+    # - Example: 'pool_size': 4,
+
+    # max_batch_size, size limit of a single bulk upload (in bytes, before compression)
+    # - int
+    # - Optional, default: 5242880
+    # - Bulk uploads are closed at max_batch_size bytes or chunk_size docs, whichever comes first.
+    #   Keep it well below http.max_content_length of the cluster. It is enforced to be at least 1024.
+    # - Example: 'max_batch_size': 10485760,
+
+    # max_doc_size, size limit of a single doc (in bytes)
+    # - int
+    # - Optional, default: 1048576
+    # - Bigger docs are dropped (and counted in docs_oversized). It is enforced to be at least 1024.
+    # - Example: 'max_doc_size': 65536,
+
+    # max_retries, retry_backoff, retry_budget
+    # - int / float / float
+    # - Optional, default: 5 / 1 / 0.1
+    # - Docs rejected by Elasticsearch with 429, 502, 503 or 504 (i.e. es_rejected_execution_exception
+    #   when the cluster is under pressure) are retried up to max_retries times, after retry_backoff
+    #   seconds doubled on each attempt (with jitter). Only retry_budget * buffer_limit docs can wait
+    #   for a retry at once. Docs rejected with other codes, or out of retries, are dropped and counted
+    #   in docs_dead_lettered. Bulk uploads failing as a whole are kept in the buffer as before.
+    # - Example: 'max_retries': 0,
+
+    # push_concurrency, number of bulk uploads in flight at once
+    # - int
+    # - Optional, default: 1
+    # - With values above 1, consecutive chunks from the buffer are uploaded concurrently, each over
+    #   its own pooled connection, so they get spread over the resolved hosts. Chunks that fail are
+    #   kept in the buffer, the ones that succeed are removed regardless of the order they finish in.
+    #   pool_size is enforced to be at least push_concurrency.
+    # - Example: 'push_concurrency': 4,
+
+    # connection_max_requests
+    # - int
+    # - Optional, default: 1000
+    # - A pooled connection is retired after this many bulk uploads. Connections are also
+    #   retired on any error and when they are older than 3min.
+    # - Example: 'connection_max_requests': 100,
+
     'flush_interval': 5,
 
     # compression, whether to compress HTTP payload in Elasticsearch API calls
     # - str
     # - Optional, default: None
     # - In heavy load setups, compressing JSON bulk uploads can save a lot of bandwidth.
-    #   Acceptable values are: 'deflate' and 'gzip'
+    #   Acceptable values are: 'deflate' and 'gzip'. Bulk bodies are compressed as they are
+    #   being encoded, see compression_ratio and compression_time in self report.
     # - Example: 'compression': 'deflate',
+
+    # compression_level
+    # - int
+    # - Optional, default: 6
+    # - zlib compression level, 1 is the fastest, 9 compresses best.
+    # - Example: 'compression_level': 1,
 }
 
 
@@ -571,6 +869,8 @@ prometheus = {
     # - Optional, default: "metrics"
     # - This module only replies to GETs for /http_path, by default it is GET /metrics
     #   Other requests receive 404. If you use http_path="", the endpoint will be GET /
+    #   Responses carry an ETag, a scrape with a matching If-None-Match header gets 304 Not Modified
+    #   if nothing has been received or evicted since, which makes redundant scrapes almost free.
     # - Example: 'http_path': "",
 
     # flush_interval in combination with values_timeout define the metrics retention
@@ -599,4 +899,13 @@ prometheus = {
     # - Note that unlike Elasticsearch, Prometheus can only accept 'gzip' encoding.
     #   Also, the module will only use gzip when client offers it with 'Accept-Encoding'.
     'compression': 'gzip',
+
+    # exposition_formats, formats the module is allowed to serve
+    # - tuple of str
+    # - Optional, default: ('text', 'openmetrics', 'protobuf')
+    # - The format is negotiated with the 'Accept' header sent by the client, the text format 0.0.4
+    #   is used when the client doesn't ask for anything else. 'openmetrics' is the OpenMetrics text
+    #   format and 'protobuf' is the Prometheus delimited protobuf format. Both are cheaper to parse
+    #   for the scraper. Series are grouped into families by bucket in all formats.
+    # - Example: 'exposition_formats': ('text',),
 }
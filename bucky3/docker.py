@@ -12,19 +12,46 @@ Hence this hybrid implementation. It extracts the resources usage from /sys & /p
 gets the meta info via docker API calls (those used are fast though). Consequently:
 - it only works with local docker (because it uses unix socket)
 - it only works locally on linux (because it uses /proc & /sys)
-- it is single threaded and fast, metrics for 100 containers are collected in a split of sec
+- it is fast, metrics for 100 containers are collected in a split of sec
+  (the cgroup files are opened once per container and re-read on every scan)
 - it has no external dependencies, vanilla Python3
 - it is vulnerable to future changes in docker API as well as changes in /sys layout
+  (both cgroup v1 and the v2 unified hierarchy are supported, the cgroupfs and systemd drivers)
+
+The scan itself runs in flush, but the docker API calls that are slow or blocking are done
+by background threads:
+- the inspect executor (inspect_concurrency threads) inspects new containers, the flush
+  waits for them up to inspect_timeout. They share inspect_cache, inspect_cache_generation
+  and inspects_in_flight with the flush, all guarded by inspect_cache_lock.
+- the events thread follows the docker events stream and drops the inspect_cache entries
+  of containers that changed, under inspect_cache_lock as well. The docker_events counter
+  is only written by this thread, the flush just reads it for the self report.
+- the filesystem thread inspects containers with their sizes every filesystem_interval.
+  It reads container_ids (replaced by the flush as a whole, never modified in place)
+  and fills filesystem_stats, both of them guarded by filesystem_stats_lock.
+All of them take their docker connections from docker_pool, which has its own lock.
 """
 
+import os
 import re
 import json
+import errno
+import time
 import socket
+import threading
+import collections
 import http.client
+import concurrent.futures
+import urllib.parse
 import bucky3.module as module
 import bucky3.linux as linux
 
 
+class DockerAPIError(ConnectionError):
+    # Error responses leave the connection in a usable state
+    pass
+
+
 class DockerConnection(http.client.HTTPConnection):
     def __init__(self, docker_socket, api_version):
         super().__init__(docker_socket)
@@ -38,18 +65,152 @@ class DockerConnection(http.client.HTTPConnection):
         url = '/v' + self.api_version + url
         self.request('GET', url)
         resp = self.getresponse()
+        body = resp.read()
         if resp.status != 200:
-            raise ConnectionError('Docker error code {} for {}'.format(resp.status, url))
-        return json.loads(resp.read().decode('utf-8'))
+            raise DockerAPIError('Docker error code {} for {}'.format(resp.status, url))
+        return json.loads(body.decode('utf-8'))
 
     def list_containers(self):
         return self._get_json('/containers/json')
 
-    def inspect_container(self, container_id):
-        return self._get_json('/containers/' + str(container_id) + '/json?size=true')
+    def inspect_container(self, container_id, size=False):
+        # With size=true docker walks the container filesystem, it is by far the slowest call.
+        return self._get_json('/containers/' + str(container_id) + '/json?size=' + ('true' if size else 'false'))
+
+    # https://docs.docker.com/engine/api/v1.22/#monitor-dockers-events
+    def container_events(self):
+        url = '/v' + self.api_version + '/events?filters=' + urllib.parse.quote('{"type":["container"]}')
+        self.request('GET', url)
+        resp = self.getresponse()
+        if resp.status != 200:
+            raise ConnectionError('Docker error code {} for {}'.format(resp.status, url))
+        # A never ending stream of JSON objects, one per line.
+        while True:
+            l = resp.readline()
+            if not l:
+                raise ConnectionError('Docker events stream ended')
+            l = l.strip()
+            if l:
+                yield json.loads(l.decode('utf-8'))
+
+
+class DockerConnectionPool:
+    # Keep-alive connections to the docker API, shared by the flushes and the background threads.
+    def __init__(self, docker_socket, api_version, pool_size):
+        self.docker_socket = docker_socket
+        self.api_version = api_version
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.idle_connections = collections.deque()
+        # Per API call: count, total time, max time
+        self.latencies = {}
+
+    def call(self, method, *args):
+        with self.lock:
+            connection = self.idle_connections.pop() if self.idle_connections else None
+        if connection is None:
+            connection = DockerConnection(self.docker_socket, self.api_version)
+        call_start = time.monotonic()
+        try:
+            result = getattr(connection, method)(*args)
+        except DockerAPIError:
+            # I.e. 404 for a container removed in the meantime
+            self.release(connection, call_start, method)
+            raise
+        except Exception:
+            connection.close()
+            raise
+        self.release(connection, call_start, method)
+        return result
+
+    def release(self, connection, call_start, method):
+        call_time = time.monotonic() - call_start
+        with self.lock:
+            latency = self.latencies.get(method)
+            if latency is None:
+                latency = self.latencies[method] = [0, 0, 0]
+            latency[0] += 1
+            latency[1] += call_time
+            latency[2] = max(latency[2], call_time)
+            if connection.sock is not None and len(self.idle_connections) < self.pool_size:
+                self.idle_connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            while self.idle_connections:
+                self.idle_connections.pop().close()
+
+    def take_latencies(self):
+        # Per API call count, average and max latency (in ms) since the previous call
+        with self.lock:
+            latencies, self.latencies = self.latencies, {}
+        return {
+            method: (count, round(1000 * total / count, 3), round(1000 * max_time, 3))
+            for method, (count, total, max_time) in latencies.items()
+        }
+
+
+class HandleBudget:
+    # File handles kept open by all containers together, see max_cached_handles
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+
+class DockerContainer:
+    # Per container state, set up when the container shows up (or its inspect info changes)
+    # and torn down when it is gone. The steady state scan only re-reads the files kept open here.
+    def __init__(self, container_id, metadata, inspect_info, cgroup_paths, handle_budget):
+        self.container_id = container_id
+        self.metadata = metadata
+        self.inspect_info = inspect_info
+        self.host_config = inspect_info['HostConfig']
+        self.root_pid = inspect_info['State']['Pid']
+        self.cgroup_paths = cgroup_paths
+        self.handle_budget = handle_budget
+        self.files = {}
+
+    def read_file(self, path, optional=False):
+        # Handles are kept open for the container lifetime, a seek and re-read is way cheaper
+        # than open & close on every scan. Once the handle budget is used up, files are opened
+        # and closed on every read. Missing optional files (i.e. no PSI in the kernel)
+        # are remembered as None, so they are not looked up again.
+        f = self.files.get(path, False)
+        if f is False:
+            try:
+                f = open(path)
+            except FileNotFoundError:
+                if not optional:
+                    raise
+                self.files[path] = None
+                return None
+            if self.handle_budget.used >= self.handle_budget.limit:
+                with f:
+                    return f.read().splitlines()
+            self.files[path] = f
+            self.handle_budget.used += 1
+        if f is None:
+            return None
+        f.seek(0)
+        return f.read().splitlines()
+
+    def close(self):
+        for f in self.files.values():
+            if f is not None:
+                f.close()
+                self.handle_budget.used -= 1
+        self.files.clear()
 
 
 class DockerStatsCollector(module.MetricsSrcProcess, linux.ProcfsReader):
+    # Container events that can change the inspect info. The frequent exec_* and health_status
+    # events leave it as is, so the cache is kept for them.
+    INVALIDATING_EVENTS = frozenset((
+        'create', 'start', 'stop', 'die', 'destroy', 'rename', 'update', 'pause', 'unpause',
+    ))
+
     def __init__(self, *args):
         super().__init__(*args)
         self.meta_name_regex = re.compile(r'([a-zA-Z][a-zA-Z0-9_]*)')
@@ -62,47 +223,314 @@ class DockerStatsCollector(module.MetricsSrcProcess, linux.ProcfsReader):
         self.docker_socket = self.cfg.get('docker_socket', '/var/run/docker.sock')
         self.env_mapping = self.cfg.get('env_mapping')
         self.system_memory = dict(self.read_memory())['total_bytes']
+        # Inspect info per container ID. Entries are dropped when a docker event comes for the container,
+        # they also expire after inspect_cache_ttl as a safety net.
+        self.inspect_cache_ttl = self.cfg.get('inspect_cache_ttl', 300)
+        self.inspect_cache = {}
+        self.inspect_cache_lock = threading.Lock()
+        self.inspect_cache_generation = 0
+        self.inspect_calls = 0
+        self.docker_events = 0
+        # Filesystem sizes are collected in the background, at their own (slower) pace.
+        self.filesystem_interval = max(self.cfg.get('filesystem_interval', 60), 1)
+        self.filesystem_stats = {}
+        self.filesystem_stats_lock = threading.Lock()
+        self.container_ids = ()
+        self.cgroup_root = self.cfg.get('cgroup_root', '/sys/fs/cgroup')
+        self.cgroup_v2 = os.path.exists(os.path.join(self.cgroup_root, 'cgroup.controllers'))
+        # DockerContainer per container ID
+        self.containers = {}
+        self.handle_budget = HandleBudget(self.get_max_cached_handles(512))
+        self.container_setups = 0
+        self.inspect_concurrency = max(self.cfg.get('inspect_concurrency', 4), 1)
+        self.inspect_timeout = self.cfg.get('inspect_timeout', self.tick_interval / 2)
+        self.inspects_in_flight = set()
+        self.inspect_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.inspect_concurrency, thread_name_prefix='DockerInspectThread'
+        )
+        # The inspect workers, the filesystem thread and the flush itself
+        self.docker_pool = DockerConnectionPool(self.docker_socket, self.api_version, self.inspect_concurrency + 2)
 
-    def read_df_stats(self, buffer, container_id, timestamp, container_metadata, inspect_info):
-        df_stats = {
-            'total_bytes': int(inspect_info['SizeRootFs']),
-            'used_bytes': int(inspect_info.get('SizeRw', 0)),
-        }
-        buffer.append(("docker_filesystem", df_stats, timestamp, container_metadata))
+    def loop(self):
+        self.start_thread('DockerEventsThread', self.events_loop)
+        self.start_thread('DockerFilesystemThread', self.filesystem_loop)
+        super().loop()
+
+    def filesystem_loop(self):
+        while True:
+            container_ids = self.container_ids
+            if not container_ids:
+                time.sleep(1)
+                continue
+            # Containers are spread over the interval, rather than inspected all at once.
+            delay = self.filesystem_interval / len(container_ids)
+            try:
+                for container_id in sorted(container_ids):
+                    inspect_start = time.monotonic()
+                    if container_id in self.container_ids:
+                        try:
+                            inspect_info = self.docker_pool.call('inspect_container', container_id, True)
+                            df_stats = {
+                                'total_bytes': int(inspect_info.get('SizeRootFs', 0)),
+                                'used_bytes': int(inspect_info.get('SizeRw', 0)),
+                            }
+                            with self.filesystem_stats_lock:
+                                # The flush could have pruned the container while it was being inspected.
+                                if container_id in self.container_ids:
+                                    self.filesystem_stats[container_id] = df_stats
+                        except DockerAPIError:
+                            # Removed in the meantime?
+                            self.log.debug('Could not inspect container %s', container_id)
+                        except (OSError, ValueError, TypeError, http.client.HTTPException) as e:
+                            # A bad inspect (or a hiccup of the daemon) only skips this container,
+                            # the thread going down would take the whole module with it.
+                            self.log.warning('Docker filesystem stats for container %s failed: %r', container_id, e)
+                    time.sleep(max(delay - (time.monotonic() - inspect_start), 0))
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                self.log.warning('Docker filesystem stats failed: %r', e)
+                time.sleep(1)
+
+    def invalidate_inspect_cache(self, container_id=None):
+        with self.inspect_cache_lock:
+            self.inspect_cache_generation += 1
+            if container_id is None:
+                self.inspect_cache.clear()
+            else:
+                self.inspect_cache.pop(container_id, None)
+
+    def events_loop(self):
+        while True:
+            docker_connection = DockerConnection(self.docker_socket, self.api_version)
+            try:
+                events = docker_connection.container_events()
+                # Events could have been missed while not subscribed
+                self.invalidate_inspect_cache()
+                self.log.debug('Subscribed to docker events')
+                for event in events:
+                    container_id = event.get('id') or event.get('Actor', {}).get('ID')
+                    if container_id:
+                        self.docker_events += 1
+                        action = event.get('Action') or event.get('status') or ''
+                        if action in self.INVALIDATING_EVENTS:
+                            self.invalidate_inspect_cache(container_id)
+            except (ConnectionError, FileNotFoundError, http.client.HTTPException, ValueError) as e:
+                self.log.warning('Docker events subscription failed: %r', e)
+            finally:
+                docker_connection.close()
+            self.invalidate_inspect_cache()
+            time.sleep(1)
+
+    def inspect_container(self, container_id, cache_generation):
+        try:
+            inspect_info = self.docker_pool.call('inspect_container', container_id)
+        finally:
+            with self.inspect_cache_lock:
+                self.inspects_in_flight.discard(container_id)
+        with self.inspect_cache_lock:
+            self.inspect_calls += 1
+            # Unless an event came in the meantime, the info could be already stale then.
+            if self.inspect_cache_generation == cache_generation:
+                self.inspect_cache[container_id] = time.monotonic(), inspect_info
+        return inspect_info
+
+    def get_inspect_infos(self, container_ids):
+        # Cache misses are inspected concurrently. Those not done within inspect_timeout are skipped
+        # in this flush, they land in the cache when done, so a slow docker daemon doesn't stretch
+        # the scan beyond flush_interval.
+        now = time.monotonic()
+        inspect_infos, futures = {}, {}
+        with self.inspect_cache_lock:
+            cache_generation = self.inspect_cache_generation
+            for container_id in container_ids:
+                cache_entry = self.inspect_cache.get(container_id)
+                if cache_entry and now - cache_entry[0] < self.inspect_cache_ttl:
+                    inspect_infos[container_id] = cache_entry[1]
+                elif container_id not in self.inspects_in_flight:
+                    self.inspects_in_flight.add(container_id)
+                    futures[container_id] = None
+        for container_id in futures:
+            futures[container_id] = self.inspect_executor.submit(
+                self.inspect_container, container_id, cache_generation
+            )
+        if futures:
+            concurrent.futures.wait(futures.values(), timeout=self.inspect_timeout)
+        for container_id, future in futures.items():
+            if not future.done():
+                self.log.debug('Inspect of container %s still pending', container_id)
+            elif future.exception():
+                # Most likely removed in the meantime
+                self.log.debug('Could not inspect container %s: %r', container_id, future.exception())
+            else:
+                inspect_infos[container_id] = future.result()
+        return inspect_infos
+
+    def read_df_stats(self, buffer, container, timestamp):
+        df_stats = self.filesystem_stats.get(container.container_id)
+        if df_stats:
+            buffer.append(("docker_filesystem", df_stats, timestamp, container.metadata))
+
+    # Docker puts containers in <parent>/<id> (cgroupfs driver) or in <parent>/docker-<id>.scope
+    # (systemd driver), for other parents we fall back to the cgroup of the container root process.
+    CGROUP_V1_CONTROLLERS = {
+        'cpuacct': ('cpu', 'cpuacct', 'cpu,cpuacct'),
+        'memory': ('memory',),
+        'blkio': ('blkio',),
+    }
 
-    def read_cpu_stats(self, buffer, container_id, timestamp, container_metadata, inspect_info):
-        host_config = inspect_info['HostConfig']
-        with open('/sys/fs/cgroup/cpu/docker/' + container_id + '/cpuacct.usage_percpu') as f:
-            cpu_tokens = f.read().strip().split()
+    def find_cgroup(self, container_id, root_pid, controller=None):
+        if controller:
+            bases = [os.path.join(self.cgroup_root, d) for d in self.CGROUP_V1_CONTROLLERS[controller]]
+        else:
+            bases = [self.cgroup_root]
+        for base in bases:
+            for path in ('docker/' + container_id, 'system.slice/docker-' + container_id + '.scope'):
+                path = os.path.join(base, path)
+                if os.path.isdir(path):
+                    return path
+        try:
+            with open('/proc/' + str(root_pid) + '/cgroup') as f:
+                for l in f:
+                    hierarchy_id, controllers, path = l.strip().split(':', 2)
+                    if controller:
+                        if controller not in controllers.split(','):
+                            continue
+                    elif hierarchy_id != '0':
+                        continue
+                    for base in bases:
+                        cgroup_path = os.path.join(base, path.lstrip('/'))
+                        if os.path.isdir(cgroup_path):
+                            return cgroup_path
+        except (OSError, ValueError):
+            pass
+        raise FileNotFoundError('No cgroup found for container ' + container_id)
+
+    def setup_container(self, container_id, container_info, inspect_info):
+        root_pid = inspect_info['State']['Pid']
+        if self.cgroup_v2:
+            path = self.find_cgroup(container_id, root_pid)
+            cgroup_paths = {c: path for c in self.CGROUP_V1_CONTROLLERS}
+        else:
+            cgroup_paths = {c: self.find_cgroup(container_id, root_pid, c) for c in self.CGROUP_V1_CONTROLLERS}
+        container_metadata = self.extract_metadata(container_id, container_info, inspect_info)
+        return DockerContainer(container_id, container_metadata, inspect_info, cgroup_paths, self.handle_budget)
+
+    def read_cpu_stats(self, buffer, container, timestamp):
+        host_config = container.host_config
+        cgroup_path = container.cgroup_paths['cpuacct']
+        if self.cgroup_v2:
+            # No per CPU usage in cgroup v2, it is reported as a whole, as "cpu".
+            cpu_stats = dict(self.parse_key_values(container.read_file(cgroup_path + '/cpu.stat')))
+            metadata = container.metadata.copy()
+            metadata.update(name='cpu')
+            buffer.append(("docker_cpu", {
+                'usage': cpu_stats['usage_usec'] * 1000,
+                'user': cpu_stats.get('user_usec', 0) * 1000,
+                'system': cpu_stats.get('system_usec', 0) * 1000,
+                'throttled_periods': cpu_stats.get('nr_throttled', 0),
+                'throttled_time': cpu_stats.get('throttled_usec', 0) * 1000,
+            }, timestamp, metadata))
+            cpu_count = os.cpu_count() or 1
+        else:
+            cpu_tokens = container.read_file(cgroup_path + '/cpuacct.usage_percpu')[0].split()
             for k, v in enumerate(cpu_tokens):
-                metadata = container_metadata.copy()
+                metadata = container.metadata.copy()
                 metadata.update(name='cpu' + str(k))
                 buffer.append(("docker_cpu", {'usage': int(v)}, timestamp, metadata))
-            # Docker reports CPU counters in nanosecs but quota/period in microsecs, here we make sure we send out
-            # all CPU metrics in nanosecs - that differs from linuxstats module CPU counters that are in USER_HZ.
-            limit_ps = host_config.get('NanoCpus', 0)
-            if not limit_ps:
-                cpu_period = host_config.get('CpuPeriod', 0) or 1000000
-                cpu_quota = host_config.get('CpuQuota', 0)
-                if not cpu_quota:
-                    cpu_quota = cpu_period * len(cpu_tokens)
-                limit_ps = round(1000000000 * cpu_quota / cpu_period)
-            buffer.append(("docker_cpu", {'limit_ps': limit_ps}, timestamp, container_metadata))
-
-    def read_interface_stats(self, buffer, container_id, timestamp, container_metadata, inspect_info):
-        root_pid = inspect_info['State']['Pid']
-        for interface_name, interface_stats in self.read_interfaces('/proc/' + str(root_pid) + '/net/dev'):
-            metadata = container_metadata.copy()
+            cpu_count = len(cpu_tokens)
+        # Docker reports CPU counters in nanosecs but quota/period in microsecs, here we make sure we send out
+        # all CPU metrics in nanosecs - that differs from linuxstats module CPU counters that are in USER_HZ.
+        limit_ps = host_config.get('NanoCpus', 0)
+        if not limit_ps:
+            cpu_period = host_config.get('CpuPeriod', 0) or 1000000
+            cpu_quota = host_config.get('CpuQuota', 0)
+            if not cpu_quota:
+                cpu_quota = cpu_period * cpu_count
+            limit_ps = round(1000000000 * cpu_quota / cpu_period)
+        buffer.append(("docker_cpu", {'limit_ps': limit_ps}, timestamp, container.metadata))
+
+    def read_interface_stats(self, buffer, container, timestamp):
+        for interface_name, interface_stats in self.parse_interfaces(
+            container.read_file('/proc/' + str(container.root_pid) + '/net/dev')
+        ):
+            metadata = container.metadata.copy()
             metadata.update(name=interface_name)
             buffer.append(("docker_interface", interface_stats, timestamp, metadata))
 
-    def read_memory_stats(self, buffer, container_id, timestamp, container_metadata, inspect_info):
-        host_config = inspect_info['HostConfig']
-        with open('/sys/fs/cgroup/memory/docker/' + container_id + '/memory.usage_in_bytes') as f:
-            buffer.append(("docker_memory", {
-                'used_bytes': int(f.read().strip()),
-                'limit_bytes': int(host_config.get('Memory') or self.system_memory),
-            }, timestamp, container_metadata))
+    MEMORY_STAT_FIELDS = {
+        'anon': 'anon_bytes',
+        'file': 'file_bytes',
+        'shmem': 'shared_bytes',
+        'slab': 'slab_bytes',
+    }
+
+    def read_memory_stats(self, buffer, container, timestamp):
+        cgroup_path = container.cgroup_paths['memory']
+        memory_stats = {'limit_bytes': int(container.host_config.get('Memory') or self.system_memory)}
+        if self.cgroup_v2:
+            memory_stats['used_bytes'] = int(container.read_file(cgroup_path + '/memory.current')[0])
+            for k, v in self.parse_key_values(container.read_file(cgroup_path + '/memory.stat')):
+                if k in self.MEMORY_STAT_FIELDS:
+                    memory_stats[self.MEMORY_STAT_FIELDS[k]] = v
+        else:
+            memory_stats['used_bytes'] = int(container.read_file(cgroup_path + '/memory.usage_in_bytes')[0])
+        buffer.append(("docker_memory", memory_stats, timestamp, container.metadata))
+
+    # Per device, the cgroup v1 names are from blkio.throttle.io_service_bytes & io_serviced,
+    # the v2 ones from io.stat. The v1 throttle files account I/O regardless of the I/O scheduler.
+    BLKIO_V1_FIELDS = {
+        'Read': 'read',
+        'Write': 'write',
+        'Discard': 'discard',
+    }
+    BLKIO_V2_FIELDS = {
+        'rbytes': 'read_bytes',
+        'wbytes': 'write_bytes',
+        'dbytes': 'discard_bytes',
+        'rios': 'read_ops',
+        'wios': 'write_ops',
+        'dios': 'discard_ops',
+    }
+
+    def read_blkio_stats(self, buffer, container, timestamp):
+        cgroup_path = container.cgroup_paths['blkio']
+        devices = {}
+        if self.cgroup_v2:
+            io_stat = container.read_file(cgroup_path + '/io.stat')
+            for device, device_stats in self.parse_nested_key_values(io_stat):
+                devices[device] = {
+                    self.BLKIO_V2_FIELDS[k]: v for k, v in device_stats.items() if k in self.BLKIO_V2_FIELDS
+                }
+        else:
+            for file_name, suffix in ('io_service_bytes', '_bytes'), ('io_serviced', '_ops'):
+                for l in container.read_file(cgroup_path + '/blkio.throttle.' + file_name):
+                    tokens = l.split()
+                    if len(tokens) == 3 and tokens[1] in self.BLKIO_V1_FIELDS:
+                        device_stats = devices.setdefault(tokens[0], {})
+                        device_stats[self.BLKIO_V1_FIELDS[tokens[1]] + suffix] = int(tokens[2])
+        for device, device_stats in devices.items():
+            if device_stats:
+                metadata = container.metadata.copy()
+                metadata.update(name=device)
+                buffer.append(("docker_blkio", device_stats, timestamp, metadata))
+
+    # Only in cgroup v2 and with CONFIG_PSI, the averages are in % and the totals in microsecs.
+    PRESSURE_RESOURCES = ('cpu', 'memory', 'io')
+
+    def read_pressure_stats(self, buffer, container, timestamp):
+        if not self.cgroup_v2:
+            return
+        cgroup_path = container.cgroup_paths['cpuacct']
+        for resource in self.PRESSURE_RESOURCES:
+            lines = container.read_file(cgroup_path + '/' + resource + '.pressure', optional=True)
+            if not lines:
+                continue
+            pressure_stats = {}
+            for kind, kind_stats in self.parse_nested_key_values(lines):
+                for k, v in kind_stats.items():
+                    pressure_stats[kind + '_' + k] = v
+            metadata = container.metadata.copy()
+            metadata.update(name=resource)
+            buffer.append(("docker_pressure", pressure_stats, timestamp, metadata))
 
     def extract_metadata(self, container_id, container_info, inspect_info):
         inspect_config = inspect_info['Config']
@@ -127,30 +555,85 @@ class DockerStatsCollector(module.MetricsSrcProcess, linux.ProcfsReader):
 
     def flush(self, system_timestamp):
         timestamp = system_timestamp if self.add_timestamps else None
-        docker_connection = None
         try:
             self.log.debug('Starting containers scan')
-            docker_connection = DockerConnection(self.docker_socket, self.api_version)
-            for container_info in sorted(docker_connection.list_containers(), key=lambda v: v.get('Id')):
+            container_list = self.docker_pool.call('list_containers')
+            container_infos = {container_info.get('Id'): container_info for container_info in container_list}
+            for container_id in [i for i in self.containers if i not in container_infos]:
+                self.containers.pop(container_id).close()
+            with self.filesystem_stats_lock:
+                for container_id in [i for i in self.filesystem_stats if i not in container_infos]:
+                    del self.filesystem_stats[container_id]
+                self.container_ids = frozenset(container_infos)
+            # Only new containers and those with their inspect info gone from the cache (a docker event
+            # or inspect_cache_ttl) need setting up, the rest is scanned with the state kept from before.
+            now = time.monotonic()
+            with self.inspect_cache_lock:
+                for container_id in [i for i in self.inspect_cache if i not in container_infos]:
+                    del self.inspect_cache[container_id]
+                pending_ids = []
+                for container_id in container_infos:
+                    container = self.containers.get(container_id)
+                    cache_entry = self.inspect_cache.get(container_id)
+                    if container is None or cache_entry is None or cache_entry[1] is not container.inspect_info \
+                            or now - cache_entry[0] >= self.inspect_cache_ttl:
+                        pending_ids.append(container_id)
+            if pending_ids:
+                inspect_infos = self.get_inspect_infos(pending_ids)
+                for container_id in pending_ids:
+                    inspect_info = inspect_infos.get(container_id)
+                    if inspect_info is None:
+                        # Not inspected yet, a known container keeps its current state meanwhile.
+                        continue
+                    container = self.containers.pop(container_id, None)
+                    if container:
+                        container.close()
+                    try:
+                        self.containers[container_id] = self.setup_container(
+                            container_id, container_infos[container_id], inspect_info
+                        )
+                        self.container_setups += 1
+                    except FileNotFoundError:
+                        # No cgroups (yet?), it will be looked up again.
+                        self.log.debug('No cgroups for container %s', container_id)
+            for container in list(self.containers.values()):
                 try:
                     buffer = []
-                    container_id = container_info['Id']
-                    inspect_info = docker_connection.inspect_container(container_id)
-                    container_metadata = self.extract_metadata(container_id, container_info, inspect_info)
-                    self.read_df_stats(buffer, container_id, timestamp, container_metadata, inspect_info)
-                    self.read_cpu_stats(buffer, container_id, timestamp, container_metadata, inspect_info)
-                    self.read_memory_stats(buffer, container_id, timestamp, container_metadata, inspect_info)
-                    self.read_interface_stats(buffer, container_id, timestamp, container_metadata, inspect_info)
+                    self.read_df_stats(buffer, container, timestamp)
+                    self.read_cpu_stats(buffer, container, timestamp)
+                    self.read_memory_stats(buffer, container, timestamp)
+                    self.read_blkio_stats(buffer, container, timestamp)
+                    self.read_pressure_stats(buffer, container, timestamp)
+                    self.read_interface_stats(buffer, container, timestamp)
                     for metric in buffer:
                         self.buffer_metric(*metric)
-                except FileNotFoundError:
-                    pass
+                except OSError as e:
+                    if e.errno in (errno.EMFILE, errno.ENFILE):
+                        # Not the container's fault, tearing it down would only make it worse.
+                        self.log.warning('Out of file descriptors, missing stats for container %s',
+                                         container.container_id)
+                        continue
+                    # Most likely the container is gone (reading a removed cgroup via an open handle
+                    # fails with ENODEV), otherwise it will be set up again.
+                    self.log.debug('Missing stats for container %s', container.container_id)
+                    del self.containers[container.container_id]
+                    container.close()
             self.log.debug('Finished containers scan')
             return super().flush(system_timestamp)
-        except (ConnectionError, FileNotFoundError):
+        except (ConnectionError, FileNotFoundError, http.client.HTTPException):
             self.log.exception("Docker error, is it running?")
             super().flush(system_timestamp)
             return False
-        finally:
-            if docker_connection:
-                docker_connection.close()
+
+    def produce_self_report(self):
+        self_report = super().produce_self_report()
+        self_report['inspect_calls'] = self.inspect_calls
+        self_report['docker_events'] = self.docker_events
+        self_report['containers'] = len(self.containers)
+        self_report['container_setups'] = self.container_setups
+        self_report['cached_handles'] = self.handle_budget.used
+        for method, (count, average, max_time) in self.docker_pool.take_latencies().items():
+            self_report[method + '_calls'] = count
+            self_report[method + '_latency'] = average
+            self_report[method + '_latency_max'] = max_time
+        return self_report
@@ -3,8 +3,16 @@
 import json
 import uuid
 import zlib
+import hashlib
 import gzip
+import time
+import heapq
+import random
+import itertools
+import threading
+import collections
 import http.client
+import concurrent.futures
 from datetime import timezone, timedelta
 import bucky3.module as module
 
@@ -13,42 +21,76 @@ TZ = timezone(timedelta(hours=0))
 
 
 class ElasticsearchConnection(http.client.HTTPConnection):
-    def __init__(self, open_socket, compression=None):
-        super().__init__('elasticsearch')
-        self.open_socket = open_socket
+    # zlib wbits for the supported content encodings, 31 produces the gzip container
+    COMPRESSION_WBITS = {
+        'gzip': 16 + zlib.MAX_WBITS,
+        'deflate': zlib.MAX_WBITS,
+    }
+    # Docs are encoded in pieces of roughly this size, rather than in one go
+    BODY_PIECE_SIZE = 64 * 1024
+
+    def __init__(self, remote_host, compression=None, timeout=None, compression_level=6):
+        super().__init__(*remote_host, timeout=timeout)
+        self.remote_host = remote_host
         self.compression = compression
-        if compression == 'gzip':
-            self.compressor = gzip.compress
-        elif compression == 'deflate':
-            self.compressor = zlib.compress
-        else:
-            self.compressor = lambda x: x
+        self.compression_level = compression_level
+        self.created = time.monotonic()
+        self.requests = 0
 
     def connect(self):
-        self.sock = self.open_socket()
         try:
-            self.host = self.sock.getpeername()[0]
-        except OSError:
-            # This can happen if in between calls something happens to the socket.
-            # I.e. getpeername raises OSError when called on the closed socket,
-            # we only handle ConnectionError and socket.timeout in the calling code.
-            raise ConnectionError('Elasticsearch connection seems broken')
+            super().connect()
+        except OSError as e:
+            # Connect failures (including timeouts) are not fatal, the calling code only handles
+            # ConnectionError and socket.timeout, so the remaining OSErrors are translated here.
+            raise ConnectionError('Elasticsearch connection to {}:{} failed: {!r}'.format(self.host, self.port, e))
 
     # https://www.elastic.co/guide/en/elasticsearch/reference/5.6/docs-bulk.html
     # https://github.com/ndjson/ndjson-spec
+    def encode_body(self, docs):
+        # Docs are encoded and fed to the compressor piece by piece, so there are never full size
+        # copies of the body (joined, encoded and compressed) in memory at the same time.
+        # Only the compressed output is kept, its length goes into Content-Length.
+        # The body comes with its stats, (size, compressed size, compression time).
+        compress_start = time.monotonic()
+        wbits = self.COMPRESSION_WBITS.get(self.compression)
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, wbits) if wbits else None
+        body, piece, piece_size, body_size = [], [], 0, 0
+        for i, doc in enumerate(docs, 1):
+            piece.append(doc)
+            piece_size += len(doc)
+            if piece_size >= self.BODY_PIECE_SIZE or i == len(docs):
+                data = ''.join(piece).encode('utf-8')
+                body_size += len(data)
+                if compressor:
+                    data = compressor.compress(data)
+                if data:
+                    body.append(data)
+                piece, piece_size = [], 0
+        if compressor:
+            body.append(compressor.flush())
+        body_stats = body_size, sum(len(data) for data in body), time.monotonic() - compress_start
+        return body, body_stats
+
     def bulk_upload(self, docs):
-        body = ''.join(docs).encode('utf-8')
+        # Returns the rejected items along with the body stats, the connection goes back to the pool
+        # right after the call, so nothing about the request is kept on it.
+        body, body_stats = self.encode_body(docs)
         headers = {
             # ES complains when receiving the content type with charset specified, even though
             # it does specify charset in its responses...
             # 'Content-Type': 'application/x-ndjson; charset=UTF-8'
-            'Content-Type': 'application/x-ndjson'
+            'Content-Type': 'application/x-ndjson',
+            'Content-Length': str(body_stats[1]),
         }
-        body = self.compressor(body)
         headers['Content-Encoding'] = headers['Accept-Encoding'] = self.compression
-        self.request('POST', '/_bulk', body=body, headers=headers)
-        resp = self.getresponse()
-        body = resp.read()
+        self.requests += 1
+        try:
+            self.request('POST', '/_bulk', body=body, headers=headers)
+            resp = self.getresponse()
+            body = resp.read()
+        except http.client.HTTPException as e:
+            raise ConnectionError('Elasticsearch HTTP error: ' + repr(e))
         if resp.status != 200:
             raise ConnectionError('Elasticsearch response code {}'.format(resp.status))
         if resp.headers.get('Content-Encoding') == 'deflate':
@@ -56,26 +98,126 @@ class ElasticsearchConnection(http.client.HTTPConnection):
         elif resp.headers.get('Content-Encoding') == 'gzip':
             body = gzip.decompress(body)
 
-        docs_rejected = 0
+        rejected_items = []
 
         try:
             body = body.decode('UTF-8')
             try:
                 body = json.loads(body)
                 if body.get('errors'):
-                    for i in body.get('items', []):
-                        doc_status = i.get('status', 200)
+                    # Items come in the order of docs, each one keyed by the action, i.e. {"index": {...}}
+                    for i, item in enumerate(body.get('items', [])):
+                        result = next(iter(item.values()), {}) if isinstance(item, dict) else {}
+                        doc_status = result.get('status', 200)
                         if doc_status >= 300 or doc_status < 200:
-                            docs_rejected += 1
+                            rejected_items.append((i, doc_status, result.get('error')))
             except json.decoder.JSONDecodeError:
                 raise ConnectionError('Elasticsearch response is not JSON')
         except UnicodeDecodeError:
             raise ConnectionError('Elasticsearch response is not UTF-8')
 
-        return docs_rejected
+        return rejected_items, body_stats
+
+
+class ElasticsearchConnectionPool:
+    # Keep-alive connections are kept across flushes. A connection is retired after max_requests
+    # bulk calls, after max_age seconds (so that, over time, connections follow topology changes
+    # and rebalance over the resolved hosts) or on any error. New connections are opened to the
+    # least used of the currently resolved hosts.
+    def __init__(self, resolve_hosts, connect, log, pool_size, max_requests, max_age=180):
+        self.resolve_hosts = resolve_hosts
+        self.connect = connect
+        self.log = log
+        self.pool_size = pool_size
+        self.max_requests = max_requests
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.idle_connections = collections.deque()
+        self.host_connections = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+        self.retired = 0
+        self.connect_count = 0
+        self.connect_time = 0
+
+    def usable(self, connection, resolved_hosts, now):
+        return (
+            connection.sock is not None and
+            connection.requests < self.max_requests and
+            now - connection.created < self.max_age and
+            connection.remote_host in resolved_hosts
+        )
+
+    def retire(self, connection):
+        # Must be called with the lock held.
+        connection.close()
+        self.host_connections[connection.remote_host] -= 1
+        if self.host_connections[connection.remote_host] <= 0:
+            del self.host_connections[connection.remote_host]
+        self.retired += 1
+
+    def acquire(self):
+        resolved_hosts = self.resolve_hosts()
+        now = time.monotonic()
+        with self.lock:
+            while self.idle_connections:
+                connection = self.idle_connections.popleft()
+                if self.usable(connection, resolved_hosts, now):
+                    self.hits += 1
+                    return connection
+                self.retire(connection)
+            self.misses += 1
+            # Shuffle before the (stable) sort so that ties are broken randomly.
+            candidates = list(resolved_hosts)
+            random.shuffle(candidates)
+            candidates.sort(key=lambda h: self.host_connections[h])
+        for remote_host in candidates:
+            connect_start = time.monotonic()
+            try:
+                connection = self.connect(remote_host)
+            except (ConnectionError, OSError):
+                self.log.warning('Elasticsearch connection to %s:%d failed', *remote_host)
+                continue
+            with self.lock:
+                self.connect_count += 1
+                self.connect_time += time.monotonic() - connect_start
+                self.host_connections[remote_host] += 1
+            self.log.debug('Connected to Elasticsearch at %s:%d', *remote_host)
+            return connection
+        raise ConnectionError("No connection could be found")
+
+    def release(self, connection, failed=False):
+        with self.lock:
+            if failed or connection.sock is None or connection.requests >= self.max_requests or \
+                    len(self.idle_connections) >= self.pool_size:
+                self.retire(connection)
+            else:
+                self.idle_connections.append(connection)
+
+    def close(self):
+        with self.lock:
+            while self.idle_connections:
+                self.retire(self.idle_connections.popleft())
+
+    def take_connect_latency(self):
+        # Average connect time (in ms) since the previous call
+        with self.lock:
+            connect_count, connect_time = self.connect_count, self.connect_time
+            self.connect_count, self.connect_time = 0, 0
+        if not connect_count:
+            return 0
+        return round(1000 * connect_time / connect_count, 3)
+
+
+class RetriedDoc(str):
+    # A doc rejected with a retryable status, it carries the number of attempts made so far.
+    attempts = 0
 
 
-class ElasticsearchClient(module.MetricsPushProcess, module.TCPConnector):
+class ElasticsearchClient(module.MetricsPushProcess, module.HostResolver):
+    # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html#bulk-failures-ex
+    RETRYABLE_STATUSES = frozenset((429, 502, 503, 504))
+
     def __init__(self, *args):
         super().__init__(*args, default_port=9200)
 
@@ -91,17 +233,179 @@ class ElasticsearchClient(module.MetricsPushProcess, module.TCPConnector):
         self.compression = self.cfg.get('compression')
         if self.compression not in {'gzip', 'deflate'}:
             self.compression = 'identity'
+        self.compression_level = min(max(self.cfg.get('compression_level', 6), 0), 9)
         self.bucket_field_name = self.cfg.get('bucket_field_name', 'bucket')
         self.timestamp_field_name = self.cfg.get('timestamp_field_name', 'timestamp')
+        self.id_mode = self.cfg.get('id_mode', 'uuid5')
+        if self.id_mode not in {'uuid5', 'hash', 'none'}:
+            self.id_mode = 'uuid5'
+        if self.id_mode == 'uuid5':
+            self.doc_id = self.uuid5_doc_id
+        else:
+            self.doc_id = self.hash_doc_id
+        # json.dumps with non default arguments creates a new encoder on every call, so one is reused.
+        # Keys are sorted only if ids are derived from the content, which has to be consistent.
+        # It is as consistent as json serializer inner workings, i.e. serialization of floats or unicode.
+        # Should be more than enough in our case though. With id_mode 'none' nothing depends on the key
+        # order, so the sorting is skipped.
+        self.doc_encoder = json.JSONEncoder(
+            sort_keys=(self.id_mode != 'none'), indent=None, separators=(',', ':')
+        ).encode
+        self.action_templates = {}
+        # Docs are ASCII JSON (json.dumps escapes everything else), so their length is their size in bytes.
+        self.max_batch_size = max(self.cfg.get('max_batch_size', 5 * 1024 * 1024), 1024)
+        self.max_doc_size = max(self.cfg.get('max_doc_size', 1024 * 1024), 1024)
+        self.max_retries = max(self.cfg.get('max_retries', 5), 0)
+        self.retry_backoff = max(self.cfg.get('retry_backoff', 1), 0.1)
+        self.retry_limit = int(self.buffer_limit * min(max(self.cfg.get('retry_budget', 0.1), 0), 1))
+        # Heap of (not_before, sequence, doc), the sequence keeps the docs out of comparisons.
+        self.retry_queue = []
+        self.retry_sequence = itertools.count()
         self.docs_rejected = 0
+        self.docs_retried = 0
+        self.docs_dead_lettered = 0
+        self.docs_oversized = 0
+        self.batches_sent = 0
+        self.batch_bytes = 0
+        self.batch_bytes_max = 0
+        self.body_bytes = 0
+        self.body_compressed_bytes = 0
+        self.compression_time = 0
+        self.stats_lock = threading.Lock()
+        self.push_concurrency = max(self.cfg.get('push_concurrency', 1), 1)
+        self.push_executor = None
+        if self.push_concurrency > 1:
+            self.push_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.push_concurrency, thread_name_prefix='BulkUploadThread'
+            )
+        # Every in-flight bulk upload needs its own connection
+        pool_size = max(self.cfg.get('pool_size', 2), self.push_concurrency, 1)
+        self.connection_pool = ElasticsearchConnectionPool(
+            lambda: self.resolve_remote_hosts(), self.create_connection, self.log,
+            pool_size, max(self.cfg.get('connection_max_requests', 1000), 1)
+        )
+
+    def create_connection(self, remote_host):
+        connection = ElasticsearchConnection(
+            remote_host, self.compression, self.socket_timeout, self.compression_level
+        )
+        connection.connect()
+        return connection
+
+    def close_socket(self):
+        # Called on push errors, if one connection failed, the idle ones are likely stale too.
+        self.connection_pool.close()
+        super().close_socket()
+
+    def next_chunk_length(self, offset):
+        # A batch is closed at max_batch_size bytes or at chunk_size docs, whichever comes first.
+        # Docs are never split, a batch always has at least one doc.
+        end = min(offset + self.chunk_size, len(self.buffer))
+        batch_bytes = 0
+        for i in range(offset, end):
+            batch_bytes += len(self.buffer[i])
+            if batch_bytes > self.max_batch_size and i > offset:
+                return i - offset
+        return end - offset
 
     def push_chunk(self, chunk):
-        self.docs_rejected += self.elasticsearch_connection.bulk_upload(chunk)
+        batch_bytes = sum(len(doc) for doc in chunk)
+        connection = self.connection_pool.acquire()
+        try:
+            rejected_items, body_stats = connection.bulk_upload(chunk)
+        except Exception:
+            self.connection_pool.release(connection, failed=True)
+            raise
+        self.connection_pool.release(connection)
+        body_size, body_compressed_size, compression_time = body_stats
+        if rejected_items:
+            self.handle_rejected_items(chunk, rejected_items)
+        with self.stats_lock:
+            self.batches_sent += 1
+            self.batch_bytes += batch_bytes
+            self.batch_bytes_max = max(self.batch_bytes_max, batch_bytes)
+            self.body_bytes += body_size
+            self.body_compressed_bytes += body_compressed_size
+            self.compression_time += compression_time
+
+    def handle_rejected_items(self, chunk, rejected_items):
+        # The chunk as a whole succeeded, only the retryable items are queued for another attempt
+        # (with exponential backoff), as long as they have attempts left and the retry queue
+        # is within its budget. The rest is dropped, counted and logged as dead letters.
+        now = time.monotonic()
+        dead_letters, first_error = 0, None
+        with self.stats_lock:
+            self.docs_rejected += len(rejected_items)
+            for i, status, error in rejected_items:
+                if i >= len(chunk):
+                    continue
+                doc = chunk[i]
+                attempts = doc.attempts if isinstance(doc, RetriedDoc) else 0
+                if status in self.RETRYABLE_STATUSES and attempts < self.max_retries and \
+                        len(self.retry_queue) < self.retry_limit:
+                    doc = RetriedDoc(doc)
+                    doc.attempts = attempts + 1
+                    delay = self.retry_backoff * (2 ** attempts) * (0.5 + random.random() / 2)
+                    heapq.heappush(self.retry_queue, (now + delay, next(self.retry_sequence), doc))
+                    self.docs_retried += 1
+                    self.push_congested = True
+                else:
+                    dead_letters += 1
+                    if first_error is None:
+                        first_error = status, error
+            self.docs_dead_lettered += dead_letters
+        if dead_letters:
+            self.log.warning('Dropped %d rejected docs, first error: %d %s', dead_letters, *first_error)
+
+    def requeue_retries(self):
+        now = time.monotonic()
+        due_docs = []
+        with self.stats_lock:
+            while self.retry_queue and self.retry_queue[0][0] <= now:
+                due_docs.append(heapq.heappop(self.retry_queue)[2])
+        if due_docs:
+            # They are older than anything in the buffer, so they go first.
+            with self.buffer_lock:
+                self.buffer[0:0] = due_docs
 
     def flush(self, system_timestamp):
-        self.elasticsearch_connection = ElasticsearchConnection(self.open_socket, self.compression)
+        self.requeue_retries()
         return super().flush(system_timestamp)
 
+    def push_chunks(self, chunks):
+        if self.push_executor is None or len(chunks) == 1:
+            return super().push_chunks(chunks)
+        # Each chunk goes over its own pooled connection, so the concurrent uploads get spread
+        # over the resolved hosts. Chunks can finish in any order, errors are reported per chunk.
+        futures = [self.push_executor.submit(self.push_chunk, chunk) for chunk in chunks]
+        return [f.exception() for f in futures]
+
+    def uuid5_doc_id(self, doc_str):
+        return str(uuid.uuid5(uuid.NAMESPACE_DNS, doc_str))
+
+    def hash_doc_id(self, doc_str):
+        return hashlib.blake2b(doc_str.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get_action_template(self, index_name, bucket):
+        # The action line only depends on the index and type names, so it is rendered
+        # once per index, with a %s placeholder for the doc id (unless ES generates ids).
+        type_name = (self.type_name or bucket) if self.add_type else None
+        template = self.action_templates.get((index_name, type_name))
+        if template is None:
+            if len(self.action_templates) >= 1000:
+                self.action_templates.clear()
+            action = {"_index": index_name}
+            if type_name is not None:
+                action["_type"] = type_name
+            if self.id_mode == 'none':
+                template = json.dumps({"index": action}, separators=(',', ':')) + '\n'
+            else:
+                action["_id"] = '\0'
+                template = json.dumps({"index": action}, separators=(',', ':'))
+                template = template.replace('%', '%%').replace('"\\u0000"', '"%s"') + '\n'
+            self.action_templates[(index_name, type_name)] = template
+        return template
+
     def process_values(self, recv_timestamp, bucket, values, timestamp, metadata):
         self.merge_dict(metadata)
         self.merge_dict(values, metadata)
@@ -120,20 +424,40 @@ class ElasticsearchClient(module.MetricsPushProcess, module.TCPConnector):
         if self.bucket_field_name:
             values[self.bucket_field_name] = bucket
 
-        # Try to produce consistent hashing, it is as consistent as json serializer inner workings.
-        # I.e. serialization of floats or unicode. Should be more then enough in our case though.
-        doc_str = json.dumps(values, sort_keys=True, indent=None, separators=(',', ':'))
-        doc_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, doc_str))
-
-        if self.add_type:
-            req = {"index": {"_index": index_name, "_type": self.type_name or bucket, "_id": doc_id}}
+        doc_str = self.doc_encoder(values)
+        if self.id_mode == 'none':
+            req_str = self.get_action_template(index_name, bucket)
         else:
-            req = {"index": {"_index": index_name, "_id": doc_id}}
+            req_str = self.get_action_template(index_name, bucket) % (self.doc_id(doc_str),)
 
-        req_str = json.dumps(req, indent=None, separators=(',', ':'))
-        self.buffer_output(req_str + '\n' + doc_str + '\n')
+        doc = req_str + doc_str + '\n'
+        if len(doc) > self.max_doc_size:
+            self.docs_oversized += 1
+            self.log.warning('Dropped %d bytes long doc for index %s', len(doc), index_name)
+            return
+        self.buffer_output(doc)
 
     def produce_self_report(self):
         self_report = super().produce_self_report()
         self_report['docs_rejected'] = self.docs_rejected
+        self_report['docs_retried'] = self.docs_retried
+        self_report['docs_dead_lettered'] = self.docs_dead_lettered
+        self_report['docs_retry_queued'] = len(self.retry_queue)
+        self_report['docs_oversized'] = self.docs_oversized
+        with self.stats_lock:
+            self_report['batches_sent'] = self.batches_sent
+            self_report['batch_bytes_avg'] = round(self.batch_bytes / self.batches_sent) if self.batches_sent else 0
+            self_report['batch_bytes_max'] = self.batch_bytes_max
+            self_report['bytes_sent'] = self.body_compressed_bytes
+            if self.body_compressed_bytes:
+                self_report['compression_ratio'] = round(self.body_bytes / self.body_compressed_bytes, 3)
+            # Includes encoding, it is reported even without compression
+            self_report['compression_time'] = round(self.compression_time, 3)
+            # Batch sizes and compression stats are reported per self report period
+            self.batches_sent = self.batch_bytes = self.batch_bytes_max = 0
+            self.body_bytes = self.body_compressed_bytes = self.compression_time = 0
+        self_report['pool_hits'] = self.connection_pool.hits
+        self_report['pool_misses'] = self.connection_pool.misses
+        self_report['pool_retired'] = self.connection_pool.retired
+        self_report['connect_latency'] = self.connection_pool.take_connect_latency()
         return self_report
@@ -1,22 +1,44 @@
 
 
+import time
+import gzip
+import zlib
+import operator
+import http.client
+import urllib.parse
 import bucky3.module as module
 
 
-class InfluxDBClient(module.MetricsPushProcess, module.UDPConnector):
-    def __init__(self, *args):
-        super().__init__(*args, default_port=8086)
+class InfluxDBLineProtocol:
+    # Multiplier turning secs into the precision of timestamps in lines. Nanosecs by default,
+    # the lower timestamp precisions don't seem to work with UDP line protocol...
+    timestamp_multiplier = 1000000000
+    NUMERIC_TYPES = frozenset((int, float, bool))
 
-    def push_chunk(self, chunk):
-        payload = '\n'.join(chunk).encode("utf-8")
-        for ip, port in self.resolve_remote_hosts():
-            self.sock.sendto(payload, (ip, port))
+    def pack_lines(self, lines, max_size):
+        # Pack lines into payloads up to max_size bytes, lines longer than that go out on their own.
+        payload, payload_len = [], 0
+        for line in lines:
+            line = line.encode("utf-8")
+            line_len = len(line)
+            if payload and payload_len + 1 + line_len > max_size:
+                yield b'\n'.join(payload)
+                payload, payload_len = [], 0
+            if payload:
+                payload_len += 1
+            payload.append(line)
+            payload_len += line_len
+        if payload:
+            yield b'\n'.join(payload)
 
-    def flush(self, system_timestamp):
-        self.open_socket()
-        return super().flush(system_timestamp)
+    def init_line_protocol(self):
+        # Tag sets barely change from one flush to the next, so the escaped series keys
+        # (measurement and tags) are cached. The cache is simply dropped when it gets full.
+        self.series_cache_size = max(self.cfg.get('series_cache_size', 10000), 0)
+        self.series_cache = {}
+        self.fields_cache = {}
 
-    def process_values(self, recv_timestamp, bucket, values, timestamp, metadata):
+    def build_series_key(self, bucket, metadata):
         # https://docs.influxdata.com/influxdb/v2.0/reference/syntax/line-protocol/
         metadata_buf = [bucket]
         # InfluxDB docs recommend sorting tags
@@ -26,15 +48,279 @@ class InfluxDBClient(module.MetricsPushProcess, module.UDPConnector):
             if v is None or v == '':
                 continue
             metadata_buf.append(k + '=' + str(v).replace(',', '\\,').replace(' ', '\\ ').replace('=', '\\='))
+        return ','.join(metadata_buf)
+
+    def get_series_key(self, bucket, metadata):
+        if not self.series_cache_size:
+            return self.build_series_key(bucket, metadata)
+        # 1, 1.0 and True are equal (and hash the same), but their tags are not, hence the types.
+        cache_key = (bucket, tuple(metadata.items()), tuple(map(type, metadata.values())))
+        try:
+            series_key = self.series_cache.get(cache_key)
+        except TypeError:
+            # Unhashable metadata values
+            return self.build_series_key(bucket, metadata)
+        if series_key is None:
+            if len(self.series_cache) >= self.series_cache_size:
+                self.series_cache.clear()
+            series_key = self.series_cache[cache_key] = self.build_series_key(bucket, metadata)
+        return series_key
+
+    def get_fields(self, values):
+        # Few distinct sets of keys show up, so for each one a getter pulling the values out
+        # in sorted order and a format template are cached. Numeric values (the vast majority)
+        # are then formatted in one go, %r of int, float and bool matches their str()
+        fields_key = tuple(values)
+        if not fields_key:
+            return ''
+        fields = self.fields_cache.get(fields_key)
+        if fields is None:
+            if len(self.fields_cache) >= 1000:
+                self.fields_cache.clear()
+            sorted_keys = sorted(fields_key)
+            getter = operator.itemgetter(*sorted_keys) if len(sorted_keys) > 1 else lambda d: (d[sorted_keys[0]],)
+            template = ','.join(str(k).replace('%', '%%') + '=%r' for k in sorted_keys)
+            fields = self.fields_cache[fields_key] = getter, template, tuple(str(k) + '=' for k in sorted_keys)
+        getter, template, prefixes = fields
+        field_values = getter(values)
+        if self.NUMERIC_TYPES.issuperset(map(type, field_values)):
+            return template % field_values
         value_buf = []
-        for k in sorted(values.keys()):
-            v = values[k]
+        for prefix, v in zip(prefixes, field_values):
             if isinstance(v, (float, int, bool)):
-                value_buf.append(str(k) + '=' + str(v))
+                value_buf.append(prefix + str(v))
             elif isinstance(v, str):
-                value_buf.append(str(k) + '="' + v.replace('"', r'\"') + '"')
-        line = ' '.join((','.join(metadata_buf), ','.join(value_buf)))
+                value_buf.append(prefix + '"' + v.replace('"', r'\"') + '"')
+        return ','.join(value_buf)
+
+    def process_values(self, recv_timestamp, bucket, values, timestamp, metadata):
+        fields = self.get_fields(values)
+        # InfluxDB rejects lines without fields
+        if not fields:
+            return
+        line = self.get_series_key(bucket, metadata) + ' ' + fields
         if timestamp is not None:
-            # So, the lower timestamp precisions don't seem to work with line protocol...
-            line += ' ' + str(int(timestamp * 1000000000))
+            line += ' ' + str(int(timestamp * self.timestamp_multiplier))
         self.buffer_output(line)
+
+
+class InfluxDBClient(module.MetricsPushProcess, module.UDPConnector, InfluxDBLineProtocol):
+    def __init__(self, *args):
+        super().__init__(*args, default_port=8086)
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.destination_stats = {}
+        self.round_robin = 0
+
+    def init_cfg(self):
+        super().init_cfg()
+        self.max_packet_size = max(self.cfg.get('max_packet_size', 1400), 100)
+        self.init_line_protocol()
+        self.distribution = self.cfg.get('distribution', 'broadcast')
+        if self.distribution not in ('broadcast', 'round_robin', 'hash'):
+            self.distribution = 'broadcast'
+
+    def series_key(self, line):
+        # Measurement and tags, i.e. everything up to the first unescaped space
+        i = line.find(' ')
+        while i > 0 and line[i - 1] == '\\':
+            i = line.find(' ', i + 1)
+        return line[:i] if i > 0 else line
+
+    def send_payload(self, payload, remote_host):
+        self.sock.sendto(payload, remote_host)
+        payload_len = len(payload)
+        self.packets_sent += 1
+        self.bytes_sent += payload_len
+        destination_stats = self.destination_stats.get(remote_host)
+        if destination_stats is None:
+            destination_stats = self.destination_stats[remote_host] = [0, 0]
+        destination_stats[0] += 1
+        destination_stats[1] += payload_len
+
+    def push_chunk(self, chunk):
+        # There is no sendmmsg in Python, so packing as much as possible into one datagram
+        # is what keeps the number of syscalls (and packets) down.
+        # Sorted, so that hashing maps series to hosts consistently across DNS resolutions.
+        remote_hosts = sorted(self.resolve_remote_hosts())
+        if not remote_hosts:
+            return
+        if self.distribution == 'hash':
+            # Every series always goes to the same host
+            lines_by_host = [[] for _ in remote_hosts]
+            for line in chunk:
+                i = zlib.crc32(self.series_key(line).encode("utf-8")) % len(remote_hosts)
+                lines_by_host[i].append(line)
+            for remote_host, lines in zip(remote_hosts, lines_by_host):
+                for payload in self.pack_lines(lines, self.max_packet_size):
+                    self.send_payload(payload, remote_host)
+        elif self.distribution == 'round_robin':
+            for payload in self.pack_lines(chunk, self.max_packet_size):
+                self.round_robin = (self.round_robin + 1) % len(remote_hosts)
+                self.send_payload(payload, remote_hosts[self.round_robin])
+        else:
+            for payload in self.pack_lines(chunk, self.max_packet_size):
+                for remote_host in remote_hosts:
+                    self.send_payload(payload, remote_host)
+
+    def flush(self, system_timestamp):
+        self.open_socket()
+        return super().flush(system_timestamp)
+
+    def produce_self_report(self):
+        self_report = super().produce_self_report()
+        self_report['packets_sent'] = self.packets_sent
+        self_report['bytes_sent'] = self.bytes_sent
+        if self.packets_sent:
+            self_report['packet_fill'] = round(self.bytes_sent / (self.packets_sent * self.max_packet_size), 3)
+        return self_report
+
+    def produce_self_reports(self):
+        yield from super().produce_self_reports()
+        for (ip, port), (packets_sent, bytes_sent) in self.destination_stats.items():
+            yield {'packets_sent': packets_sent, 'bytes_sent': bytes_sent}, {
+                'name': self.name, 'destination': ip + ':' + str(port)
+            }
+
+
+class InfluxDBConnection(http.client.HTTPConnection):
+    def __init__(self, connect_socket):
+        super().__init__('influxdb')
+        self.connect_socket = connect_socket
+
+    def connect(self):
+        self.sock = self.connect_socket()
+        try:
+            self.host = self.sock.getpeername()[0]
+        except OSError:
+            raise ConnectionError('InfluxDB connection seems broken')
+
+    # https://docs.influxdata.com/influxdb/v1.8/tools/api/#write-http-endpoint
+    # https://docs.influxdata.com/influxdb/v2.0/api/#operation/PostWrite
+    def write(self, url, body, headers):
+        try:
+            self.request('POST', url, body=body, headers=headers)
+            resp = self.getresponse()
+            resp_body = resp.read()
+        except http.client.HTTPException as e:
+            raise ConnectionError('InfluxDB HTTP error: ' + repr(e))
+        if resp.will_close:
+            self.close()
+        return resp.status, resp.getheader('Retry-After'), resp_body
+
+
+class InfluxDBHTTPClient(module.MetricsPushProcess, module.TCPConnector, InfluxDBLineProtocol):
+    PRECISIONS = {
+        'ns': 1000000000,
+        'us': 1000000,
+        'ms': 1000,
+        's': 1,
+    }
+    # The v1 /write endpoint has its own names for the precisions
+    V1_PRECISIONS = {
+        'ns': 'n',
+        'us': 'u',
+        'ms': 'ms',
+        's': 's',
+    }
+
+    def __init__(self, *args):
+        super().__init__(*args, default_port=8086)
+        self.influxdb_connection = None
+        self.connection_timestamp = 0
+        self.retry_deadline = 0
+        self.writes_sent = 0
+        self.writes_rejected = 0
+        self.writes_throttled = 0
+        self.bytes_sent = 0
+
+    def init_cfg(self):
+        super().init_cfg()
+        self.precision = self.cfg.get('precision', 'ns')
+        if self.precision not in self.PRECISIONS:
+            self.precision = 'ns'
+        self.timestamp_multiplier = self.PRECISIONS[self.precision]
+        self.init_line_protocol()
+        self.max_batch_size = max(self.cfg.get('max_batch_size', 1024 * 1024), 1024)
+        self.compression = self.cfg.get('compression', 'gzip')
+        if self.compression != 'gzip':
+            self.compression = None
+        self.compression_level = self.cfg.get('compression_level', 6)
+        database = self.cfg['database']
+        auth_token = self.cfg.get('auth_token')
+        if self.cfg.get('api_version', 1) == 2:
+            query = {'org': self.cfg['org'], 'bucket': database, 'precision': self.precision}
+            self.write_url = '/api/v2/write?' + urllib.parse.urlencode(query)
+        else:
+            query = {'db': database, 'precision': self.V1_PRECISIONS[self.precision]}
+            if self.cfg.get('retention_policy'):
+                query['rp'] = self.cfg['retention_policy']
+            self.write_url = '/write?' + urllib.parse.urlencode(query)
+        self.write_headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.compression:
+            self.write_headers['Content-Encoding'] = self.compression
+        if auth_token:
+            self.write_headers['Authorization'] = 'Token ' + auth_token
+
+    def close_socket(self):
+        if self.influxdb_connection:
+            self.influxdb_connection.close()
+        super().close_socket()
+
+    def next_chunk_length(self, offset):
+        # A chunk goes out as a single write, closed at max_batch_size bytes or at chunk_size lines,
+        # whichever comes first. So a chunk is written all or nothing, and a failed write doesn't
+        # resend lines already accepted (those without timestamps would become duplicate points).
+        end = min(offset + self.chunk_size, len(self.buffer))
+        batch_bytes = -1
+        for i in range(offset, end):
+            batch_bytes += len(self.buffer[i].encode('utf-8')) + 1
+            if batch_bytes > self.max_batch_size and i > offset:
+                return i - offset
+        return end - offset
+
+    def push_chunk(self, chunk):
+        body = '\n'.join(chunk).encode('utf-8')
+        if self.compression:
+            body = gzip.compress(body, self.compression_level)
+        status, retry_after, resp_body = self.influxdb_connection.write(self.write_url, body, self.write_headers)
+        if status in (200, 204):
+            self.writes_sent += 1
+            self.bytes_sent += len(body)
+        elif status in (429, 503):
+            self.writes_throttled += 1
+            try:
+                retry_after = max(float(retry_after), 0)
+            except (TypeError, ValueError):
+                retry_after = self.flush_interval
+            self.retry_deadline = time.monotonic() + retry_after
+            raise ConnectionError('InfluxDB response code {}, retry in {}s'.format(status, retry_after))
+        elif status in (400, 413):
+            # Malformed or too big, resending the same lines won't help, so they are dropped.
+            self.writes_rejected += 1
+            self.log.warning('InfluxDB rejected write with code %d: %s', status, resp_body[:200])
+        else:
+            raise ConnectionError('InfluxDB response code {}'.format(status))
+
+    def flush(self, system_timestamp):
+        now = time.monotonic()
+        if now < self.retry_deadline:
+            # Not an error, InfluxDB asked us to hold off, the buffer is retained meanwhile.
+            self.log.debug('Write throttled for another %.1fs', self.retry_deadline - now)
+            return True
+        if self.influxdb_connection is None:
+            self.influxdb_connection = InfluxDBConnection(self.connect_socket)
+        # The connection is kept alive across flushes, but to provide load balancing it
+        # gets reopened at intervals (to a random host from the pool of resolved ones).
+        if now - self.connection_timestamp > 180:
+            self.influxdb_connection.close()
+            self.connection_timestamp = now
+        return super().flush(system_timestamp)
+
+    def produce_self_report(self):
+        self_report = super().produce_self_report()
+        self_report['writes_sent'] = self.writes_sent
+        self_report['writes_rejected'] = self.writes_rejected
+        self_report['writes_throttled'] = self.writes_throttled
+        self_report['bytes_sent'] = self.bytes_sent
+        return self_report
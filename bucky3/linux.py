@@ -2,6 +2,7 @@
 
 import os
 import re
+import time
 import platform
 import bucky3.module as module
 
@@ -11,17 +12,20 @@ class ProcfsReader:
                         None, None, None, None,
                         'tx_bytes', 'tx_packets', 'tx_errors', 'tx_dropped')
 
+    def parse_interfaces(self, lines):
+        for l in lines:
+            tokens = l.strip().split()
+            if not tokens or len(tokens) != 17:
+                continue
+            if not tokens[0].endswith(':'):
+                continue
+            interface_name = tokens.pop(0)[:-1]
+            interface_stats = {k: int(v) for k, v in zip(self.INTERFACE_FIELDS, tokens) if k}
+            yield interface_name, interface_stats
+
     def read_interfaces(self, path='/proc/net/dev'):
         with open(path) as f:
-            for l in f:
-                tokens = l.strip().split()
-                if not tokens or len(tokens) != 17:
-                    continue
-                if not tokens[0].endswith(':'):
-                    continue
-                interface_name = tokens.pop(0)[:-1]
-                interface_stats = {k: int(v) for k, v in zip(self.INTERFACE_FIELDS, tokens) if k}
-                yield interface_name, interface_stats
+            yield from self.parse_interfaces(f)
 
     MEMORY_FIELDS = {
         'MemTotal:': 'total_bytes',
@@ -46,6 +50,34 @@ class ProcfsReader:
                 if name in self.MEMORY_FIELDS:
                     yield self.MEMORY_FIELDS[name], int(tokens[1]) * 1024
 
+    def parse_number(self, v):
+        return float(v) if '.' in v else int(v)
+
+    # Flat keyed files, i.e. cgroup v2 cpu.stat or memory.stat, "key value" per line.
+    def parse_key_values(self, lines):
+        for l in lines:
+            tokens = l.split()
+            if len(tokens) == 2:
+                yield tokens[0], self.parse_number(tokens[1])
+
+    def read_key_values(self, path):
+        with open(path) as f:
+            yield from self.parse_key_values(f)
+
+    # Nested keyed files, i.e. cgroup v2 io.stat or PSI files, "name key=value key=value ..." per line.
+    # See Documentation/admin-guide/cgroup-v2.rst and Documentation/accounting/psi.rst
+    def parse_nested_key_values(self, lines):
+        for l in lines:
+            tokens = l.split()
+            if tokens:
+                yield tokens[0], {
+                    k: self.parse_number(v) for k, _, v in (t.partition('=') for t in tokens[1:]) if v
+                }
+
+    def read_nested_key_values(self, path):
+        with open(path) as f:
+            yield from self.parse_nested_key_values(f)
+
 
 class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
     CPU_FIELDS = ('user', 'nice', 'system', 'idle', 'wait', 'interrupt', 'softirq', 'steal')
@@ -87,6 +119,39 @@ class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
         'TcpExt:SyncookiesRecv': ('tcp', 'rx_syncookies'),
         'TcpExt:SyncookiesSent': ('tcp', 'tx_syncookies'),
     }
+    # /proc/net/snmp6 is "name value" per line, the names are looked up as they are.
+    # TCP has no IPv6 counterpart there, TCP over IPv6 is accounted in the Tcp: counters.
+    PROTOCOL6_FIELDS = {
+        'Ip6InReceives': ('ip6', 'rx_packets'),
+        'Ip6InDiscards': ('ip6', 'rx_dropped'),
+        'Ip6InOctets': ('ip6', 'rx_bytes'),
+        'Ip6OutRequests': ('ip6', 'tx_packets'),
+        'Ip6OutDiscards': ('ip6', 'tx_dropped'),
+        'Ip6OutOctets': ('ip6', 'tx_bytes'),
+        'Icmp6InMsgs': ('icmp6', 'rx_packets'),
+        'Icmp6InErrors': ('icmp6', 'rx_errors'),
+        'Icmp6OutMsgs': ('icmp6', 'tx_packets'),
+        'Icmp6OutErrors': ('icmp6', 'tx_errors'),
+        'Udp6InDatagrams': ('udp6', 'rx_packets'),
+        'Udp6InErrors': ('udp6', 'rx_errors'),
+        'Udp6OutDatagrams': ('udp6', 'tx_packets'),
+        'Udp6RcvbufErrors': ('udp6', 'rcvbuf_errors'),
+        'Udp6SndbufErrors': ('udp6', 'sndbuf_errors'),
+    }
+
+    # Buckets made of counters, with name prefixes of their fields that are gauges
+    COUNTER_BUCKETS = {
+        'system_activity': ('running', 'load'),
+        'system_cpu': (),
+        'system_disk': ('in_progress',),
+        'system_interface': (),
+        'system_protocol': ('conn_count',),
+        'system_pressure': ('some_avg', 'full_avg'),
+        'system_vmstat': ('nr_',),
+    }
+    # Unless vmstat_whitelist or vmstat_blacklist is configured
+    VMSTAT_FIELDS = ('pgfault', 'pgmajfault', 'pswpin', 'pswpout', 'oom_kill')
+    PRESSURE_RESOURCES = ('cpu', 'memory', 'io')
 
     def __init__(self, *args):
         assert platform.system() == 'Linux' and platform.release() >= '3'
@@ -94,7 +159,21 @@ class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
 
     def init_cfg(self):
         super().init_cfg()
-        for name in 'interface', 'disk', 'filesystem':
+        self.procfs_root = self.cfg.get('procfs_root', '/proc')
+        # Parse plans, built on first read
+        self.disk_plans = {}
+        self.disk_names = {}
+        self.protocol_plans = {}
+        # Gone with IPv6 disabled
+        self.snmp6_available = True
+        self.counter_mode = self.cfg.get('counter_mode', 'raw')
+        if self.counter_mode not in ('raw', 'delta', 'rate'):
+            self.log.warning('Unknown counter_mode %r, falling back to raw', self.counter_mode)
+            self.counter_mode = 'raw'
+        # Raw counters per (bucket, name) and when they were taken
+        self.previous_counters = {}
+        self.previous_time = None
+        for name in 'interface', 'disk', 'filesystem', 'pressure', 'vmstat':
             blacklist = self.cfg.get(name + '_blacklist')
             if blacklist:
                 blacklist = [re.compile(regex) for regex in blacklist]
@@ -103,6 +182,14 @@ class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
             if whitelist:
                 whitelist = [re.compile(regex) for regex in whitelist]
             setattr(self, name + '_whitelist', whitelist)
+        if not self.vmstat_whitelist and not self.vmstat_blacklist:
+            self.vmstat_whitelist = [re.compile(re.escape(name)) for name in self.VMSTAT_FIELDS]
+        # The lists are checked once per vmstat field, not on every flush
+        self.vmstat_fields = {}
+        self.pressure_resources = [
+            resource for resource in self.PRESSURE_RESOURCES
+            if self.check_lists(resource, self.pressure_blacklist, self.pressure_whitelist)
+        ]
 
     def check_lists(self, val, blacklist, whitelist):
         if whitelist:
@@ -118,7 +205,7 @@ class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
 
     def read_activity_stats(self, buffer, timestamp):
         activity_stats = {}
-        with open('/proc/stat') as f:
+        with open(self.procfs_root + '/stat') as f:
             for l in f:
                 tokens = l.strip().split(maxsplit=20)
                 if not tokens:
@@ -138,7 +225,7 @@ class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
                         continue
                     cpu_stats = {k: int(v) for k, v in zip(self.CPU_FIELDS, tokens)}
                     buffer.append(("system_cpu", cpu_stats, timestamp, {'name': name}))
-        with open('/proc/loadavg') as f:
+        with open(self.procfs_root + '/loadavg') as f:
             for l in f:
                 tokens = l.strip().split()
                 if tokens and len(tokens) == 5:
@@ -148,7 +235,7 @@ class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
             buffer.append(("system_activity", activity_stats, timestamp, None))
 
     def read_filesystem_stats(self, buffer, timestamp):
-        with open('/proc/mounts') as f:
+        with open(self.procfs_root + '/mounts') as f:
             for l in f:
                 tokens = l.strip().split()
                 if not tokens or len(tokens) != 6:
@@ -177,54 +264,181 @@ class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
                     pass
 
     def read_interface_stats(self, buffer, timestamp):
-        for interface_name, interface_stats in self.read_interfaces():
+        for interface_name, interface_stats in self.read_interfaces(self.procfs_root + '/net/dev'):
             if self.check_lists(interface_name, self.interface_blacklist, self.interface_whitelist):
                 buffer.append(("system_interface", interface_stats, timestamp, {'name': interface_name}))
 
     def read_memory_stats(self, buffer, timestamp):
-        memory_stats = dict(self.read_memory())
+        memory_stats = dict(self.read_memory(self.procfs_root + '/meminfo'))
         if memory_stats:
             buffer.append(("system_memory", memory_stats, timestamp, None))
 
+    def build_disk_plan(self, tokens_count):
+        # The number of columns depends on the kernel version, see DISK_FIELDS.
+        columns = tuple(enumerate(self.DISK_FIELDS[:max(tokens_count - 3, 0)], 3))
+        byte_fields = tuple((k[:-7] + 'bytes', k) for _, k in columns if k.endswith('_sectors'))
+        return columns, byte_fields
+
     def read_disk_stats(self, buffer, timestamp):
-        with open('/proc/diskstats') as f:
+        # The include/exclude decisions are carried over from the previous read only for the disks
+        # still listed, so short lived devices (loop, dm, nbd) don't pile up.
+        previous_names, disk_names = self.disk_names, {}
+        with open(self.procfs_root + '/diskstats') as f:
             for l in f:
-                tokens = l.strip().split()
-                if not tokens or len(tokens) < 3:
+                tokens = l.split()
+                if len(tokens) < 3:
                     continue
                 disk_name = tokens[2]
-                if not self.check_lists(disk_name, self.disk_blacklist, self.disk_whitelist):
+                included = previous_names.get(disk_name)
+                if included is None:
+                    included = self.check_lists(disk_name, self.disk_blacklist, self.disk_whitelist)
+                disk_names[disk_name] = included
+                if not included:
                     continue
-                disk_stats = {k: int(v) for k, v in zip(self.DISK_FIELDS, tokens[3:])}
-                for k in self.DISK_FIELDS:
-                    if k.endswith('_sectors') and k in disk_stats:
-                        disk_stats[k[:-7] + 'bytes'] = disk_stats[k] * 512
+                plan = self.disk_plans.get(len(tokens))
+                if plan is None:
+                    plan = self.disk_plans[len(tokens)] = self.build_disk_plan(len(tokens))
+                columns, byte_fields = plan
+                disk_stats = {k: int(tokens[i]) for i, k in columns}
+                for k, sectors_k in byte_fields:
+                    disk_stats[k] = disk_stats[sectors_k] * 512
                 buffer.append(("system_disk", disk_stats, timestamp, {'name': disk_name}))
+        self.disk_names = disk_names
+
+    # Strictly "name value" per line files, split as a whole that is way cheaper than line by line.
+    def read_name_values(self, path):
+        with open(path) as f:
+            tokens = f.read().split()
+        return zip(tokens[::2], tokens[1::2])
+
+    def read_snmp6(self, path='/proc/net/snmp6'):
+        for k, v in self.read_name_values(path):
+            if k in self.PROTOCOL6_FIELDS:
+                yield self.PROTOCOL6_FIELDS[k], int(v)
+
+    def build_protocol_plan(self, lines):
+        # In /proc/net/snmp & netstat a "Name: header header ..." line is followed by its
+        # "Name: value value ..." line. The plan is (header index, header line, value index,
+        # ((column, proto, field), ...)) for the lines with any PROTOCOL_FIELDS in them.
+        plan, headers = [], {}
+        for i, l in enumerate(lines):
+            tokens = l.split()
+            if not tokens:
+                continue
+            name = tokens[0]
+            if name not in headers:
+                headers[name] = i, tokens
+                continue
+            header_index, header_tokens = headers.pop(name)
+            columns = tuple(
+                (column,) + self.PROTOCOL_FIELDS[name + k]
+                for column, k in enumerate(header_tokens[1:], 1) if name + k in self.PROTOCOL_FIELDS
+            )
+            if columns:
+                plan.append((header_index, lines[header_index], i, columns))
+        return plan
 
     def read_protocol_stats(self, buffer, timestamp):
-        # TODO: IPv6? (/proc/net/snmp6 has a different syntax)
-        param_map, proto_stats = {}, {}
-        for p in '/proc/net/snmp', '/proc/net/netstat':
-            with open(p) as f:
-                for l in f:
-                    tokens = l.strip().split()
-                    if not tokens:
-                        continue
-                    name = tokens.pop(0)
-                    if name in param_map:
-                        for k, v in zip(param_map[name], tokens):
-                            k = name + k
-                            if k in self.PROTOCOL_FIELDS:
-                                proto, value = self.PROTOCOL_FIELDS[k]
-                                bucket = proto_stats.get(proto)
-                                if not bucket:
-                                    bucket = proto_stats[proto] = {}
-                                bucket[value] = int(v)
-                    else:
-                        param_map[name] = tokens
+        proto_stats = {}
+        for path in self.procfs_root + '/net/snmp', self.procfs_root + '/net/netstat':
+            with open(path) as f:
+                lines = f.read().splitlines()
+            plan = self.protocol_plans.get(path)
+            # Only the header lines are compared, the kernel doesn't change them at runtime anyway.
+            if plan is None or not all(h < len(lines) and lines[h] == header for h, header, _, _ in plan):
+                plan = self.protocol_plans[path] = self.build_protocol_plan(lines)
+            for _, _, i, columns in plan:
+                tokens = lines[i].split()
+                for column, proto, value in columns:
+                    bucket = proto_stats.get(proto)
+                    if not bucket:
+                        bucket = proto_stats[proto] = {}
+                    bucket[value] = int(tokens[column])
+        if self.snmp6_available:
+            try:
+                for (proto, value), v in self.read_snmp6(self.procfs_root + '/net/snmp6'):
+                    bucket = proto_stats.get(proto)
+                    if not bucket:
+                        bucket = proto_stats[proto] = {}
+                    bucket[value] = v
+            except FileNotFoundError:
+                self.log.info('No IPv6 protocol stats')
+                self.snmp6_available = False
         for k, v in proto_stats.items():
             buffer.append(("system_protocol", v, timestamp, {'name': k}))
 
+    # See Documentation/accounting/psi.rst, the averages are in % and the totals in microsecs.
+    def read_pressure_stats(self, buffer, timestamp):
+        for resource in self.pressure_resources:
+            pressure_stats = {}
+            try:
+                for kind, kind_stats in self.read_nested_key_values(self.procfs_root + '/pressure/' + resource):
+                    for k, v in kind_stats.items():
+                        pressure_stats[kind + '_' + k] = v
+            except OSError:
+                # No CONFIG_PSI, or disabled with psi=0 (EOPNOTSUPP)
+                self.log.info('No pressure stall information for %s', resource)
+                self.pressure_resources = [r for r in self.pressure_resources if r != resource]
+                continue
+            if pressure_stats:
+                buffer.append(("system_pressure", pressure_stats, timestamp, {'name': resource}))
+
+    def read_vmstat_stats(self, buffer, timestamp):
+        vmstat_stats = {}
+        for k, v in self.read_name_values(self.procfs_root + '/vmstat'):
+            included = self.vmstat_fields.get(k)
+            if included is None:
+                included = self.check_lists(k, self.vmstat_blacklist, self.vmstat_whitelist)
+                self.vmstat_fields[k] = included
+            if included:
+                vmstat_stats[k] = int(v)
+        if vmstat_stats:
+            buffer.append(("system_vmstat", vmstat_stats, timestamp, None))
+
+    def counter_delta(self, old_value, new_value):
+        if new_value >= old_value:
+            return new_value - old_value
+        # A 32 bit counter wrapped around, otherwise it was reset (i.e. a driver reload).
+        if 2 ** 31 <= old_value < 2 ** 32:
+            return new_value + 2 ** 32 - old_value
+        return new_value
+
+    def derive_counters(self, buffer, now):
+        # Turns the counters into deltas or per second rates against the previous flush. A series
+        # shows up with its gauges only in the first flush, so that deltas can be computed later on.
+        # In both modes, system_cpu is turned into percentages.
+        elapsed = now - self.previous_time if self.previous_time else None
+        derived_buffer, previous_counters = [], {}
+        for bucket, stats, timestamp, metadata in buffer:
+            gauges = self.COUNTER_BUCKETS.get(bucket)
+            if gauges is None:
+                derived_buffer.append((bucket, stats, timestamp, metadata))
+                continue
+            key = bucket, metadata['name'] if metadata else None
+            previous_stats = self.previous_counters.get(key) if elapsed else None
+            previous_counters[key] = stats
+            derived_stats = {}
+            for k, v in stats.items():
+                if k.startswith(gauges):
+                    derived_stats[k] = v
+                elif previous_stats and k in previous_stats:
+                    derived_stats[k] = self.counter_delta(previous_stats[k], v)
+            if bucket == 'system_cpu':
+                total = sum(derived_stats.values())
+                if total:
+                    derived_stats = {k: round(100 * v / total, 2) for k, v in derived_stats.items()}
+                else:
+                    derived_stats = {}
+            elif self.counter_mode == 'rate':
+                for k, v in derived_stats.items():
+                    if not k.startswith(gauges):
+                        derived_stats[k] = v / elapsed
+            if derived_stats:
+                derived_buffer.append((bucket, derived_stats, timestamp, metadata))
+        self.previous_counters = previous_counters
+        self.previous_time = now
+        return derived_buffer
+
     def flush(self, system_timestamp):
         timestamp = system_timestamp if self.add_timestamps else None
         buffer = []
@@ -234,6 +448,10 @@ class LinuxStatsCollector(module.MetricsSrcProcess, ProcfsReader):
         self.read_filesystem_stats(buffer, timestamp)
         self.read_disk_stats(buffer, timestamp)
         self.read_protocol_stats(buffer, timestamp)
+        self.read_pressure_stats(buffer, timestamp)
+        self.read_vmstat_stats(buffer, timestamp)
+        if self.counter_mode != 'raw':
+            buffer = self.derive_counters(buffer, time.monotonic())
         for metric in buffer:
             self.buffer_metric(*metric)
         return super().flush(system_timestamp)
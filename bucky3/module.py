@@ -119,7 +119,10 @@ class TCPConnector(Connector, HostResolver):
     @cached_with_timeout(timeout=180)
     def open_socket(self):
         self.close_socket()
+        self.sock = self.connect_socket()
+        return self.sock
 
+    def connect_socket(self):
         # TODO use socket.create_connection instead?
         resolved_hosts = list(self.resolve_remote_hosts())
         if resolved_hosts:
@@ -129,22 +132,20 @@ class TCPConnector(Connector, HostResolver):
             random.shuffle(resolved_hosts)
 
             for remote_ip, remote_port in resolved_hosts:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 if self.socket_timeout is not None:
-                    self.sock.settimeout(self.socket_timeout)
+                    sock.settimeout(self.socket_timeout)
                 self.log.debug('Created TCP socket')
                 try:
                     # Connect failure is not fatal.
-                    self.sock.connect((remote_ip, remote_port))
+                    sock.connect((remote_ip, remote_port))
                     self.log.info('Connected TCP socket to %s:%d', remote_ip, remote_port)
                 except (ConnectionError, socket.timeout):
                     self.log.warning('TCP connection to %s:%d failed', remote_ip, remote_port)
-                    self.close_socket()
+                    sock.close()
                     continue
-                break
-        if self.sock is None:
-            raise ConnectionError("No connection could be found")
-        return self.sock
+                return sock
+        raise ConnectionError("No connection could be found")
 
 
 class MetricsProcess(multiprocessing.Process, Logger):
@@ -247,16 +248,16 @@ class MetricsProcess(multiprocessing.Process, Logger):
             'flush_errors': self.flush_errors,
         }
 
+    def produce_self_reports(self):
+        # Modules can extend it to report extra metrics, i.e. per destination host.
+        yield self.produce_self_report(), {'name': self.name}
+
     @cached_with_timeout(timeout=60, allow_none=True)
     def take_self_report(self):
         # Source modules will push their self reported metrics to their respective destination modules.
         # But destination modules only expose their metrics to what consumes their output.
-        self.process_self_report(
-            "bucky3",
-            self.produce_self_report(),
-            None,
-            {'name': self.name},
-        )
+        for stats, metadata in self.produce_self_reports():
+            self.process_self_report("bucky3", stats, None, metadata)
 
     def merge_dict(self, dst, src=None):
         if src is None:
@@ -282,6 +283,15 @@ class MetricsSrcProcess(MetricsProcess):
         super().init_cfg()
         self.log.info('Destination modules: ' + ', '.join(m[0] for m in self.cfg['destination_modules']))
 
+    def get_max_cached_handles(self, default):
+        # Modules keeping files open across flushes leave at least half of the descriptors
+        # to sockets, pipes and the files opened on the fly.
+        max_cached_handles = max(self.cfg.get('max_cached_handles', default), 0)
+        soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft_limit != resource.RLIM_INFINITY:
+            max_cached_handles = min(max_cached_handles, soft_limit // 2)
+        return max_cached_handles
+
     def buffer_metric(self, bucket, stats, timestamp, metadata):
         if metadata:
             metadata = self.merge_dict(metadata)
@@ -386,6 +396,15 @@ class MetricsPushProcess(MetricsDstProcess, Connector):
         super().init_cfg()
         self.push_count_limit = self.cfg.get('push_count_limit', self.buffer_limit)
         self.push_time_limit = self.cfg.get('push_time_limit', max(self.tick_interval / 2, 0.1))
+        # Number of chunks pushed at once, only modules with thread safe push_chunk can go above 1.
+        self.push_concurrency = 1
+        self.adaptive_push = self.cfg.get('adaptive_push', False)
+        self.target_push_latency = max(self.cfg.get('target_push_latency', self.push_time_limit / 4), 0.001)
+        self.max_chunk_size = max(self.cfg.get('max_chunk_size', 10 * self.chunk_size), self.chunk_size)
+        self.max_push_count_limit = self.push_count_limit
+        self.chunk_size_step = max(self.chunk_size // 10, 1)
+        # Subclasses set it when the destination pushes back without failing the push, i.e. throttles.
+        self.push_congested = False
 
     def tick(self):
         super().tick()
@@ -417,8 +436,34 @@ class MetricsPushProcess(MetricsDstProcess, Connector):
         self_report['metrics_dropped'] = self.metrics_dropped
         self_report['connection_errors'] = self.connection_errors
         self_report['metrics_buffered'] = len(self.buffer)
+        if self.adaptive_push:
+            self_report['chunk_size'] = self.chunk_size
+            self_report['push_count_limit'] = self.push_count_limit
         return self_report
 
+    def adapt_push(self, push_latency):
+        # AIMD, the chunk size grows additively while pushes are fast and clean. Both the chunk size
+        # and the per flush push limit are halved as soon as the destination pushes back, that is
+        # on errors (push_latency is None), on throttling or with latency above the target.
+        congested = push_latency is None or push_latency > self.target_push_latency or self.push_congested
+        self.push_congested = False
+        if congested:
+            self.chunk_size = max(self.chunk_size // 2, 1)
+            self.push_count_limit = max(self.push_count_limit // 2, self.chunk_size)
+        else:
+            self.chunk_size = min(self.chunk_size + self.chunk_size_step, self.max_chunk_size)
+            self.push_count_limit = min(self.push_count_limit + self.chunk_size, self.max_push_count_limit)
+
+    def next_chunk_length(self, offset):
+        return min(self.chunk_size, len(self.buffer) - offset)
+
+    def push_chunks(self, chunks):
+        # Returns the exceptions (None on success) per chunk, subclasses can push the chunks
+        # concurrently, see push_concurrency. Sequentially, the first exception is just raised.
+        for chunk in chunks:
+            self.push_chunk(chunk)
+        return [None] * len(chunks)
+
     def flush(self, system_timestamp):
         self.log.debug('%d entries in buffer to be pushed', len(self.buffer))
         if not self.buffer:
@@ -430,20 +475,39 @@ class MetricsPushProcess(MetricsDstProcess, Connector):
                     break
                 if time.monotonic() - push_start >= self.push_time_limit:
                     break
-                chunk = self.buffer[:self.chunk_size]
-                chunk_len = len(chunk)
+                chunks, offset = [], 0
+                while len(chunks) < self.push_concurrency and offset < len(self.buffer):
+                    if push_counter + offset >= self.push_count_limit:
+                        break
+                    chunk_len = self.next_chunk_length(offset)
+                    chunks.append((offset, chunk_len))
+                    offset += chunk_len
                 # Subclass must raise an exception to signal an issue.
-                self.push_chunk(chunk)
-                self.metrics_sent += chunk_len
+                round_start = time.monotonic()
+                errors = self.push_chunks([self.buffer[i:i + chunk_len] for i, chunk_len in chunks])
+                pushed = 0
                 with self.buffer_lock:
-                    del self.buffer[:chunk_len]
-                push_counter += chunk_len
+                    # Chunks can fail independently, the successful ones are deleted from the end
+                    # of the buffer backwards, so that the offsets of the preceding ones stay valid.
+                    for (i, chunk_len), e in reversed(tuple(zip(chunks, errors))):
+                        if e is None:
+                            del self.buffer[i:i + chunk_len]
+                            pushed += chunk_len
+                self.metrics_sent += pushed
+                push_counter += pushed
+                for e in errors:
+                    if e is not None:
+                        raise e
+                if self.adaptive_push:
+                    self.adapt_push(time.monotonic() - round_start)
             # Report success if we managed to push something.
             return push_counter > 0
         except (ConnectionError, socket.timeout) as e:
             self.log.exception(e)
             self.close_socket()
             self.connection_errors += 1
+            if self.adaptive_push:
+                self.adapt_push(None)
             return False
         finally:
             if self.buffer:
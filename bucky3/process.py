@@ -0,0 +1,211 @@
+
+
+"""
+Per process stats. On a busy host there are thousands of processes, but only a handful
+of them is of interest, so:
+- only /proc/<pid>/stat is read for all processes, it has the CPU and RSS needed for ranking
+- status, io and fd are only read for the processes emitted, the top consumers of CPU & RSS
+  and those whitelisted by name
+- handles are kept open across scans (up to max_cached_handles) and re-read with pread
+Note, io and fd are only readable for processes of the same user (or with CAP_SYS_PTRACE),
+for others they are silently skipped.
+"""
+
+import os
+import re
+import heapq
+import platform
+import bucky3.module as module
+
+
+class ProcessState:
+    def __init__(self, procfs_root, pid):
+        self.pid = pid
+        self.path = procfs_root + '/' + pid + '/'
+        # Cached file descriptors, by file name. None for files we have no access to.
+        self.handles = {}
+        self.raw_name = None
+        self.name = None
+        self.whitelisted = False
+        self.cpu_ticks = 0
+        self.cpu_delta = 0
+        self.rss_pages = 0
+        self.stat_fields = None
+
+
+class ProcessStatsCollector(module.MetricsSrcProcess):
+    # See proc(5), the fields after "(comm) ", so starting from "state"
+    STAT_UTIME = 11
+    STAT_STIME = 12
+    STAT_THREADS = 17
+    STAT_RSS = 21
+    STATUS_FIELDS = {
+        b'VmSwap:': ('swap_bytes', 1024),
+        b'voluntary_ctxt_switches:': ('voluntary_switches', 1),
+        b'nonvoluntary_ctxt_switches:': ('involuntary_switches', 1),
+    }
+    IO_FIELDS = {
+        b'rchar:': 'read_chars',
+        b'wchar:': 'write_chars',
+        b'read_bytes:': 'read_bytes',
+        b'write_bytes:': 'write_bytes',
+    }
+    READ_SIZE = 4096
+
+    def __init__(self, *args):
+        assert platform.system() == 'Linux' and platform.release() >= '3'
+        super().__init__(*args)
+
+    def init_cfg(self):
+        super().init_cfg()
+        self.procfs_root = self.cfg.get('procfs_root', '/proc')
+        self.top_processes = max(self.cfg.get('top_processes', 10), 0)
+        whitelist = self.cfg.get('process_whitelist')
+        self.process_whitelist = [re.compile(regex) for regex in whitelist] if whitelist else None
+        self.max_cached_handles = self.get_max_cached_handles(256)
+        self.cached_handles = 0
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        # ProcessState by PID (str)
+        self.processes = {}
+
+    def read_process_file(self, process, name):
+        fd = process.handles.get(name, -1)
+        if fd is None:
+            raise PermissionError('No access to ' + process.path + name)
+        if fd < 0:
+            try:
+                fd = os.open(process.path + name, os.O_RDONLY)
+            except PermissionError:
+                process.handles[name] = None
+                raise
+            if self.cached_handles >= self.max_cached_handles:
+                try:
+                    return os.pread(fd, self.READ_SIZE, 0)
+                finally:
+                    os.close(fd)
+            process.handles[name] = fd
+            self.cached_handles += 1
+        return os.pread(fd, self.READ_SIZE, 0)
+
+    def close_process(self, process):
+        for fd in process.handles.values():
+            if fd is not None:
+                os.close(fd)
+                self.cached_handles -= 1
+        process.handles.clear()
+
+    def read_process_stat(self, process):
+        data = self.read_process_file(process, 'stat')
+        # The name can have spaces and parentheses in it, hence the rpartition.
+        head, _, tail = data.rpartition(b') ')
+        if not tail:
+            # A cached handle of a gone process, its PID could have been reused already.
+            raise ProcessLookupError('No process ' + process.pid)
+        raw_name = head[head.find(b'(') + 1:]
+        if raw_name != process.raw_name:
+            process.raw_name = raw_name
+            process.name = raw_name.decode('utf-8', 'replace')
+            process.whitelisted = self.check_whitelist(process.name)
+        fields = tail.split()
+        cpu_ticks = int(fields[self.STAT_UTIME]) + int(fields[self.STAT_STIME])
+        process.cpu_delta = cpu_ticks - process.cpu_ticks
+        process.cpu_ticks = cpu_ticks
+        process.rss_pages = int(fields[self.STAT_RSS])
+        process.stat_fields = fields
+
+    def check_whitelist(self, name):
+        if self.process_whitelist:
+            for regex in self.process_whitelist:
+                if regex.fullmatch(name):
+                    return True
+        return False
+
+    def scan_processes(self):
+        processes = {}
+        for pid in os.listdir(self.procfs_root):
+            if not pid.isdigit():
+                continue
+            process = self.processes.pop(pid, None) or ProcessState(self.procfs_root, pid)
+            try:
+                self.read_process_stat(process)
+            except OSError:
+                self.close_process(process)
+                if not process.raw_name:
+                    continue
+                # Reused PID?
+                process = ProcessState(self.procfs_root, pid)
+                try:
+                    self.read_process_stat(process)
+                except OSError:
+                    self.close_process(process)
+                    continue
+            processes[pid] = process
+        for process in self.processes.values():
+            self.close_process(process)
+        self.processes = processes
+
+    def select_processes(self):
+        selected = {}
+        if self.top_processes:
+            for key in (lambda p: p.cpu_delta), (lambda p: p.rss_pages):
+                for process in heapq.nlargest(self.top_processes, self.processes.values(), key=key):
+                    selected[process.pid] = process
+        if self.process_whitelist:
+            for process in self.processes.values():
+                if process.whitelisted:
+                    selected[process.pid] = process
+        return selected.values()
+
+    def read_process_stats(self, buffer, process, timestamp):
+        metadata = {'name': process.name, 'pid': process.pid}
+        fields = process.stat_fields
+        cpu_stats = {
+            'user': int(fields[self.STAT_UTIME]),
+            'system': int(fields[self.STAT_STIME]),
+            'threads': int(fields[self.STAT_THREADS]),
+        }
+        memory_stats = {'rss_bytes': process.rss_pages * self.page_size}
+        io_stats = {}
+        try:
+            for l in self.read_process_file(process, 'status').splitlines():
+                tokens = l.split()
+                if tokens and tokens[0] in self.STATUS_FIELDS:
+                    name, multiplier = self.STATUS_FIELDS[tokens[0]]
+                    (memory_stats if name == 'swap_bytes' else cpu_stats)[name] = int(tokens[1]) * multiplier
+        except PermissionError:
+            pass
+        try:
+            for l in self.read_process_file(process, 'io').splitlines():
+                tokens = l.split()
+                if len(tokens) == 2 and tokens[0] in self.IO_FIELDS:
+                    io_stats[self.IO_FIELDS[tokens[0]]] = int(tokens[1])
+        except PermissionError:
+            pass
+        try:
+            io_stats['open_files'] = len(os.listdir(process.path + 'fd'))
+        except PermissionError:
+            pass
+        buffer.append(("process_cpu", cpu_stats, timestamp, metadata))
+        buffer.append(("process_memory", memory_stats, timestamp, metadata.copy()))
+        if io_stats:
+            buffer.append(("process_io", io_stats, timestamp, metadata.copy()))
+
+    def flush(self, system_timestamp):
+        timestamp = system_timestamp if self.add_timestamps else None
+        self.scan_processes()
+        buffer = []
+        for process in self.select_processes():
+            try:
+                self.read_process_stats(buffer, process, timestamp)
+            except OSError:
+                # Gone in the meantime
+                pass
+        for metric in buffer:
+            self.buffer_metric(*metric)
+        return super().flush(system_timestamp)
+
+    def produce_self_report(self):
+        self_report = super().produce_self_report()
+        self_report['processes'] = len(self.processes)
+        self_report['cached_handles'] = self.cached_handles
+        return self_report
@@ -1,21 +1,300 @@
 
 
+import sys
 import gzip
+import array
+import random
+import struct
 import http.server
 import bucky3.module as module
 
 
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+# https://github.com/OpenObservability/OpenMetrics/blob/main/specification/OpenMetrics.md
+CONTENT_TYPES = {
+    'text': 'text/plain; version=0.0.4; charset=utf-8',
+    'openmetrics': 'application/openmetrics-text; version=1.0.0; charset=utf-8',
+    'protobuf': 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited',
+}
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# A minimal encoder for metrics.proto from https://github.com/prometheus/client_model
+# We only ever produce untyped families, so there is no need for a protobuf dependency.
+def encode_varint(value):
+    value &= 0xFFFFFFFFFFFFFFFF
+    buf = bytearray()
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+    return bytes(buf)
+
+
+def encode_bytes(field_key, value):
+    return field_key + encode_varint(len(value)) + value
+
+
+def encode_label(k, v):
+    # LabelPair: name = 1, value = 2
+    return encode_bytes(b'\x0a', encode_bytes(b'\x0a', k.encode('utf-8')) + encode_bytes(b'\x12', v.encode('utf-8')))
+
+
+def encode_family(bucket, series):
+    # MetricFamily: name = 1, type = 3 (UNTYPED = 3), metric = 4
+    buf = [encode_bytes(b'\x0a', bucket.encode('utf-8')), b'\x18\x03']
+    label_cache = {}
+    for label_set, label_str, value_name, value, timestamp in series:
+        # Metric: label = 1, untyped = 5 (Untyped: value = 1), timestamp_ms = 6
+        labels_buf = label_cache.get(label_set)
+        if labels_buf is None:
+            labels_buf = label_cache[label_set] = b''.join(
+                encode_label(k, v) for k, v in zip(label_set[::2], label_set[1::2])
+            )
+        metric_buf = [labels_buf, encode_label('value', value_name)]
+        metric_buf.append(b'\x2a\x09\x09' + struct.pack('<d', value))
+        if timestamp is not None:
+            metric_buf.append(b'\x30' + encode_varint(int(timestamp * 1000)))
+        buf.append(encode_bytes(b'\x22', b''.join(metric_buf)))
+    family = b''.join(buf)
+    # Delimited encoding, every message is prefixed with its length.
+    return encode_varint(len(family)) + family
+
+
+def format_number(value):
+    # Integral values are stored as floats, render them without the trailing ".0"
+    if value.is_integer() and -9007199254740992 <= value <= 9007199254740992:
+        return str(int(value))
+    return repr(value)
+
+
+class SeriesStore:
+    # Compact storage of series. The label set (metadata without the "value" label) is interned
+    # together with its pre-escaped text rendering. All values of a metric, i.e. all series of
+    # a (bucket, label set) pair, share one row. A row holds the tuple of value names (interned
+    # as well, typically shared by all rows of a bucket) and an array of slots. Numbers live
+    # in typed arrays indexed by slot. Lines are only rendered when scraped.
+    # A row with an empty slots array, the slots add SLOT_SIZE each
+    ROW_SIZE = sys.getsizeof([(), None, None, None]) + sys.getsizeof(array.array('l'))
+    SLOT_SIZE = array.array('l').itemsize
+
+    def __init__(self):
+        # {bucket: {label_set: row}}, the dicts are the hash index of series identities
+        self.families = {}
+        # Kept up to date for memory_usage, which can't afford to walk all the rows
+        self.rows_count = 0
+        # {label_set: [label_set, label_str, refcount]}
+        self.label_sets = {}
+        self.label_sets_bytes = 0
+        self.value_names = {}
+        # slot -> row, row = [value_names, slots, bucket, label_set]
+        self.slot_rows = []
+        self.free_slots = array.array('l')
+        self.values = array.array('d')
+        # Free slots have recv_timestamp = inf, so that they are never evicted
+        self.recv_timestamps = array.array('d')
+        # NaN stands for "no timestamp"
+        self.timestamps = array.array('d')
+
+    def __len__(self):
+        return len(self.slot_rows) - len(self.free_slots)
+
+    def intern_label_set(self, metadata):
+        # Flat (name1, value1, name2, value2, ...) tuple, saves a tuple per label
+        label_set = []
+        for k in sorted(metadata):
+            if k != 'value':
+                label_set.append(sys.intern(k))
+                label_set.append(sys.intern(metadata[k]))
+        label_set = tuple(label_set)
+        label_entry = self.label_sets.get(label_set)
+        if label_entry is None:
+            label_str = ''.join(
+                k + '="' + escape_label_value(v) + '",' for k, v in zip(label_set[::2], label_set[1::2])
+            )
+            label_entry = self.label_sets[label_set] = [label_set, label_str, 0]
+            self.label_sets_bytes += self.label_set_size(label_entry)
+        return label_entry
+
+    def label_set_size(self, label_entry):
+        label_set, label_str, refcount = label_entry
+        return sys.getsizeof(label_entry) + sys.getsizeof(label_set) + sys.getsizeof(label_str)
+
+    def release_label_set(self, label_entry):
+        if not label_entry[2]:
+            self.label_sets_bytes -= self.label_set_size(label_entry)
+            del self.label_sets[label_entry[0]]
+
+    def intern_value_names(self, value_names):
+        return self.value_names.setdefault(value_names, value_names)
+
+    def allocate_slot(self, row):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.slot_rows[slot] = row
+        else:
+            slot = len(self.slot_rows)
+            self.slot_rows.append(row)
+            self.values.append(0)
+            self.recv_timestamps.append(0)
+            self.timestamps.append(0)
+        return slot
+
+    def free_slot(self, slot):
+        self.slot_rows[slot] = None
+        self.recv_timestamps[slot] = float('inf')
+        self.free_slots.append(slot)
+
+    def update(self, bucket, label_entry, value_name, value, recv_timestamp, timestamp):
+        bucket = sys.intern(bucket)
+        family = self.families.get(bucket)
+        if family is None:
+            family = self.families[bucket] = {}
+        label_set = label_entry[0]
+        row = family.get(label_set)
+        if row is None:
+            row = family[label_set] = [(), array.array('l'), bucket, label_set]
+            self.rows_count += 1
+            label_entry[2] += 1
+        try:
+            slot = row[1][row[0].index(value_name)]
+        except ValueError:
+            slot = self.allocate_slot(row)
+            row[0] = self.intern_value_names(row[0] + (sys.intern(value_name),))
+            row[1].append(slot)
+        self.values[slot] = value
+        self.recv_timestamps[slot] = recv_timestamp
+        self.timestamps[slot] = float('nan') if timestamp is None else timestamp
+
+    def evict(self, threshold):
+        # Drop series received before the threshold, returns the number of evicted series
+        evicted = 0
+        for slot, recv_timestamp in enumerate(self.recv_timestamps):
+            if recv_timestamp >= threshold:
+                continue
+            row = self.slot_rows[slot]
+            value_names, slots, bucket, label_set = row
+            i = slots.index(slot)
+            del slots[i]
+            row[0] = self.intern_value_names(value_names[:i] + value_names[i + 1:])
+            if not slots:
+                family = self.families[bucket]
+                del family[label_set]
+                self.rows_count -= 1
+                if not family:
+                    del self.families[bucket]
+                label_entry = self.label_sets[label_set]
+                label_entry[2] -= 1
+                self.release_label_set(label_entry)
+            self.free_slot(slot)
+            evicted += 1
+        if evicted:
+            # Forget value names tuples no longer in use
+            self.value_names = {}
+            for family in self.families.values():
+                for row in family.values():
+                    row[0] = self.intern_value_names(row[0])
+        return evicted
+
+    def snapshot(self):
+        values, timestamps, label_sets = self.values, self.timestamps, self.label_sets
+        families = []
+        for bucket, family in self.families.items():
+            series = []
+            for label_set, (value_names, slots, _, _) in family.items():
+                label_str = label_sets[label_set][1]
+                for value_name, slot in zip(value_names, slots):
+                    timestamp = timestamps[slot]
+                    series.append((
+                        label_set, label_str, value_name, values[slot],
+                        None if timestamp != timestamp else timestamp
+                    ))
+            families.append((bucket, series))
+        return families
+
+    def memory_usage(self):
+        # Approximate, bucket and value names are not included (they are shared by many series),
+        # rows are estimated from their count. Only the families are walked, there are few of them.
+        usage = self.label_sets_bytes + sys.getsizeof(self.label_sets) + sys.getsizeof(self.families)
+        usage += self.rows_count * self.ROW_SIZE + len(self) * self.SLOT_SIZE
+        for family in self.families.values():
+            usage += sys.getsizeof(family)
+        for a in self.slot_rows, self.free_slots, self.values, self.recv_timestamps, self.timestamps:
+            usage += sys.getsizeof(a)
+        return usage
+
+
 class PrometheusExporter(module.MetricsDstProcess, module.HostResolver):
     def __init__(self, *args):
         super().__init__(*args)
         self.http_requests = 0
+        self.http_not_modified = 0
 
     def init_cfg(self):
         super().init_cfg()
-        self.buffer = {}
+        # Series are grouped into families by bucket
+        self.buffer = SeriesStore()
+        # Bumped on every change to the buffer, ETags are derived from it. The random part
+        # makes sure ETags handed out before a restart don't match the fresh buffer.
+        self.buffer_version = 0
+        self.etag_prefix = '%08x' % random.getrandbits(32)
         self.compression = self.cfg.get('compression')
         if self.compression != 'gzip':
             self.compression = None
+        self.exposition_formats = tuple(
+            f for f in self.cfg.get('exposition_formats', ('text', 'openmetrics', 'protobuf')) if f in CONTENT_TYPES
+        ) or ('text',)
+
+    def negotiate_format(self, accept):
+        # Pick the supported media type with the highest q value, the text format is the fallback.
+        best_format, best_q = 'text', 0
+        for media_range in accept.split(','):
+            params = [p.strip() for p in media_range.split(';')]
+            media_type, media_params, q = params[0].lower(), {}, 1.0
+            for p in params[1:]:
+                k, _, v = p.partition('=')
+                media_params[k.strip().lower()] = v.strip().strip('"')
+            try:
+                q = float(media_params.get('q', 1))
+            except ValueError:
+                continue
+            if media_type == 'application/vnd.google.protobuf':
+                if media_params.get('proto') != 'io.prometheus.client.MetricFamily':
+                    continue
+                if media_params.get('encoding') != 'delimited':
+                    continue
+                fmt = 'protobuf'
+            elif media_type == 'application/openmetrics-text':
+                fmt = 'openmetrics'
+            elif media_type in ('text/plain', 'text/*', '*/*'):
+                fmt = 'text'
+            else:
+                continue
+            if fmt in self.exposition_formats and q > best_q:
+                best_format, best_q = fmt, q
+        return best_format
+
+    def get_etag(self, fmt, encoding):
+        # The version is read before the page gets rendered, so the page can be newer than its ETag.
+        # That is harmless, at worst the next scrape gets a full response rather than 304.
+        with self.buffer_lock:
+            buffer_version = self.buffer_version
+        return '"' + '-'.join((self.etag_prefix, str(buffer_version), fmt, encoding)) + '"'
+
+    def check_etag(self, etag, if_none_match):
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            # If-None-Match uses the weak comparison
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag or tag == '*':
+                return True
+        return False
 
     def start_http_server(self, ip, port, path):
         def do_GET(req):
@@ -24,18 +303,31 @@ class PrometheusExporter(module.MetricsDstProcess, module.HostResolver):
                 req.send_header("Content-type", "text/plain")
                 req.end_headers()
             else:
+                fmt = self.negotiate_format(req.headers.get('Accept', ''))
+                encoding = 'identity'
+                if self.compression == 'gzip' and 'gzip' in req.headers.get('Accept-Encoding', ''):
+                    encoding = self.compression
+                etag = self.get_etag(fmt, encoding)
+                if self.check_etag(etag, req.headers.get('If-None-Match')):
+                    req.send_response(304)
+                    req.send_header('ETag', etag)
+                    req.end_headers()
+                    self.http_not_modified += 1
+                    self.http_requests += 1
+                    return
                 req.send_response(200)
-                req.send_header("Content-Type", "text/plain; version=0.0.4")
+                req.send_header("Content-Type", CONTENT_TYPES[fmt])
+                req.send_header('ETag', etag)
                 write, flush, close = req.wfile.write, req.wfile.flush, None
-                if self.compression == 'gzip' and 'gzip' in req.headers.get('Accept-Encoding', ''):
-                    req.send_header('Content-Encoding', self.compression)
+                if encoding == 'gzip':
+                    req.send_header('Content-Encoding', encoding)
                     req.end_headers()
                     gzip_stream = gzip.GzipFile(filename='', mode='wb', fileobj=req.wfile)
                     write, flush, close = gzip_stream.write, gzip_stream.flush, gzip_stream.close
                 else:
                     req.end_headers()
-                for chunk in self.get_chunks():
-                    write(chunk.encode("utf-8"))
+                for chunk in self.get_chunks(fmt):
+                    write(chunk)
                     flush()
                 if close:
                     close()
@@ -69,32 +361,60 @@ class PrometheusExporter(module.MetricsDstProcess, module.HostResolver):
         self.start_thread('HttpServerThread', http_server.serve_forever)
         self.log.info("Started server at http://%s:%d/%s", ip, port, path)
 
-    def get_line(self, bucket, value, metadata, timestamp):
-        # https://prometheus.io/docs/instrumenting/exposition_formats/
-        metadata_str = ','.join(
-            k + '="' + metadata[k].replace('\\', '\\\\').replace('"', '\\"') + '"' for k in sorted(metadata)
-        )
-        # metric_str is a canonical part of the metric, used as a key, too
-        metric_str = bucket
-        if metadata_str:
-            metric_str += '{' + metadata_str + '}'
-        line_str = metric_str + ' ' + str(value)
+    def get_line(self, bucket, label_str, value_name, value, timestamp, openmetrics=False):
+        line_str = bucket + '{' + label_str + 'value="' + escape_label_value(value_name) + '"} ' + format_number(value)
         if timestamp is not None:
-            line_str += ' ' + str(int(timestamp * 1000))
+            # OpenMetrics timestamps are in seconds, the text format uses millis.
+            if openmetrics:
+                line_str += ' ' + format_number(timestamp)
+            else:
+                line_str += ' ' + str(int(timestamp * 1000))
         # Lines MUST end with \n (not \r\n), the last line MUST also end with \n
         # Otherwise, Prometheus will reject the whole scrape!
         line_str += '\n'
-        return metric_str, line_str
+        return line_str
 
-    def get_chunks(self):
+    def get_families(self):
         with self.buffer_lock:
-            buffer = tuple(metric_line for recv_timestamp, metric_line in self.buffer.values())
-        for chunk_start in range(0, len(buffer), self.chunk_size):
-            chunk = buffer[chunk_start:chunk_start + self.chunk_size]
-            yield ''.join(chunk)
+            return self.buffer.snapshot()
 
-    def get_page(self):
-        return ''.join(self.get_chunks())
+    def get_text_chunks(self, families, openmetrics=False):
+        buf = []
+        for bucket, series in families:
+            if openmetrics:
+                buf.append('# TYPE ' + bucket + ' unknown\n')
+            for label_set, label_str, value_name, value, timestamp in series:
+                buf.append(self.get_line(bucket, label_str, value_name, value, timestamp, openmetrics))
+                if len(buf) >= self.chunk_size:
+                    yield ''.join(buf)
+                    buf = []
+        if openmetrics:
+            buf.append('# EOF\n')
+        if buf:
+            yield ''.join(buf)
+
+    def get_protobuf_chunks(self, families):
+        buf, buf_len = [], 0
+        for bucket, series in families:
+            buf.append(encode_family(bucket, series))
+            buf_len += len(series)
+            if buf_len >= self.chunk_size:
+                yield b''.join(buf)
+                buf, buf_len = [], 0
+        if buf:
+            yield b''.join(buf)
+
+    def get_chunks(self, fmt='text'):
+        families = self.get_families()
+        if fmt == 'protobuf':
+            yield from self.get_protobuf_chunks(families)
+        else:
+            for chunk in self.get_text_chunks(families, fmt == 'openmetrics'):
+                yield chunk.encode('utf-8')
+
+    def get_page(self, fmt='text'):
+        page = b''.join(self.get_chunks(fmt))
+        return page if fmt == 'protobuf' else page.decode('utf-8')
 
     def loop(self):
         ip, port = self.resolve_local_host(9103)
@@ -105,26 +425,29 @@ class PrometheusExporter(module.MetricsDstProcess, module.HostResolver):
     def flush(self, system_timestamp):
         timeout = self.cfg['values_timeout']
         with self.buffer_lock:
-            old_keys = [
-                k for k, (recv_timestamp, metric_line) in self.buffer.items()
-                if (system_timestamp - recv_timestamp) > timeout
-            ]
-            for k in old_keys:
-                del self.buffer[k]
+            if self.buffer.evict(system_timestamp - timeout):
+                self.buffer_version += 1
             return True
 
     def produce_self_report(self):
         self_report = super().produce_self_report()
         self_report['metrics_received'] = self.metrics_received
         self_report['http_requests'] = self.http_requests
+        self_report['http_not_modified'] = self.http_not_modified
+        with self.buffer_lock:
+            series_count = len(self.buffer)
+            self_report['series_count'] = series_count
+            if series_count:
+                self_report['bytes_per_series'] = round(self.buffer.memory_usage() / series_count, 1)
         return self_report
 
     def process_values(self, recv_timestamp, bucket, values, metrics_timestamp, metadata):
-        for k, v in values.items():
-            if isinstance(v, bool):
-                v = int(v)
-            if isinstance(v, (int, float)):
-                metadata['value'] = k
-                metric_str, line_str = self.get_line(bucket, v, metadata, metrics_timestamp)
-                with self.buffer_lock:
-                    self.buffer[metric_str] = recv_timestamp, line_str
+        with self.buffer_lock:
+            # The label set is a canonical part of the metric, used as a key, too
+            label_entry = self.buffer.intern_label_set(metadata)
+            for k, v in values.items():
+                if isinstance(v, (int, float)):
+                    self.buffer.update(bucket, label_entry, k, v, recv_timestamp, metrics_timestamp)
+                    self.buffer_version += 1
+            # No series may refer to it, i.e. when none of the values were numeric
+            self.buffer.release_label_set(label_entry)
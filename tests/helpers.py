@@ -0,0 +1,20 @@
+
+
+import os
+import unittest
+
+
+class MetricsPipe(list):
+    def send(self, chunk):
+        self.extend(chunk)
+
+
+def env_flag(name):
+    flag = os.environ.get(name, 'no').lower()
+    return flag in ('yes', 'true', '1')
+
+
+class PerformanceTestCase(unittest.TestCase):
+    def prepare_performance_test(self):
+        if not env_flag('TEST_PERFORMANCE'):
+            self.skipTest("Performance test not requested")
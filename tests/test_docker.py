@@ -0,0 +1,461 @@
+
+
+import os
+import json
+import errno
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import socketserver
+import http.server
+import bucky3.docker as docker
+from helpers import MetricsPipe
+
+
+def container_inspect(container_id, pid, labels=None, env=None):
+    return {
+        'Id': container_id,
+        'Config': {'Labels': labels or {}, 'Env': env or []},
+        'HostConfig': {'Memory': 0, 'NanoCpus': 0, 'CpuPeriod': 0, 'CpuQuota': 0},
+        'State': {'Pid': pid},
+        'SizeRootFs': 1000,
+        'SizeRw': 10,
+    }
+
+
+class DockerStandIn(http.server.BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+        self.server.subscribed.set()
+        while not self.server.closing:
+            try:
+                event = self.server.events.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            data = json.dumps(event).encode('utf-8') + b'\n'
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+            self.wfile.flush()
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        path = self.path.split('?')[0].split('/')[2:]
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        # Latency can be injected per container
+        time.sleep(self.server.delays.get(path[1] if len(path) == 3 else None, 0))
+        if path == ['events']:
+            return self.send_events()
+        if path == ['containers', 'json']:
+            return self.send_json(200, [
+                {'Id': container_id, 'Names': ['/' + container_id[:4]]} for container_id in self.server.containers
+            ])
+        if len(path) == 3 and path[0] == 'containers' and path[2] == 'json':
+            inspect_info = self.server.containers.get(path[1])
+            if inspect_info:
+                return self.send_json(200, inspect_info)
+        self.send_json(404, {'message': 'No such container'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('docker', 0)
+
+
+def write_files(root, files):
+    for path, content in files.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def docker_setup(cgroup_files=None, **extra_cfg):
+    def wrapper(fun):
+        def run(self):
+            tmp_dir = tempfile.mkdtemp()
+            if cgroup_files is not None:
+                # A fake sysfs tree
+                extra_cfg['cgroup_root'] = os.path.join(tmp_dir, 'cgroup')
+                write_files(extra_cfg['cgroup_root'], cgroup_files)
+            socket_path = os.path.join(tmp_dir, 'docker.sock')
+            server = DockerServer(socket_path, DockerStandIn)
+            server.requests, server.lock, server.containers = [], threading.Lock(), {}
+            server.delays, server.connections = {}, 0
+            server.events, server.subscribed, server.closing = queue.Queue(), threading.Event(), False
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                cfg = dict(flush_interval=1, docker_socket=socket_path, log_level='ERROR', destination_modules=())
+                cfg.update(**extra_cfg)
+                docker_module = docker.DockerStatsCollector('docker_test', cfg, [MetricsPipe()])
+                docker_module.init_cfg()
+                try:
+                    fun(self, docker_module, server)
+                finally:
+                    # The background threads outlive the test, with no containers the filesystem
+                    # thread only sleeps, rather than keep calling time.monotonic patched by other tests.
+                    docker_module.container_ids = ()
+                    docker_module.inspect_executor.shutdown(wait=False)
+            finally:
+                server.closing = True
+                server.shutdown()
+                server.server_close()
+                shutil.rmtree(tmp_dir)
+
+        return run
+
+    return wrapper
+
+
+class TestDockerStatsCollector(unittest.TestCase):
+    def inspect_requests(self, server):
+        return len([r for r in server.requests if r.startswith('/v1.22/containers/') and '/json?' in r])
+
+    def wait_for_events(self, docker_module, count):
+        for _ in range(100):
+            if docker_module.docker_events >= count:
+                break
+            time.sleep(0.01)
+        self.assertEqual(docker_module.docker_events, count)
+
+    def container_metrics(self, docker_module, bucket):
+        return {m[3]['docker_id']: (m[1], m[3]) for m in docker_module.dst_pipes[0] if m[0] == bucket}
+
+    def stub_readers(self, docker_module):
+        # Only the API side is tested here
+        for reader in 'read_memory_stats', 'read_interface_stats', 'read_blkio_stats', 'read_pressure_stats':
+            setattr(docker_module, reader, lambda *args: None)
+        docker_module.read_cpu_stats = lambda buffer, container, timestamp: \
+            buffer.append(('docker_test', {'pid': container.root_pid}, timestamp, container.metadata))
+        docker_module.find_cgroup = lambda container_id, root_pid, controller=None: '/sys/fs/cgroup/test'
+
+    @docker_setup()
+    def test_inspect_cache(self, docker_module, server):
+        self.stub_readers(docker_module)
+        server.containers['a' * 64] = container_inspect('a' * 64, 1)
+        server.containers['b' * 64] = container_inspect('b' * 64, 2, labels={'team': 'x'})
+        docker_module.start_thread('DockerEventsThread', docker_module.events_loop)
+        self.assertTrue(server.subscribed.wait(5))
+        self.assertTrue(docker_module.flush(1))
+        self.assertEqual(self.inspect_requests(server), 2)
+        self.assertTrue(docker_module.flush(2))
+        self.assertEqual(self.inspect_requests(server), 2)
+        # Exec and health check events don't change the inspect info
+        for action in 'exec_create: sh', 'exec_start: sh', 'exec_die', 'health_status: healthy':
+            server.events.put({'Type': 'container', 'Action': action, 'Actor': {'ID': 'a' * 64}})
+        self.wait_for_events(docker_module, 4)
+        self.assertEqual(set(docker_module.inspect_cache), {'a' * 64, 'b' * 64})
+        self.assertTrue(docker_module.flush(2))
+        self.assertEqual(self.inspect_requests(server), 2)
+        # A new container, and an event for one of the known ones
+        server.containers['c' * 64] = container_inspect('c' * 64, 3)
+        server.containers['b' * 64]['Config']['Labels']['team'] = 'y'
+        server.events.put({'Type': 'container', 'Action': 'update', 'Actor': {'ID': 'b' * 64}})
+        self.wait_for_events(docker_module, 5)
+        docker_module.dst_pipes[0].clear()
+        self.assertTrue(docker_module.flush(3))
+        self.assertEqual(self.inspect_requests(server), 4)
+        self.assertEqual(self.container_metrics(docker_module, 'docker_test')['b' * 12][1]['team'], 'y')
+        self.assertEqual(len(self.container_metrics(docker_module, 'docker_test')), 3)
+        # Removed containers are dropped from the cache
+        del server.containers['a' * 64]
+        self.assertTrue(docker_module.flush(4))
+        self.assertEqual(set(docker_module.inspect_cache), {'b' * 64, 'c' * 64})
+        self.assertEqual(docker_module.produce_self_report()['inspect_calls'], 4)
+        # Metadata inspects are cheap, they don't ask for sizes
+        self.assertFalse([r for r in server.requests if 'size=true' in r])
+
+    @docker_setup(env_mapping={'APP': 'app'})
+    def test_container_diffing(self, docker_module, server):
+        self.stub_readers(docker_module)
+        setup_container, setups = docker_module.setup_container, []
+        docker_module.setup_container = lambda *args: setups.append(args[0]) or setup_container(*args)
+        docker_module.extract_metadata = unittest.mock.Mock(wraps=docker_module.extract_metadata)
+        for i in range(3):
+            server.containers[str(i) * 64] = container_inspect(str(i) * 64, i, env=['APP=app' + str(i)])
+        self.assertTrue(docker_module.flush(1))
+        self.assertEqual(setups, ['0' * 64, '1' * 64, '2' * 64])
+        # Steady state, no inspects and no metadata extraction
+        docker_module.dst_pipes[0].clear()
+        self.assertTrue(docker_module.flush(2))
+        self.assertEqual(len(setups), 3)
+        self.assertEqual(docker_module.extract_metadata.call_count, 3)
+        self.assertEqual(self.inspect_requests(server), 3)
+        test_stats = self.container_metrics(docker_module, 'docker_test')
+        self.assertEqual(test_stats['1' * 12], ({'pid': 1}, {
+            'docker_id': '1' * 12, 'docker_name': '/1111', 'app': 'app1',
+        }))
+        # One gone, one added, one changed
+        del server.containers['0' * 64]
+        server.containers['3' * 64] = container_inspect('3' * 64, 3)
+        server.containers['2' * 64]['Config']['Env'] = ['APP=changed']
+        docker_module.invalidate_inspect_cache('2' * 64)
+        docker_module.dst_pipes[0].clear()
+        self.assertTrue(docker_module.flush(3))
+        self.assertEqual(setups[3:], ['2' * 64, '3' * 64])
+        self.assertEqual(set(docker_module.containers), {'1' * 64, '2' * 64, '3' * 64})
+        test_stats = self.container_metrics(docker_module, 'docker_test')
+        self.assertEqual(set(test_stats), {'1' * 12, '2' * 12, '3' * 12})
+        self.assertEqual(test_stats['2' * 12][1]['app'], 'changed')
+        self.assertEqual(self.inspect_requests(server), 5)
+        self_report = docker_module.produce_self_report()
+        self.assertEqual(self_report['containers'], 3)
+        self.assertEqual(self_report['container_setups'], 5)
+
+    @docker_setup(filesystem_interval=1)
+    def test_filesystem_stats(self, docker_module, server):
+        self.stub_readers(docker_module)
+        for i in range(4):
+            server.containers[str(i) * 64] = container_inspect(str(i) * 64, i)
+        # A bad inspect only skips its container
+        server.containers['1' * 64]['SizeRootFs'] = 'unknown'
+        self.assertTrue(docker_module.flush(1))
+        self.assertEqual(self.container_metrics(docker_module, 'docker_filesystem'), {})
+        docker_module.start_thread('DockerFilesystemThread', docker_module.filesystem_loop)
+        # Containers are inspected one by one, every 1s / 4 containers
+        time.sleep(0.1)
+        size_requests = [r for r in server.requests if 'size=true' in r]
+        self.assertEqual(len(size_requests), 1)
+        time.sleep(0.5)
+        size_requests = [r for r in server.requests if 'size=true' in r]
+        self.assertEqual(len(size_requests), 3)
+        time.sleep(0.3)
+        self.assertTrue(docker_module.flush(2))
+        df_stats = self.container_metrics(docker_module, 'docker_filesystem')
+        self.assertEqual(set(df_stats), {'0' * 12, '2' * 12, '3' * 12})
+        self.assertEqual(df_stats['0' * 12][0], {'total_bytes': 1000, 'used_bytes': 10})
+        self.assertFalse(docker_module.ended_threads())
+        self.assertEqual(len(self.container_metrics(docker_module, 'docker_test')), 4)
+
+    @docker_setup(inspect_concurrency=4)
+    def test_concurrent_inspects(self, docker_module, server):
+        self.stub_readers(docker_module)
+        for i in range(8):
+            server.containers[str(i) * 64] = container_inspect(str(i) * 64, i)
+            server.delays[str(i) * 64] = 0.1
+        # This one is too slow for a flush, it is picked up from the cache later on
+        server.delays['7' * 64] = 0.8
+        flush_start = time.monotonic()
+        self.assertTrue(docker_module.flush(1))
+        # Two rounds of four concurrent inspects, plus the inspect_timeout for the slow one
+        self.assertLess(time.monotonic() - flush_start, 0.7)
+        self.assertEqual(len(self.container_metrics(docker_module, 'docker_test')), 7)
+        time.sleep(0.5)
+        docker_module.dst_pipes[0].clear()
+        self.assertTrue(docker_module.flush(2))
+        self.assertEqual(len(self.container_metrics(docker_module, 'docker_test')), 8)
+        self.assertEqual(self.inspect_requests(server), 8)
+        # Keep-alive connections are reused
+        self.assertLessEqual(server.connections, 6)
+        self_report = docker_module.produce_self_report()
+        self.assertEqual(self_report['list_containers_calls'], 2)
+        self.assertEqual(self_report['inspect_container_calls'], 8)
+        self.assertGreaterEqual(self_report['inspect_container_latency_max'], 800)
+        self.assertGreaterEqual(self_report['inspect_container_latency'], 100)
+
+    @docker_setup(cgroup_files={
+        'cpu,cpuacct/docker/' + 'a' * 64 + '/cpuacct.usage_percpu': '100 200\n',
+        'memory/docker/' + 'a' * 64 + '/memory.usage_in_bytes': '4096\n',
+        'cpu,cpuacct/system.slice/docker-' + 'b' * 64 + '.scope/cpuacct.usage_percpu': '300 400\n',
+        'memory/system.slice/docker-' + 'b' * 64 + '.scope/memory.usage_in_bytes': '8192\n',
+        'blkio/docker/' + 'a' * 64 + '/blkio.throttle.io_service_bytes':
+            '8:0 Read 1024\n8:0 Write 2048\n8:0 Sync 3072\n8:0 Async 0\n8:0 Total 3072\nTotal 3072\n',
+        'blkio/docker/' + 'a' * 64 + '/blkio.throttle.io_serviced':
+            '8:0 Read 1\n8:0 Write 2\n8:0 Sync 3\n8:0 Async 0\n8:0 Total 3\nTotal 3\n',
+        'blkio/system.slice/docker-' + 'b' * 64 + '.scope/blkio.throttle.io_service_bytes': 'Total 0\n',
+        'blkio/system.slice/docker-' + 'b' * 64 + '.scope/blkio.throttle.io_serviced': 'Total 0\n',
+    })
+    def test_cgroup_v1(self, docker_module, server):
+        self.assertFalse(docker_module.cgroup_v2)
+        # The network stats come from /proc/<pid>/net/dev, the current process will do
+        server.containers['a' * 64] = container_inspect('a' * 64, os.getpid())
+        server.containers['b' * 64] = container_inspect('b' * 64, os.getpid())
+        server.containers['b' * 64]['HostConfig'].update(Memory=65536, CpuQuota=50000, CpuPeriod=100000)
+        self.assertTrue(docker_module.flush(1))
+        cpu_stats = [(m[1], m[3].get('name')) for m in docker_module.dst_pipes[0] if m[0] == 'docker_cpu']
+        self.assertEqual(cpu_stats, [
+            ({'usage': 100}, 'cpu0'), ({'usage': 200}, 'cpu1'), ({'limit_ps': 2000000000}, None),
+            ({'usage': 300}, 'cpu0'), ({'usage': 400}, 'cpu1'), ({'limit_ps': 500000000}, None),
+        ])
+        memory_stats = self.container_metrics(docker_module, 'docker_memory')
+        self.assertEqual(memory_stats['a' * 12][0], {'used_bytes': 4096, 'limit_bytes': docker_module.system_memory})
+        self.assertEqual(memory_stats['b' * 12][0], {'used_bytes': 8192, 'limit_bytes': 65536})
+        self.assertTrue(self.container_metrics(docker_module, 'docker_interface'))
+        blkio_stats = [
+            (m[1], m[3]['docker_id'], m[3]['name']) for m in docker_module.dst_pipes[0] if m[0] == 'docker_blkio'
+        ]
+        self.assertEqual(blkio_stats, [
+            ({'read_bytes': 1024, 'write_bytes': 2048, 'read_ops': 1, 'write_ops': 2}, 'a' * 12, '8:0'),
+        ])
+        # No PSI in cgroup v1
+        self.assertEqual(self.container_metrics(docker_module, 'docker_pressure'), {})
+        self.assertEqual(set(docker_module.containers), {'a' * 64, 'b' * 64})
+
+    @docker_setup(cgroup_files={
+        'cgroup.controllers': 'cpu io memory pids\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/cpu.stat':
+            'usage_usec 1000\nuser_usec 600\nsystem_usec 400\nnr_periods 10\nnr_throttled 2\nthrottled_usec 50\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/memory.current': '4096\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/memory.stat':
+            'anon 1024\nfile 2048\nkernel_stack 16\nslab 512\nshmem 8\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/io.stat': '',
+    })
+    def test_cgroup_v2(self, docker_module, server):
+        self.assertTrue(docker_module.cgroup_v2)
+        server.containers['a' * 64] = container_inspect('a' * 64, os.getpid())
+        server.containers['a' * 64]['HostConfig'].update(NanoCpus=1500000000)
+        # No cgroup for this one, it is skipped
+        server.containers['b' * 64] = container_inspect('b' * 64, os.getpid())
+        self.assertTrue(docker_module.flush(1))
+        cpu_stats = [(m[1], m[3].get('name')) for m in docker_module.dst_pipes[0] if m[0] == 'docker_cpu']
+        self.assertEqual(cpu_stats, [
+            ({'usage': 1000000, 'user': 600000, 'system': 400000,
+              'throttled_periods': 2, 'throttled_time': 50000}, 'cpu'),
+            ({'limit_ps': 1500000000}, None),
+        ])
+        memory_stats = self.container_metrics(docker_module, 'docker_memory')
+        self.assertEqual(list(memory_stats), ['a' * 12])
+        self.assertEqual(memory_stats['a' * 12][0], {
+            'used_bytes': 4096, 'limit_bytes': docker_module.system_memory,
+            'anon_bytes': 1024, 'file_bytes': 2048, 'slab_bytes': 512, 'shared_bytes': 8,
+        })
+        self.assertEqual(set(docker_module.containers), {'a' * 64})
+
+    @docker_setup(cgroup_files={
+        'cgroup.controllers': 'cpu io memory pids\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/cpu.stat': 'usage_usec 1000\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/memory.current': '4096\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/memory.stat': '',
+        'system.slice/docker-' + 'a' * 64 + '.scope/io.stat':
+            '8:0 rbytes=1024 wbytes=2048 rios=1 wios=2 dbytes=0 dios=0\n253:0 rbytes=512 wbytes=0 rios=1 wios=0\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/cpu.pressure':
+            'some avg10=1.50 avg60=0.50 avg300=0.10 total=1234\nfull avg10=0.00 avg60=0.00 avg300=0.00 total=0\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/io.pressure':
+            'some avg10=0.00 avg60=0.00 avg300=0.00 total=10\nfull avg10=0.00 avg60=0.00 avg300=0.00 total=5\n',
+    })
+    def test_blkio_and_pressure(self, docker_module, server):
+        cgroup_path = os.path.join(docker_module.cgroup_root, 'system.slice/docker-' + 'a' * 64 + '.scope')
+        server.containers['a' * 64] = container_inspect('a' * 64, os.getpid())
+        self.assertTrue(docker_module.flush(1))
+        blkio_stats = [(m[1], m[3]['name']) for m in docker_module.dst_pipes[0] if m[0] == 'docker_blkio']
+        self.assertEqual(blkio_stats, [
+            ({'read_bytes': 1024, 'write_bytes': 2048, 'discard_bytes': 0,
+              'read_ops': 1, 'write_ops': 2, 'discard_ops': 0}, '8:0'),
+            ({'read_bytes': 512, 'write_bytes': 0, 'read_ops': 1, 'write_ops': 0}, '253:0'),
+        ])
+        # No memory.pressure, it is skipped
+        pressure_stats = [(m[1], m[3]['name']) for m in docker_module.dst_pipes[0] if m[0] == 'docker_pressure']
+        self.assertEqual(pressure_stats, [
+            ({'some_avg10': 1.5, 'some_avg60': 0.5, 'some_avg300': 0.1, 'some_total': 1234,
+              'full_avg10': 0.0, 'full_avg60': 0.0, 'full_avg300': 0.0, 'full_total': 0}, 'cpu'),
+            ({'some_avg10': 0.0, 'some_avg60': 0.0, 'some_avg300': 0.0, 'some_total': 10,
+              'full_avg10': 0.0, 'full_avg60': 0.0, 'full_avg300': 0.0, 'full_total': 5}, 'io'),
+        ])
+        # The handles stay open and get re-read, even the missing file is not looked up again
+        container = docker_module.containers['a' * 64]
+        cgroup_files = dict(container.files)
+        self.assertIsNone(cgroup_files[cgroup_path + '/memory.pressure'])
+        write_files(cgroup_path, {
+            'io.stat': '8:0 rbytes=4096 wbytes=2048 rios=3 wios=2\n',
+            'memory.pressure': 'some avg10=0.00 avg60=0.00 avg300=0.00 total=1\n',
+        })
+        docker_module.dst_pipes[0].clear()
+        self.assertTrue(docker_module.flush(2))
+        blkio_stats = [(m[1], m[3]['name']) for m in docker_module.dst_pipes[0] if m[0] == 'docker_blkio']
+        self.assertEqual(blkio_stats, [
+            ({'read_bytes': 4096, 'write_bytes': 2048, 'read_ops': 3, 'write_ops': 2}, '8:0'),
+        ])
+        pressure_stats = [m[3]['name'] for m in docker_module.dst_pipes[0] if m[0] == 'docker_pressure']
+        self.assertEqual(pressure_stats, ['cpu', 'io'])
+        self.assertIs(docker_module.containers['a' * 64], container)
+        self.assertEqual(container.files, cgroup_files)
+        # Closed when the container is gone
+        del server.containers['a' * 64]
+        self.assertTrue(docker_module.flush(3))
+        self.assertEqual(docker_module.containers, {})
+        self.assertTrue(all(f.closed for f in cgroup_files.values() if f))
+
+    @docker_setup(max_cached_handles=2, cgroup_files={
+        'cgroup.controllers': 'cpu io memory pids\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/cpu.stat': 'usage_usec 1000\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/memory.current': '4096\n',
+        'system.slice/docker-' + 'a' * 64 + '.scope/memory.stat': '',
+        'system.slice/docker-' + 'a' * 64 + '.scope/io.stat': '',
+    })
+    def test_cached_handles_limit(self, docker_module, server):
+        cgroup_path = os.path.join(docker_module.cgroup_root, 'system.slice/docker-' + 'a' * 64 + '.scope')
+        server.containers['a' * 64] = container_inspect('a' * 64, os.getpid())
+        self.assertTrue(docker_module.flush(1))
+        container = docker_module.containers['a' * 64]
+        self.assertEqual(len([f for f in container.files.values() if f]), 2)
+        self.assertEqual(docker_module.produce_self_report()['cached_handles'], 2)
+        # Files beyond the limit are still read, just opened on every flush
+        write_files(cgroup_path, {'memory.current': '8192\n'})
+        docker_module.dst_pipes[0].clear()
+        self.assertTrue(docker_module.flush(2))
+        self.assertEqual(self.container_metrics(docker_module, 'docker_memory')['a' * 12][0]['used_bytes'], 8192)
+        # Running out of descriptors doesn't tear the container down
+        def read_file(path, optional=False):
+            raise OSError(errno.EMFILE, 'Too many open files')
+
+        container.read_file = read_file
+        self.assertTrue(docker_module.flush(3))
+        self.assertIs(docker_module.containers['a' * 64], container)
+        del container.read_file
+        del server.containers['a' * 64]
+        self.assertTrue(docker_module.flush(4))
+        self.assertEqual(docker_module.handle_budget.used, 0)
+
+    def test_nested_key_values(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            write_files(tmp_dir, {
+                'io.stat': '8:0 rbytes=1024 wbytes=2048 rios=1 wios=2 dbytes=0 dios=0\n253:0 rbytes=1\n',
+                'io.pressure': 'some avg10=0.12 avg60=0.00 avg300=0.00 total=1234\n'
+                               'full avg10=0.00 avg60=0.00 avg300=0.00 total=567\n',
+            })
+            reader = docker.linux.ProcfsReader()
+            self.assertEqual(dict(reader.read_nested_key_values(os.path.join(tmp_dir, 'io.stat'))), {
+                '8:0': {'rbytes': 1024, 'wbytes': 2048, 'rios': 1, 'wios': 2, 'dbytes': 0, 'dios': 0},
+                '253:0': {'rbytes': 1},
+            })
+            self.assertEqual(dict(reader.read_nested_key_values(os.path.join(tmp_dir, 'io.pressure'))), {
+                'some': {'avg10': 0.12, 'avg60': 0.0, 'avg300': 0.0, 'total': 1234},
+                'full': {'avg10': 0.0, 'avg60': 0.0, 'avg300': 0.0, 'total': 567},
+            })
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
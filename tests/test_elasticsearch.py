@@ -0,0 +1,391 @@
+
+
+import sys
+import time
+import gzip
+import json
+import uuid
+import hashlib
+import zlib
+import threading
+import unittest
+import socketserver
+import http.server
+import bucky3.elasticsearch as elasticsearch
+from helpers import PerformanceTestCase
+
+
+def legacy_process_values(self, recv_timestamp, bucket, values, timestamp, metadata):
+    # The doc pipeline used before templating, for performance comparisons
+    self.merge_dict(metadata)
+    self.merge_dict(values, metadata)
+    timestamp = timestamp or recv_timestamp
+    index_name = self.index_name(bucket, values, timestamp) if self.index_name else bucket
+    if self.timestamp_field_name:
+        values[self.timestamp_field_name] = round(timestamp * 1000)
+    if self.bucket_field_name:
+        values[self.bucket_field_name] = bucket
+    doc_str = json.dumps(values, sort_keys=True, indent=None, separators=(',', ':'))
+    doc_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, doc_str))
+    if self.add_type:
+        req = {"index": {"_index": index_name, "_type": self.type_name or bucket, "_id": doc_id}}
+    else:
+        req = {"index": {"_index": index_name, "_id": doc_id}}
+    req_str = json.dumps(req, indent=None, separators=(',', ':'))
+    self.buffer_output(req_str + '\n' + doc_str + '\n')
+
+
+class ElasticsearchStandIn(http.server.BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        elif self.headers.get('Content-Encoding') == 'deflate':
+            body = zlib.decompress(body)
+        lines = body.decode('utf-8').splitlines()
+        docs = [json.loads(line) for line in lines[1::2]]
+        # Latency and response code can be injected per request
+        delay, status = self.server.handle_docs(docs)
+        time.sleep(delay)
+        with self.server.lock:
+            self.server.requests.append((self.path, dict(self.headers), self.client_address, docs))
+        items = []
+        for doc in docs:
+            doc_status = self.server.doc_status(doc)
+            if doc_status < 300:
+                items.append({'index': {'status': doc_status}})
+            else:
+                items.append({'index': {'status': doc_status, 'error': {'type': 'test_exception'}}})
+        errors = any(i['index']['status'] >= 300 for i in items)
+        resp_body = json.dumps({'took': 1, 'errors': errors, 'items': items}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(resp_body)))
+        self.end_headers()
+        self.wfile.write(resp_body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ElasticsearchServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def elasticsearch_setup(**extra_cfg):
+    def wrapper(fun):
+        def run(self):
+            server = ElasticsearchServer(('127.0.0.1', 0), ElasticsearchStandIn)
+            server.requests, server.lock = [], threading.Lock()
+            server.handle_docs = lambda docs: (0, 200)
+            server.doc_status = lambda doc: 201
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                cfg = dict(flush_interval=1, remote_hosts=(), log_level='ERROR')
+                cfg.update(**extra_cfg)
+                elasticsearch_module = elasticsearch.ElasticsearchClient('elasticsearch_test', cfg, None)
+                elasticsearch_module.init_cfg()
+                elasticsearch_module.resolve_remote_hosts = lambda: {server.server_address}
+                fun(self, elasticsearch_module, server)
+                elasticsearch_module.close_socket()
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        return run
+
+    return wrapper
+
+
+class TestElasticsearchClient(PerformanceTestCase):
+    @elasticsearch_setup(chunk_size=10, compression='gzip')
+    def test_bulk_upload(self, elasticsearch_module, server):
+        for i in range(25):
+            elasticsearch_module.process_values(2, 'val', dict(x=i), 1, dict(host='a'))
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(elasticsearch_module.buffer, [])
+        self.assertEqual([len(r[3]) for r in server.requests], [10, 10, 5])
+        self.assertEqual(sorted(d['x'] for r in server.requests for d in r[3]), list(range(25)))
+        self.assertEqual(server.requests[0][3][0], dict(x=0, host='a', bucket='val', timestamp=1000))
+        self.assertTrue(all(r[0] == '/_bulk' for r in server.requests))
+
+    @elasticsearch_setup(chunk_size=1000, compression='deflate', compression_level=1)
+    def test_compression(self, elasticsearch_module, server):
+        # Big enough to be encoded and compressed in several pieces
+        for i in range(1000):
+            elasticsearch_module.process_values(2, 'val', dict(x=i, message='hello world ' * 10), 1, {})
+        docs_size = sum(len(doc) for doc in elasticsearch_module.buffer)
+        self.assertGreater(docs_size, 2 * elasticsearch.ElasticsearchConnection.BODY_PIECE_SIZE)
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual([d['x'] for d in server.requests[0][3]], list(range(1000)))
+        self.assertEqual(server.requests[0][1]['Content-Encoding'], 'deflate')
+        self_report = elasticsearch_module.produce_self_report()
+        self.assertEqual(self_report['bytes_sent'], int(server.requests[0][1]['Content-Length']))
+        self.assertEqual(self_report['compression_ratio'], round(docs_size / self_report['bytes_sent'], 3))
+        self.assertGreater(self_report['compression_ratio'], 5)
+
+    @elasticsearch_setup(chunk_size=10)
+    def test_connection_pool(self, elasticsearch_module, server):
+        for _ in range(3):
+            for i in range(20):
+                elasticsearch_module.process_values(2, 'val', dict(x=i), 1, {})
+            self.assertTrue(elasticsearch_module.flush(3))
+        # All bulk uploads went over one keep-alive connection
+        self.assertEqual(len(server.requests), 6)
+        self.assertEqual(len(set(r[2] for r in server.requests)), 1)
+        pool = elasticsearch_module.connection_pool
+        self.assertEqual((pool.hits, pool.misses, pool.retired), (5, 1, 0))
+        self_report = elasticsearch_module.produce_self_report()
+        self.assertEqual(self_report['pool_hits'], 5)
+        self.assertEqual(self_report['pool_misses'], 1)
+        self.assertGreater(self_report['connect_latency'], 0)
+
+    @elasticsearch_setup(chunk_size=10, connection_max_requests=2)
+    def test_connection_retirement(self, elasticsearch_module, server):
+        for i in range(50):
+            elasticsearch_module.process_values(2, 'val', dict(x=i), 1, {})
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(len(server.requests), 5)
+        self.assertEqual(len(set(r[2] for r in server.requests)), 3)
+        pool = elasticsearch_module.connection_pool
+        self.assertEqual((pool.hits, pool.misses, pool.retired), (2, 3, 2))
+        # Connections to hosts that are no longer resolved are dropped
+        elasticsearch_module.resolve_remote_hosts = lambda: {('127.0.0.1', 1)}
+        elasticsearch_module.process_values(2, 'val', dict(x=1), 1, {})
+        self.assertFalse(elasticsearch_module.flush(3))
+        self.assertEqual(pool.retired, 3)
+        self.assertEqual(len(elasticsearch_module.buffer), 1)
+        self.assertEqual(elasticsearch_module.connection_errors, 1)
+
+    @elasticsearch_setup(chunk_size=10, push_concurrency=4)
+    def test_parallel_bulk_upload(self, elasticsearch_module, server):
+        # The first chunk of every round is the slowest one, so chunks finish out of order
+        server.handle_docs = lambda docs: (0.3 if docs[0]['x'] % 40 == 0 else 0.1, 200)
+        for i in range(80):
+            elasticsearch_module.process_values(2, 'val', dict(x=i), 1, {})
+        body_bytes = sum(len(doc) for doc in elasticsearch_module.buffer)
+        flush_start = time.monotonic()
+        self.assertTrue(elasticsearch_module.flush(3))
+        # Two rounds of four concurrent uploads, sequentially it would take 1.2s
+        self.assertLess(time.monotonic() - flush_start, 0.9)
+        self.assertEqual(elasticsearch_module.buffer, [])
+        self.assertEqual(elasticsearch_module.metrics_sent, 80)
+        self.assertEqual(len(server.requests), 8)
+        self.assertEqual(sorted(d['x'] for r in server.requests for d in r[3]), list(range(80)))
+        self.assertNotEqual(server.requests[0][3][0]['x'], 0)
+        self.assertEqual(len(set(r[2] for r in server.requests)), 4)
+        # Body stats of every upload are accounted for, despite the connections being reused concurrently
+        self.assertEqual(elasticsearch_module.body_bytes, body_bytes)
+        self.assertEqual(
+            elasticsearch_module.body_compressed_bytes, sum(int(r[1]['Content-Length']) for r in server.requests)
+        )
+
+    @elasticsearch_setup(chunk_size=10, push_concurrency=4)
+    def test_parallel_bulk_upload_failures(self, elasticsearch_module, server):
+        # Chunks 2 and 4 fail, the delays make the failing ones finish first
+        server.handle_docs = lambda docs: (0, 500) if docs[0]['x'] in (10, 30) else (0.2, 200)
+        for i in range(40):
+            elasticsearch_module.process_values(2, 'val', dict(x=i), 1, {})
+        self.assertFalse(elasticsearch_module.flush(3))
+        self.assertEqual(elasticsearch_module.metrics_sent, 20)
+        self.assertEqual(elasticsearch_module.connection_errors, 1)
+        remaining = [json.loads(doc.splitlines()[1])['x'] for doc in elasticsearch_module.buffer]
+        self.assertEqual(remaining, list(range(10, 20)) + list(range(30, 40)))
+        server.handle_docs = lambda docs: (0, 200)
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(elasticsearch_module.buffer, [])
+        self.assertEqual(elasticsearch_module.metrics_sent, 40)
+
+    @elasticsearch_setup(chunk_size=100, max_batch_size=4096, max_doc_size=2048)
+    def test_byte_size_batching(self, elasticsearch_module, server):
+        for i in range(20):
+            elasticsearch_module.process_values(2, 'small', dict(x=i), 1, {})
+        for i in range(6):
+            elasticsearch_module.process_values(2, 'big', dict(x=i, trace='a' * 1500), 1, {})
+        elasticsearch_module.process_values(2, 'huge', dict(x=0, trace='a' * 3000), 1, {})
+        for i in range(20):
+            elasticsearch_module.process_values(2, 'small', dict(x=i), 1, {})
+        self.assertEqual(elasticsearch_module.docs_oversized, 1)
+        self.assertEqual(len(elasticsearch_module.buffer), 46)
+        docs = list(elasticsearch_module.buffer)
+        self.assertTrue(elasticsearch_module.flush(3))
+        sizes = [sum(len(doc) for doc in docs[i:i + len(r[3])]) for i, r in self.batch_offsets(server)]
+        self.assertEqual(sum(len(r[3]) for r in server.requests), 46)
+        self.assertGreater(len(server.requests), 2)
+        self.assertTrue(all(size <= 4096 for size in sizes))
+        self_report = elasticsearch_module.produce_self_report()
+        self.assertEqual(self_report['batches_sent'], len(server.requests))
+        self.assertEqual(self_report['batch_bytes_max'], max(sizes))
+        self.assertEqual(self_report['batch_bytes_avg'], round(sum(sizes) / len(sizes)))
+        self.assertEqual(elasticsearch_module.produce_self_report()['batches_sent'], 0)
+
+    @elasticsearch_setup(chunk_size=10, max_retries=2, retry_backoff=0.1, buffer_limit=100, retry_budget=0.05)
+    def test_partial_retry(self, elasticsearch_module, server):
+        # Docs divisible by 10 are malformed, 4n+1 docs are rejected with 429 once, 4n+3 docs always
+        rejections = set()
+
+        def doc_status(doc):
+            if doc['x'] % 10 == 0:
+                return 400
+            if doc['x'] % 4 == 3:
+                return 429
+            if doc['x'] % 4 == 1 and doc['x'] not in rejections:
+                rejections.add(doc['x'])
+                return 429
+            return 201
+
+        server.doc_status = doc_status
+        for i in range(10):
+            elasticsearch_module.process_values(2, 'val', dict(x=i), 1, {})
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(elasticsearch_module.buffer, [])
+        self.assertEqual(len(elasticsearch_module.retry_queue), 5)
+        self.assertEqual(elasticsearch_module.docs_dead_lettered, 1)
+        # Not due yet
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(len(server.requests), 1)
+        time.sleep(0.11)
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(sorted(d['x'] for d in server.requests[1][3]), [1, 3, 5, 7, 9])
+        self.assertEqual(len(elasticsearch_module.retry_queue), 2)
+        # 3 and 7 run out of retries, the retry budget only lets 5 docs wait for a retry
+        for i in range(10, 30):
+            elasticsearch_module.process_values(2, 'val', dict(x=i), 1, {})
+        time.sleep(0.21)
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(sorted(json.loads(d[2].splitlines()[1])['x'] for d in elasticsearch_module.retry_queue), [11, 13, 15, 17, 19])
+        self.assertEqual(elasticsearch_module.docs_dead_lettered, 1 + 9)
+        time.sleep(0.11)
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(len(elasticsearch_module.retry_queue), 3)
+        self_report = elasticsearch_module.produce_self_report()
+        self.assertEqual(self_report['docs_retried'], 5 + 2 + 5 + 3)
+        self.assertEqual(self_report['docs_rejected'], 6 + 2 + 14 + 3)
+        self.assertEqual(self_report['docs_dead_lettered'], 10)
+        self.assertEqual(self_report['docs_retry_queued'], 3)
+
+    @staticmethod
+    def batch_offsets(server):
+        offset = 0
+        for r in server.requests:
+            yield offset, r
+            offset += len(r[3])
+
+    @elasticsearch_setup(chunk_size=20, adaptive_push=True, target_push_latency=0.3, max_chunk_size=30)
+    def test_adaptive_push(self, elasticsearch_module, server):
+        def push(count):
+            for i in range(count):
+                elasticsearch_module.process_values(2, 'val', dict(x=i), 1, {})
+            return elasticsearch_module.flush(3)
+
+        # The measured latency is replaced, so that the outcome doesn't depend on the host speed
+        push_latency = 0.01
+        adapt_push = elasticsearch_module.adapt_push
+        elasticsearch_module.adapt_push = lambda latency: adapt_push(latency if latency is None else push_latency)
+        # Fast pushes grow the chunk size by 2 until the max
+        self.assertTrue(push(100))
+        self.assertEqual([len(r[3]) for r in server.requests], [20, 22, 24, 26, 8])
+        self.assertTrue(push(100))
+        self.assertEqual(elasticsearch_module.chunk_size, 30)
+        # Slow pushes halve it
+        server.requests.clear()
+        push_latency = 0.4
+        self.assertTrue(push(30))
+        self.assertEqual(elasticsearch_module.chunk_size, 15)
+        self.assertEqual(elasticsearch_module.push_count_limit, 5000)
+        push_latency = 0.01
+        self.assertTrue(push(15))
+        self.assertEqual(elasticsearch_module.chunk_size, 17)
+        # So do per doc rejections and failures
+        server.doc_status = lambda doc: 429 if doc['x'] == 0 else 201
+        self.assertTrue(push(10))
+        self.assertEqual(elasticsearch_module.chunk_size, 8)
+        self.assertEqual(elasticsearch_module.push_count_limit, 2508)
+        server.handle_docs = lambda docs: (0, 500)
+        self.assertFalse(push(10))
+        self.assertEqual(elasticsearch_module.chunk_size, 4)
+        self.assertEqual(elasticsearch_module.push_count_limit, 1254)
+        self_report = elasticsearch_module.produce_self_report()
+        self.assertEqual(self_report['chunk_size'], 4)
+        self.assertEqual(self_report['push_count_limit'], 1254)
+
+    def process_test_values(self, elasticsearch_module, process_values):
+        elasticsearch_module.buffer = []
+        process_values(2, 'val', dict(y='\u00fc', x=1), 1, dict(host='a'))
+        process_values(2, 'val', dict(z=1.5), None, {})
+        return elasticsearch_module.buffer
+
+    @elasticsearch_setup(add_type=True, index_name='idx-%d"')
+    def test_doc_ids(self, elasticsearch_module, server):
+        legacy = lambda *args: legacy_process_values(elasticsearch_module, *args)
+        self.assertEqual(
+            self.process_test_values(elasticsearch_module, elasticsearch_module.process_values),
+            self.process_test_values(elasticsearch_module, legacy)
+        )
+        elasticsearch_module.id_mode = 'hash'
+        elasticsearch_module.doc_id = elasticsearch_module.hash_doc_id
+        elasticsearch_module.action_templates.clear()
+        docs = self.process_test_values(elasticsearch_module, elasticsearch_module.process_values)
+        doc_str = '{"bucket":"val","timestamp":2000,"z":1.5}'
+        doc_id = hashlib.blake2b(doc_str.encode('utf-8'), digest_size=16).hexdigest()
+        self.assertEqual(docs[1], '{"index":{"_index":"idx-%d\\"","_type":"val","_id":"' + doc_id + '"}}\n' + doc_str + '\n')
+
+    @elasticsearch_setup(id_mode='none')
+    def test_server_generated_ids(self, elasticsearch_module, server):
+        docs = self.process_test_values(elasticsearch_module, elasticsearch_module.process_values)
+        self.assertEqual(docs, [
+            '{"index":{"_index":"val"}}\n{"y":"\\u00fc","x":1,"host":"a","timestamp":1000,"bucket":"val"}\n',
+            '{"index":{"_index":"val"}}\n{"z":1.5,"timestamp":2000,"bucket":"val"}\n',
+        ])
+        self.assertTrue(elasticsearch_module.flush(3))
+        self.assertEqual(server.requests[0][3][0]['y'], '\u00fc')
+
+    def encoding_performance(self, elasticsearch_module, prefix, docs_count, flushes_count):
+        # Roughly what systemd_journal produces
+        test_set = [
+            ('journal', {
+                'MESSAGE': 'Started Session ' + str(i) + ' of user root.', 'PRIORITY': '6',
+                'SYSLOG_FACILITY': '3', 'SYSLOG_IDENTIFIER': 'systemd', '_PID': str(1000 + i),
+                '_SYSTEMD_UNIT': 'session-' + str(i) + '.scope', '_TRANSPORT': 'journal',
+            }, 1000 + i / 1000, {'host': 'myhost.mydomain', 'env': 'prod'})
+            for i in range(docs_count)
+        ]
+        total_time = 0
+        for i in range(flushes_count):
+            elasticsearch_module.buffer = []
+            batch = [(b, dict(v), t, dict(m)) for b, v, t, m in test_set]
+            start_time = time.process_time()
+            for bucket, values, timestamp, metadata in batch:
+                elasticsearch_module.process_values(1, bucket, values, timestamp, metadata)
+            total_time += time.process_time() - start_time
+        total_docs = docs_count * flushes_count
+        print('\n{prefix}: {total_docs:d} docs in {total_time:.2f}s -> {us_per_doc:.2f}us/doc'.format(
+            prefix=prefix, total_docs=total_docs, total_time=total_time,
+            us_per_doc=1000000 * total_time / total_docs
+        ), flush=True, file=sys.stderr)
+
+    @elasticsearch_setup(index_name='metrics')
+    def test_encoding_performance(self, elasticsearch_module, server):
+        self.prepare_performance_test()
+        process_values = elasticsearch_module.process_values
+        elasticsearch_module.process_values = lambda *args: legacy_process_values(elasticsearch_module, *args)
+        self.encoding_performance(elasticsearch_module, "doc encoding, before templating", 1000, 50)
+        elasticsearch_module.process_values = process_values
+        for id_mode, doc_id in (('uuid5', elasticsearch_module.uuid5_doc_id),
+                                ('hash', elasticsearch_module.hash_doc_id),
+                                ('none', None)):
+            elasticsearch_module.id_mode, elasticsearch_module.doc_id = id_mode, doc_id
+            elasticsearch_module.doc_encoder = json.JSONEncoder(
+                sort_keys=(id_mode != 'none'), indent=None, separators=(',', ':')
+            ).encode
+            elasticsearch_module.action_templates.clear()
+            self.encoding_performance(elasticsearch_module, "doc encoding, id_mode=" + id_mode, 1000, 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,14 @@
 
 
+import sys
+import gzip
+import time
+import threading
 import unittest
-from unittest.mock import patch
+import http.server
+from unittest.mock import patch, MagicMock
 import bucky3.influxdb as influxdb
+from helpers import PerformanceTestCase
 
 
 def influxdb_verify(influxdb_module, expected_values):
@@ -40,7 +46,72 @@ def influxdb_setup(timestamps, **extra_cfg):
         return wrapper
 
 
-class TestInfluxDBClient(unittest.TestCase):
+def legacy_process_values(self, recv_timestamp, bucket, values, timestamp, metadata):
+    # The encoder used before caching, for performance comparisons
+    metadata_buf = [bucket]
+    for k in sorted(metadata.keys()):
+        v = metadata[k]
+        if v is None or v == '':
+            continue
+        metadata_buf.append(k + '=' + str(v).replace(',', '\\,').replace(' ', '\\ ').replace('=', '\\='))
+    value_buf = []
+    for k in sorted(values.keys()):
+        v = values[k]
+        if isinstance(v, (float, int, bool)):
+            value_buf.append(str(k) + '=' + str(v))
+        elif isinstance(v, str):
+            value_buf.append(str(k) + '="' + v.replace('"', r'\"') + '"')
+    line = ' '.join((','.join(metadata_buf), ','.join(value_buf)))
+    if timestamp is not None:
+        line += ' ' + str(int(timestamp * 1000000000))
+    self.buffer_output(line)
+
+
+class InfluxDBStandIn(http.server.BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.writes.append((self.path, dict(self.headers), self.client_address, body.decode('utf-8')))
+        status, headers = self.server.responses.pop(0) if self.server.responses else (204, {})
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def influxdb_http_setup(**extra_cfg):
+    def wrapper(fun):
+        def run(self):
+            server = http.server.HTTPServer(('127.0.0.1', 0), InfluxDBStandIn)
+            server.writes, server.responses = [], []
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                cfg = dict(flush_interval=1, database='testdb', remote_hosts=(), log_level='ERROR')
+                cfg.update(**extra_cfg)
+                influxdb_module = influxdb.InfluxDBHTTPClient('influxdb_test', cfg, None)
+                influxdb_module.init_cfg()
+                influxdb_module.resolve_remote_hosts = lambda: {server.server_address}
+                fun(self, influxdb_module, server)
+                influxdb_module.close_socket()
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        return run
+
+    return wrapper
+
+
+class TestInfluxDBClient(PerformanceTestCase):
     @influxdb_setup(timestamps=range(1, 100))
     def test_simple_multi_values(self, influxdb_module):
         influxdb_module.process_values(2, 'val1', dict(x=1.5, y=2), 1, {})
@@ -52,6 +123,15 @@ class TestInfluxDBClient(unittest.TestCase):
             'val1 y=10,z=1.234 2000000000',
         ]
 
+    @influxdb_setup(timestamps=range(1, 100))
+    def test_empty_values(self, influxdb_module):
+        influxdb_module.process_values(2, 'val1', {}, 1, dict(a='b'))
+        influxdb_module.process_values(2, 'val1', {}, None, {})
+        influxdb_module.process_values(2, 'val1', dict(x=1), 1, dict(a='b'))
+        return [
+            'val1,a=b x=1 1000000000',
+        ]
+
     @influxdb_setup(timestamps=range(1, 100))
     def test_multi_values(self, influxdb_module):
         influxdb_module.process_values(2, 'val1', dict(x=1, y=2), 1, dict(path='/foo/bar', foo='world', hello='world'))
@@ -63,6 +143,199 @@ class TestInfluxDBClient(unittest.TestCase):
             'val1,hello=world,path=foo.bar y=10,z=11.22 2000000000',
         ]
 
+    @influxdb_setup(timestamps=range(1, 100), max_packet_size=100)
+    def test_packet_packing(self, influxdb_module):
+        influxdb_module.sock = MagicMock()
+        influxdb_module.resolve_remote_hosts = lambda: {('127.0.0.1', 8086)}
+        lines = ['val' + str(i) + ' x=' + str(i * 1000) for i in range(20)] + ['long x="' + 'a' * 150 + '"']
+        influxdb_module.push_chunk(lines)
+        payloads = [c[0][0] for c in influxdb_module.sock.sendto.call_args_list]
+        self.assertEqual(b'\n'.join(payloads), '\n'.join(lines).encode('utf-8'))
+        self.assertTrue(all(len(p) <= 100 for p in payloads[:-1]))
+        self.assertEqual(len(payloads[-1]), len(lines[-1]))
+        self.assertEqual(len(payloads), 4)
+        self.assertEqual(influxdb_module.packets_sent, 4)
+        self.assertEqual(influxdb_module.bytes_sent, sum(len(p) for p in payloads))
+
+    @influxdb_http_setup(precision='ms', max_batch_size=1024)
+    def test_http_write(self, influxdb_module, server):
+        for i in range(100):
+            influxdb_module.process_values(2, 'val1', dict(x=i), 1.5, dict(host='h' + str(i)))
+        self.assertTrue(influxdb_module.flush(2))
+        self.assertEqual(influxdb_module.buffer, [])
+        influxdb_module.process_values(2, 'val2', dict(y=1), 2, {})
+        self.assertTrue(influxdb_module.flush(3))
+        lines = sum((body.split('\n') for path, headers, client_address, body in server.writes), [])
+        self.assertEqual(lines, ['val1,host=h' + str(i) + ' x=' + str(i) + ' 1500' for i in range(100)] + ['val2 y=1 2000'])
+        self.assertGreater(len(server.writes), 2)
+        for path, headers, client_address, body in server.writes:
+            self.assertEqual(path, '/write?db=testdb&precision=ms')
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertLessEqual(len(body), 1024)
+        # All writes went through one kept alive connection
+        self.assertEqual(len(set(client_address for path, headers, client_address, body in server.writes)), 1)
+        self.assertEqual(influxdb_module.writes_sent, len(server.writes))
+
+    @influxdb_http_setup(max_batch_size=1024)
+    def test_http_partial_write(self, influxdb_module, server):
+        server.responses.extend([(204, {}), (503, {'Retry-After': '0'})])
+        for i in range(100):
+            influxdb_module.process_values(2, 'val1', dict(x=i), None, dict(host='h' + str(i)))
+        self.assertFalse(influxdb_module.flush(2))
+        self.assertEqual(len(server.writes), 2)
+        self.assertTrue(influxdb_module.flush(3))
+        # The lines of the accepted write are not sent again
+        accepted_writes = server.writes[:1] + server.writes[2:]
+        lines = sum((body.split('\n') for path, headers, client_address, body in accepted_writes), [])
+        self.assertEqual(lines, ['val1,host=h' + str(i) + ' x=' + str(i) for i in range(100)])
+        self.assertEqual(influxdb_module.buffer, [])
+
+    @influxdb_http_setup(api_version=2, org='myorg', auth_token='secret', compression=None)
+    def test_http_write_v2(self, influxdb_module, server):
+        influxdb_module.process_values(2, 'val1', dict(x=1), 1, {})
+        self.assertTrue(influxdb_module.flush(2))
+        path, headers, client_address, body = server.writes[0]
+        self.assertEqual(path, '/api/v2/write?org=myorg&bucket=testdb&precision=ns')
+        self.assertEqual(headers['Authorization'], 'Token secret')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(body, 'val1 x=1 1000000000')
+
+    def test_http_write_urls(self):
+        for precision, v1_precision in ('ns', 'n'), ('us', 'u'), ('ms', 'ms'), ('s', 's'):
+            cfg = dict(flush_interval=1, database='testdb', precision=precision)
+            influxdb_module = influxdb.InfluxDBHTTPClient('influxdb_test', cfg, None)
+            influxdb_module.init_cfg()
+            self.assertEqual(influxdb_module.write_url, '/write?db=testdb&precision=' + v1_precision)
+            cfg.update(api_version=2, org='myorg')
+            influxdb_module = influxdb.InfluxDBHTTPClient('influxdb_test', cfg, None)
+            influxdb_module.init_cfg()
+            self.assertEqual(influxdb_module.write_url, '/api/v2/write?org=myorg&bucket=testdb&precision=' + precision)
+
+    @influxdb_http_setup()
+    def test_http_backoff(self, influxdb_module, server):
+        server.responses.extend([(429, {'Retry-After': '30'}), (400, {})])
+        influxdb_module.process_values(2, 'val1', dict(x=1), 1, {})
+        self.assertFalse(influxdb_module.flush(2))
+        self.assertEqual(len(influxdb_module.buffer), 1)
+        self.assertEqual(influxdb_module.writes_throttled, 1)
+        # Held off, the buffer is retained
+        self.assertTrue(influxdb_module.flush(3))
+        self.assertEqual(len(server.writes), 1)
+        self.assertEqual(len(influxdb_module.buffer), 1)
+        influxdb_module.retry_deadline = 0
+        # Rejected, the lines are dropped
+        self.assertTrue(influxdb_module.flush(4))
+        self.assertEqual(len(server.writes), 2)
+        self.assertEqual(influxdb_module.buffer, [])
+        self.assertEqual(influxdb_module.writes_rejected, 1)
+
+    def distribution_test(self, influxdb_module, lines):
+        remote_hosts = [('10.0.0.1', 8086), ('10.0.0.2', 8086), ('10.0.0.3', 8086)]
+        influxdb_module.sock = MagicMock()
+        influxdb_module.resolve_remote_hosts = lambda: set(remote_hosts)
+        influxdb_module.push_chunk(lines)
+        sent = {}
+        for c in influxdb_module.sock.sendto.call_args_list:
+            sent.setdefault(c[0][1], []).extend(c[0][0].decode('utf-8').split('\n'))
+        return sent
+
+    @influxdb_setup(timestamps=range(1, 100), max_packet_size=100)
+    def test_broadcast_distribution(self, influxdb_module):
+        lines = ['val,host=h' + str(i) + ' x=' + str(i) for i in range(30)]
+        sent = self.distribution_test(influxdb_module, lines)
+        self.assertEqual(len(sent), 3)
+        for host_lines in sent.values():
+            self.assertEqual(host_lines, lines)
+
+    @influxdb_setup(timestamps=range(1, 100), max_packet_size=100, distribution='round_robin')
+    def test_round_robin_distribution(self, influxdb_module):
+        lines = ['val,host=h' + str(i) + ' x=' + str(i) for i in range(30)]
+        sent = self.distribution_test(influxdb_module, lines)
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(sorted(sum(sent.values(), [])), sorted(lines))
+        packets = [v[0] for v in influxdb_module.destination_stats.values()]
+        self.assertLessEqual(max(packets) - min(packets), 1)
+
+    @influxdb_setup(timestamps=range(1, 100), max_packet_size=100, distribution='hash')
+    def test_hash_distribution(self, influxdb_module):
+        lines = ['val,host=h' + str(i % 10) + r',path=a\ b x=' + str(i) for i in range(30)]
+        sent = self.distribution_test(influxdb_module, lines)
+        self.assertEqual(sorted(sum(sent.values(), [])), sorted(lines))
+        series_hosts = {}
+        for remote_host, host_lines in sent.items():
+            for line in host_lines:
+                series_hosts.setdefault(influxdb_module.series_key(line), set()).add(remote_host)
+        self.assertEqual(len(series_hosts), 10)
+        self.assertTrue(all(len(v) == 1 for v in series_hosts.values()))
+        self.assertEqual(influxdb_module.series_key(lines[0]), r'val,host=h0,path=a\ b')
+        reports = list(influxdb_module.produce_self_reports())
+        self.assertEqual(len(reports), 1 + len(sent))
+        self.assertEqual(
+            sum(stats['packets_sent'] for stats, metadata in reports[1:]), influxdb_module.packets_sent
+        )
+
+    @influxdb_setup(timestamps=range(1, 100), series_cache_size=3)
+    def test_series_cache(self, influxdb_module):
+        for i in range(5):
+            influxdb_module.process_values(2, 'val1', dict(x=i), 1, dict(host='h' + str(i % 4), a='b c'))
+        influxdb_module.process_values(2, 'val1', dict(x=1, s='q"uote'), 1, dict(host='h1', a='b c'))
+        influxdb_module.process_values(2, 'val1', dict(x=1), 1, dict(tags=['unhashable']))
+        self.assertLessEqual(len(influxdb_module.series_cache), 3)
+        return [
+            r'val1,a=b\ c,host=h0 x=0 1000000000',
+            r'val1,a=b\ c,host=h1 x=1 1000000000',
+            r'val1,a=b\ c,host=h2 x=2 1000000000',
+            r'val1,a=b\ c,host=h3 x=3 1000000000',
+            r'val1,a=b\ c,host=h0 x=4 1000000000',
+            r'val1,a=b\ c,host=h1 s="q\"uote",x=1 1000000000',
+            r"val1,tags=['unhashable'] x=1 1000000000",
+        ]
+
+    @influxdb_setup(timestamps=range(1, 100))
+    def test_series_cache_value_types(self, influxdb_module):
+        for v in 1, True, 1.0, '1':
+            influxdb_module.process_values(2, 'val1', dict(x=1), 1, dict(a=v))
+        influxdb_module.process_values(2, 'val1', dict(x=1), 1, dict(a=True))
+        self.assertEqual(len(influxdb_module.series_cache), 4)
+        return [
+            'val1,a=1 x=1 1000000000',
+            'val1,a=True x=1 1000000000',
+            'val1,a=1.0 x=1 1000000000',
+            'val1,a=1 x=1 1000000000',
+            'val1,a=True x=1 1000000000',
+        ]
+
+    def encoding_performance(self, influxdb_module, prefix, metrics_count, flushes_count):
+        # Roughly what linux_stats produces for a 16 cores host
+        test_set = [
+            ('system_cpu', {k: 1234567 + i for k in ('user', 'nice', 'system', 'idle', 'wait', 'interrupt')},
+             None, {'name': 'cpu' + str(i % 16), 'host': 'myhost.mydomain', 'env': 'prod'})
+            for i in range(metrics_count)
+        ]
+        total_time = 0
+        for i in range(flushes_count):
+            influxdb_module.buffer = []
+            # Fresh copies, like the ones unpickled from the source modules
+            batch = [(b, dict(v), t, dict(m)) for b, v, t, m in test_set]
+            start_time = time.process_time()
+            for bucket, values, timestamp, metadata in batch:
+                influxdb_module.process_values(1, bucket, values, timestamp, metadata)
+            total_time += time.process_time() - start_time
+        total_lines = metrics_count * flushes_count
+        print('\n{prefix}: {total_lines:d} lines in {total_time:.2f}s -> {us_per_line:.2f}us/line'.format(
+            prefix=prefix, total_lines=total_lines, total_time=total_time,
+            us_per_line=1000000 * total_time / total_lines
+        ), flush=True, file=sys.stderr)
+
+    @influxdb_setup(timestamps=range(1, 100))
+    def test_encoding_performance(self, influxdb_module):
+        self.prepare_performance_test()
+        process_values = influxdb_module.process_values
+        influxdb_module.process_values = lambda *args: legacy_process_values(influxdb_module, *args)
+        self.encoding_performance(influxdb_module, "line encoding, before caching", 1000, 100)
+        influxdb_module.process_values = process_values
+        self.encoding_performance(influxdb_module, "line encoding, with caching", 1000, 100)
+
 
 if __name__ == '__main__':
     unittest.main()
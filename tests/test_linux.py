@@ -0,0 +1,364 @@
+
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import bucky3.linux as linux
+from helpers import MetricsPipe, PerformanceTestCase
+
+
+# Recorded from a live system
+FIXTURES_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'proc')
+
+
+def linux_setup(**extra_cfg):
+    def wrapper(fun):
+        def run(self):
+            cfg = dict(flush_interval=1, log_level='ERROR', destination_modules=())
+            cfg.update(**extra_cfg)
+            linux_module = linux.LinuxStatsCollector('linux_test', cfg, [MetricsPipe()])
+            linux_module.init_cfg()
+            fun(self, linux_module)
+
+        return run
+
+    return wrapper
+
+
+# The readers as they were before the parse plans, for comparison
+def legacy_read_disk_stats(linux_module, buffer, timestamp):
+    with open(linux_module.procfs_root + '/diskstats') as f:
+        for l in f:
+            tokens = l.strip().split()
+            if not tokens or len(tokens) < 3:
+                continue
+            disk_name = tokens[2]
+            if not linux_module.check_lists(disk_name, linux_module.disk_blacklist, linux_module.disk_whitelist):
+                continue
+            disk_stats = {k: int(v) for k, v in zip(linux_module.DISK_FIELDS, tokens[3:])}
+            for k in linux_module.DISK_FIELDS:
+                if k.endswith('_sectors') and k in disk_stats:
+                    disk_stats[k[:-7] + 'bytes'] = disk_stats[k] * 512
+            buffer.append(("system_disk", disk_stats, timestamp, {'name': disk_name}))
+
+
+def legacy_read_protocol_stats(linux_module, buffer, timestamp):
+    param_map, proto_stats = {}, {}
+    for p in linux_module.procfs_root + '/net/snmp', linux_module.procfs_root + '/net/netstat':
+        with open(p) as f:
+            for l in f:
+                tokens = l.strip().split()
+                if not tokens:
+                    continue
+                name = tokens.pop(0)
+                if name in param_map:
+                    for k, v in zip(param_map[name], tokens):
+                        k = name + k
+                        if k in linux_module.PROTOCOL_FIELDS:
+                            proto, value = linux_module.PROTOCOL_FIELDS[k]
+                            bucket = proto_stats.get(proto)
+                            if not bucket:
+                                bucket = proto_stats[proto] = {}
+                            bucket[value] = int(v)
+                else:
+                    param_map[name] = tokens
+    for k, v in proto_stats.items():
+        buffer.append(("system_protocol", v, timestamp, {'name': k}))
+
+
+class TestLinuxStatsCollector(PerformanceTestCase):
+    @linux_setup()
+    def test_counter_delta(self, linux_module):
+        self.assertEqual(linux_module.counter_delta(100, 150), 50)
+        self.assertEqual(linux_module.counter_delta(100, 100), 0)
+        # 32 bit wrap around
+        self.assertEqual(linux_module.counter_delta(2 ** 32 - 10, 5), 15)
+        # Reset
+        self.assertEqual(linux_module.counter_delta(1000, 5), 5)
+        self.assertEqual(linux_module.counter_delta(2 ** 40, 5), 5)
+
+    @linux_setup(counter_mode='delta')
+    def test_delta_mode(self, linux_module):
+        def sample(cpu_user, cpu_idle, rx_bytes, in_progress):
+            return [
+                ('system_cpu', {'user': cpu_user, 'idle': cpu_idle}, None, {'name': 'cpu0'}),
+                ('system_interface', {'rx_bytes': rx_bytes}, None, {'name': 'eth0'}),
+                ('system_disk', {'read_ops': 10, 'in_progress': in_progress}, None, {'name': 'sda'}),
+                ('system_memory', {'free_bytes': 1000}, None, None),
+            ]
+
+        self.assertEqual(linux_module.derive_counters(sample(100, 300, 1000, 3), 10), [
+            ('system_disk', {'in_progress': 3}, None, {'name': 'sda'}),
+            ('system_memory', {'free_bytes': 1000}, None, None),
+        ])
+        self.assertEqual(linux_module.derive_counters(sample(130, 400, 1500, 1), 20), [
+            ('system_cpu', {'user': 23.08, 'idle': 76.92}, None, {'name': 'cpu0'}),
+            ('system_interface', {'rx_bytes': 500}, None, {'name': 'eth0'}),
+            ('system_disk', {'read_ops': 0, 'in_progress': 1}, None, {'name': 'sda'}),
+            ('system_memory', {'free_bytes': 1000}, None, None),
+        ])
+        # The interface counter was reset, no CPU time passed, eth1 is new and eth0 gone
+        buffer = sample(130, 400, 200, 1)
+        buffer[1] = ('system_interface', {'rx_bytes': 7}, None, {'name': 'eth1'})
+        self.assertEqual(linux_module.derive_counters(buffer, 30), [
+            ('system_disk', {'read_ops': 0, 'in_progress': 1}, None, {'name': 'sda'}),
+            ('system_memory', {'free_bytes': 1000}, None, None),
+        ])
+        self.assertEqual(set(linux_module.previous_counters), {
+            ('system_cpu', 'cpu0'), ('system_interface', 'eth1'), ('system_disk', 'sda'),
+        })
+        buffer = sample(140, 410, 0, 1)
+        buffer[1] = ('system_interface', {'rx_bytes': 2}, None, {'name': 'eth1'})
+        self.assertEqual(linux_module.derive_counters(buffer, 40)[1], (
+            'system_interface', {'rx_bytes': 2}, None, {'name': 'eth1'}
+        ))
+
+    @linux_setup(counter_mode='rate')
+    def test_rate_mode(self, linux_module):
+        linux_module.derive_counters([
+            ('system_activity', {'switches': 1000, 'load': 0.5}, None, None),
+            ('system_protocol', {'rx_packets': 100, 'conn_count': 10}, None, {'name': 'tcp'}),
+        ], 10)
+        self.assertEqual(linux_module.derive_counters([
+            ('system_activity', {'switches': 3000, 'load': 1.5}, None, None),
+            ('system_protocol', {'rx_packets': 150, 'conn_count': 12}, None, {'name': 'tcp'}),
+        ], 14), [
+            ('system_activity', {'switches': 500.0, 'load': 1.5}, None, None),
+            ('system_protocol', {'rx_packets': 12.5, 'conn_count': 12}, None, {'name': 'tcp'}),
+        ])
+
+    @linux_setup(counter_mode='deltas')
+    def test_unknown_counter_mode(self, linux_module):
+        self.assertEqual(linux_module.counter_mode, 'raw')
+        self.assertTrue(linux_module.flush(1))
+        self.assertIn('system_cpu', set(m[0] for m in linux_module.dst_pipes[0]))
+
+    @linux_setup(counter_mode='rate')
+    def test_flush_rates(self, linux_module):
+        self.assertTrue(linux_module.flush(1))
+        buckets = set(m[0] for m in linux_module.dst_pipes[0])
+        self.assertNotIn('system_cpu', buckets)
+        self.assertIn('system_memory', buckets)
+        linux_module.dst_pipes[0].clear()
+        time.sleep(0.2)
+        # Burn some CPU, so there is a difference to compute
+        t = time.process_time()
+        while time.process_time() - t < 0.05:
+            pass
+        self.assertTrue(linux_module.flush(2))
+        cpu_stats = [m[1] for m in linux_module.dst_pipes[0] if m[0] == 'system_cpu']
+        self.assertTrue(cpu_stats)
+        for stats in cpu_stats:
+            self.assertAlmostEqual(sum(stats.values()), 100, delta=0.1)
+        activity_stats = [m[1] for m in linux_module.dst_pipes[0] if m[0] == 'system_activity']
+        self.assertGreater(activity_stats[0]['switches'], 0)
+
+    @linux_setup()
+    def test_pressure_and_vmstat(self, linux_module):
+        buffer = []
+        linux_module.read_pressure_stats(buffer, None)
+        linux_module.read_vmstat_stats(buffer, None)
+        pressure_stats = {m[3]['name']: m[1] for m in buffer if m[0] == 'system_pressure'}
+        if os.path.exists('/proc/pressure/cpu'):
+            self.assertEqual(set(pressure_stats), {'cpu', 'memory', 'io'})
+            self.assertIn('some_avg10', pressure_stats['memory'])
+            self.assertIn('full_total', pressure_stats['memory'])
+        vmstat_stats = [m[1] for m in buffer if m[0] == 'system_vmstat']
+        self.assertEqual(len(vmstat_stats), 1)
+        self.assertLessEqual(set(vmstat_stats[0]), set(linux_module.VMSTAT_FIELDS))
+        self.assertIn('pgfault', vmstat_stats[0])
+        # The lists are checked once per field
+        self.assertGreater(len(linux_module.vmstat_fields), len(vmstat_stats[0]))
+        self.assertTrue(linux_module.vmstat_fields['pgmajfault'])
+        self.assertFalse(linux_module.vmstat_fields['nr_free_pages'])
+
+    @linux_setup(pressure_blacklist={'cpu'}, vmstat_whitelist={'nr_free_pages', 'pgfault'}, counter_mode='delta')
+    def test_pressure_and_vmstat_lists(self, linux_module):
+        self.assertEqual(linux_module.pressure_resources, ['memory', 'io'])
+        read_nested_key_values = linux_module.read_nested_key_values
+
+        def fake_pressure(path):
+            if path.endswith('/io'):
+                raise OSError(95, 'Operation not supported')
+            return read_nested_key_values(os.path.join(tmp_dir, 'memory'))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmp_dir, 'memory'), 'w') as f:
+                f.write('some avg10=1.00 avg60=0.50 avg300=0.10 total=1000\n'
+                        'full avg10=0.00 avg60=0.00 avg300=0.00 total=400\n')
+            linux_module.read_nested_key_values = fake_pressure
+            buffer = []
+            linux_module.read_pressure_stats(buffer, None)
+            linux_module.read_vmstat_stats(buffer, None)
+            # Unsupported resources are not tried again
+            self.assertEqual(linux_module.pressure_resources, ['memory'])
+            self.assertEqual(linux_module.derive_counters(buffer, 10)[0], ('system_pressure', {
+                'some_avg10': 1.0, 'some_avg60': 0.5, 'some_avg300': 0.1,
+                'full_avg10': 0.0, 'full_avg60': 0.0, 'full_avg300': 0.0,
+            }, None, {'name': 'memory'}))
+            with open(os.path.join(tmp_dir, 'memory'), 'w') as f:
+                f.write('some avg10=2.00 avg60=0.50 avg300=0.10 total=1500\n'
+                        'full avg10=0.00 avg60=0.00 avg300=0.00 total=400\n')
+            buffer = []
+            linux_module.read_pressure_stats(buffer, None)
+            linux_module.read_vmstat_stats(buffer, None)
+            vmstat_stats = buffer[1][1]
+            self.assertEqual(set(vmstat_stats), {'nr_free_pages', 'pgfault'})
+            derived_buffer = linux_module.derive_counters(buffer, 20)
+            self.assertEqual(derived_buffer[0][1]['some_total'], 500)
+            self.assertEqual(derived_buffer[0][1]['some_avg10'], 2.0)
+            # A gauge, it is sent as it is
+            self.assertEqual(derived_buffer[1][1]['nr_free_pages'], vmstat_stats['nr_free_pages'])
+            self.assertLess(derived_buffer[1][1]['pgfault'], vmstat_stats['pgfault'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @linux_setup()
+    def test_snmp6(self, linux_module):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'snmp6')
+            with open(path, 'w') as f:
+                f.write('Ip6InReceives                   \t1000\n'
+                        'Ip6InHdrErrors                  \t0\n'
+                        'Ip6InOctets                     \t123456\n'
+                        'Ip6OutRequests                  \t900\n'
+                        'Icmp6InMsgs                     \t7\n'
+                        'Icmp6InType135                  \t3\n'
+                        'Udp6InDatagrams                 \t50\n'
+                        'Udp6RcvbufErrors                \t1\n'
+                        'UdpLite6InDatagrams             \t0\n')
+            self.assertEqual(list(linux_module.read_snmp6(path)), [
+                (('ip6', 'rx_packets'), 1000),
+                (('ip6', 'rx_bytes'), 123456),
+                (('ip6', 'tx_packets'), 900),
+                (('icmp6', 'rx_packets'), 7),
+                (('udp6', 'rx_packets'), 50),
+                (('udp6', 'rcvbuf_errors'), 1),
+            ])
+        finally:
+            shutil.rmtree(tmp_dir)
+        buffer = []
+        linux_module.read_protocol_stats(buffer, None)
+        protocols = {m[3]['name']: m[1] for m in buffer}
+        self.assertIn('tcp', protocols)
+        if os.path.exists('/proc/net/snmp6'):
+            self.assertIn('ip6', protocols)
+            self.assertIn('rx_packets', protocols['udp6'])
+        # Without IPv6
+        linux_module.read_snmp6 = lambda path: open(os.path.join(tmp_dir, 'snmp6'))
+        buffer = []
+        linux_module.read_protocol_stats(buffer, None)
+        self.assertNotIn('ip6', [m[3]['name'] for m in buffer])
+        self.assertFalse(linux_module.snmp6_available)
+
+    def read(self, linux_module, reader):
+        buffer = []
+        reader(buffer, None)
+        return buffer
+
+    @linux_setup(procfs_root=FIXTURES_ROOT, disk_blacklist={r'loop\d+'})
+    def test_parse_plans(self, linux_module):
+        disk_stats = self.read(linux_module, linux_module.read_disk_stats)
+        self.assertTrue(disk_stats)
+        self.assertEqual(disk_stats, self.read(
+            linux_module, lambda *args: legacy_read_disk_stats(linux_module, *args)
+        ))
+        self.assertEqual(disk_stats, self.read(linux_module, linux_module.read_disk_stats))
+        self.assertEqual(set(disk_stats[0][1]) - set(linux_module.DISK_FIELDS), {
+            'read_bytes', 'write_bytes', 'discard_bytes',
+        })
+        self.assertEqual(list(linux_module.disk_plans), [20])
+        self.assertFalse(linux_module.disk_names['loop0'])
+        # snmp6 is compared separately
+        linux_module.snmp6_available = False
+        protocol_stats = self.read(linux_module, linux_module.read_protocol_stats)
+        self.assertEqual(set(m[3]['name'] for m in protocol_stats), {'ip', 'icmp', 'tcp', 'udp'})
+        self.assertEqual(protocol_stats, self.read(
+            linux_module, lambda *args: legacy_read_protocol_stats(linux_module, *args)
+        ))
+        self.assertEqual(protocol_stats, self.read(linux_module, linux_module.read_protocol_stats))
+
+    @linux_setup()
+    def test_parse_plans_rebuilt(self, linux_module):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            linux_module.procfs_root = tmp_dir
+            os.makedirs(os.path.join(tmp_dir, 'net'))
+            with open(os.path.join(tmp_dir, 'net', 'netstat'), 'w') as f:
+                f.write('TcpExt: SyncookiesSent SyncookiesRecv\nTcpExt: 1 2\n')
+            with open(os.path.join(tmp_dir, 'diskstats'), 'w') as f:
+                f.write('   8       0 sda 1 2 3 4 5 6 7 8 9 10 11\n')
+            for snmp in ('Udp: InDatagrams NoPorts InErrors\nUdp: 10 20 30\n',
+                         'Udp: InErrors InDatagrams\nUdp: 3 1\n'):
+                with open(os.path.join(tmp_dir, 'net', 'snmp'), 'w') as f:
+                    f.write(snmp)
+                self.assertEqual(
+                    self.read(linux_module, linux_module.read_protocol_stats),
+                    self.read(linux_module, lambda *args: legacy_read_protocol_stats(linux_module, *args))
+                )
+            self.assertEqual(self.read(linux_module, linux_module.read_protocol_stats), [
+                ('system_protocol', {'rx_errors': 3, 'rx_packets': 1}, None, {'name': 'udp'}),
+                ('system_protocol', {'rx_syncookies': 2, 'tx_syncookies': 1}, None, {'name': 'tcp'}),
+            ])
+            # An older kernel, with fewer columns
+            self.assertEqual(self.read(linux_module, linux_module.read_disk_stats), [('system_disk', {
+                'read_ops': 1, 'read_merged': 2, 'read_sectors': 3, 'read_time': 4,
+                'write_ops': 5, 'write_merged': 6, 'write_sectors': 7, 'write_time': 8,
+                'in_progress': 9, 'io_time': 10, 'weighted_time': 11,
+                'read_bytes': 3 * 512, 'write_bytes': 7 * 512,
+            }, None, {'name': 'sda'})])
+            # Gone devices are dropped from the disk names
+            with open(os.path.join(tmp_dir, 'diskstats'), 'w') as f:
+                f.write('   7       0 loop0 1 2 3 4 5 6 7 8 9 10 11\n')
+            self.assertEqual(self.read(linux_module, linux_module.read_disk_stats)[0][3], {'name': 'loop0'})
+            self.assertEqual(linux_module.disk_names, {'loop0': True})
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @linux_setup(procfs_root=FIXTURES_ROOT)
+    def test_fixtures(self, linux_module):
+        linux_module.read_filesystem_stats = lambda buffer, timestamp: None
+        self.assertTrue(linux_module.flush(1))
+        buckets = set(m[0] for m in linux_module.dst_pipes[0])
+        self.assertEqual(buckets, {
+            'system_activity', 'system_cpu', 'system_memory', 'system_interface', 'system_disk',
+            'system_protocol', 'system_pressure', 'system_vmstat',
+        })
+        protocols = set(m[3]['name'] for m in linux_module.dst_pipes[0] if m[0] == 'system_protocol')
+        self.assertEqual(protocols, {'ip', 'icmp', 'tcp', 'udp', 'ip6', 'icmp6', 'udp6'})
+
+    def reader_performance(self, linux_module, name, reader, calls):
+        buffer = []
+        reader(buffer, None)
+        t = time.process_time()
+        for _ in range(calls):
+            buffer.clear()
+            reader(buffer, None)
+        t = time.process_time() - t
+        print("\n{} reader: {:.1f}us/call".format(name, 1000000 * t / calls))
+
+    @linux_setup(procfs_root=FIXTURES_ROOT)
+    def test_readers_performance(self, linux_module):
+        self.prepare_performance_test()
+        self.reader_performance(linux_module, "disk, before parse plans",
+                                lambda *args: legacy_read_disk_stats(linux_module, *args), 10000)
+        self.reader_performance(linux_module, "disk", linux_module.read_disk_stats, 10000)
+        snmp6_available, linux_module.snmp6_available = linux_module.snmp6_available, False
+        self.reader_performance(linux_module, "protocol, before parse plans",
+                                lambda *args: legacy_read_protocol_stats(linux_module, *args), 10000)
+        self.reader_performance(linux_module, "protocol, without snmp6", linux_module.read_protocol_stats, 10000)
+        linux_module.snmp6_available = snmp6_available
+        self.reader_performance(linux_module, "protocol", linux_module.read_protocol_stats, 10000)
+        self.reader_performance(linux_module, "activity", linux_module.read_activity_stats, 10000)
+        self.reader_performance(linux_module, "memory", linux_module.read_memory_stats, 10000)
+        self.reader_performance(linux_module, "interface", linux_module.read_interface_stats, 10000)
+        self.reader_performance(linux_module, "pressure", linux_module.read_pressure_stats, 10000)
+        self.reader_performance(linux_module, "vmstat", linux_module.read_vmstat_stats, 10000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+import unittest
+import bucky3.process as process
+from helpers import MetricsPipe, PerformanceTestCase
+
+
+def process_setup(**extra_cfg):
+    def wrapper(fun):
+        def run(self):
+            cfg = dict(flush_interval=1, log_level='ERROR', destination_modules=())
+            cfg.update(**extra_cfg)
+            process_module = process.ProcessStatsCollector('process_test', cfg, [MetricsPipe()])
+            process_module.init_cfg()
+            children = []
+            try:
+                fun(self, process_module, children)
+            finally:
+                for child in children:
+                    child.kill()
+                    child.wait()
+                for p in process_module.processes.values():
+                    process_module.close_process(p)
+
+        return run
+
+    return wrapper
+
+
+class TestProcessStatsCollector(PerformanceTestCase):
+    def spawn(self, children, code):
+        child = subprocess.Popen([sys.executable, '-c', code])
+        children.append(child)
+        return str(child.pid)
+
+    def emitted(self, process_module, bucket):
+        return {m[3]['pid']: m[1] for m in process_module.dst_pipes[0] if m[0] == bucket}
+
+    @process_setup(top_processes=5)
+    def test_top_processes(self, process_module, children):
+        busy_pid = self.spawn(children, 'while True: pass')
+        big_pid = self.spawn(children, 'import time; x = b"x" * (64 * 1024 * 1024); time.sleep(60)')
+        idle_pid = self.spawn(children, 'import time; time.sleep(60)')
+        time.sleep(0.5)
+        self.assertTrue(process_module.flush(1))
+        time.sleep(0.5)
+        process_module.dst_pipes[0].clear()
+        self.assertTrue(process_module.flush(2))
+        cpu_stats = self.emitted(process_module, 'process_cpu')
+        memory_stats = self.emitted(process_module, 'process_memory')
+        self.assertIn(busy_pid, cpu_stats)
+        self.assertIn(big_pid, memory_stats)
+        # Everything else hardly uses any CPU on a quiet host, so it may make the top 5 as well
+        self.assertEqual(max(process_module.processes.values(), key=lambda p: p.cpu_delta).pid, busy_pid)
+        self.assertEqual(process_module.processes[idle_pid].cpu_delta, 0)
+        self.assertGreater(cpu_stats[busy_pid]['user'], 0)
+        self.assertEqual(cpu_stats[busy_pid]['threads'], 1)
+        self.assertIn('voluntary_switches', cpu_stats[busy_pid])
+        self.assertGreater(memory_stats[big_pid]['rss_bytes'], 64 * 1024 * 1024)
+        # Own processes, so io and fd are accessible
+        io_stats = self.emitted(process_module, 'process_io')
+        self.assertGreaterEqual(io_stats[busy_pid]['open_files'], 3)
+        self.assertIn('read_chars', io_stats[busy_pid])
+        names = {m[3]['pid']: m[3]['name'] for m in process_module.dst_pipes[0]}
+        self.assertEqual(names[busy_pid], os.path.basename(sys.executable)[:15])
+        self.assertLessEqual(len(cpu_stats), 10)
+
+    @process_setup(top_processes=0, process_whitelist={'bucky3_sleeper'}, max_cached_handles=100000)
+    def test_whitelist_and_handles(self, process_module, children):
+        # A name no other process on the host has, it is set before the child goes to sleep
+        sleep_pid = self.spawn(children, 'import time\n'
+                                         'with open("/proc/self/comm", "w") as f: f.write("bucky3_sleeper")\n'
+                                         'time.sleep(60)')
+        sleep_child = children[-1]
+        self.spawn(children, 'while True: pass')
+        time.sleep(0.5)
+        self.assertTrue(process_module.flush(1))
+        cpu_stats = self.emitted(process_module, 'process_cpu')
+        self.assertEqual(list(cpu_stats), [sleep_pid])
+        # Handles are kept open across scans
+        state = process_module.processes[sleep_pid]
+        handles = dict(state.handles)
+        self.assertEqual(set(handles), {'stat', 'status', 'io'})
+        self.assertTrue(process_module.flush(2))
+        self.assertIs(process_module.processes[sleep_pid], state)
+        self.assertEqual(state.handles, handles)
+        cached_handles = process_module.cached_handles
+        self.assertEqual(cached_handles, len(process_module.processes) + 2)
+        # And closed when the process is gone
+        sleep_child.kill()
+        sleep_child.wait()
+        self.assertTrue(process_module.flush(3))
+        self.assertNotIn(sleep_pid, process_module.processes)
+        self.assertEqual(process_module.cached_handles, cached_handles - 3)
+        self_report = process_module.produce_self_report()
+        self.assertEqual(self_report['processes'], len(process_module.processes))
+
+    @process_setup(top_processes=1, max_cached_handles=0)
+    def test_uncached_handles(self, process_module, children):
+        busy_pid = self.spawn(children, 'while True: pass')
+        time.sleep(0.2)
+        self.assertTrue(process_module.flush(1))
+        self.assertTrue(process_module.flush(2))
+        self.assertEqual(process_module.cached_handles, 0)
+        self.assertIn(busy_pid, process_module.processes)
+
+    @process_setup(max_cached_handles=10 ** 9)
+    def test_cached_handles_limit(self, process_module, children):
+        # Half of the descriptors are left to everything else
+        soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft_limit != resource.RLIM_INFINITY:
+            self.assertEqual(process_module.max_cached_handles, soft_limit // 2)
+
+    @process_setup(top_processes=10)
+    def test_scan_performance(self, process_module, children):
+        self.prepare_performance_test()
+        for cached_handles in 0, 100000:
+            process_module.max_cached_handles = cached_handles
+            process_module.flush(1)
+            scans = 100
+            t = time.process_time()
+            for i in range(scans):
+                process_module.flush(i)
+                process_module.dst_pipes[0].clear()
+            t = time.process_time() - t
+            print("\nprocess scan, max_cached_handles={}: {:.1f}us/process, {} processes".format(
+                cached_handles, 1000000 * t / scans / len(process_module.processes), len(process_module.processes)
+            ))
+
+    def synthetic_procfs(self, procfs_root, processes_count):
+        # Enough of /proc/<pid> for the scan, the stat fields after "(comm) " are just their indexes
+        stat_tail = ' '.join(str(i) for i in range(50))
+        for i in range(processes_count):
+            path = os.path.join(procfs_root, str(1000 + i))
+            os.makedirs(os.path.join(path, 'fd'))
+            with open(os.path.join(path, 'stat'), 'w') as f:
+                f.write('{} (worker {}) {}\n'.format(1000 + i, i, stat_tail))
+            with open(os.path.join(path, 'status'), 'w') as f:
+                f.write('Name:\tworker\nVmSwap:\t0 kB\nvoluntary_ctxt_switches:\t{}\n'.format(i))
+            with open(os.path.join(path, 'io'), 'w') as f:
+                f.write('rchar: {}\nwchar: {}\nread_bytes: 0\nwrite_bytes: 0\n'.format(i, i))
+
+    @process_setup(top_processes=10)
+    def test_synthetic_scan_performance(self, process_module, children):
+        self.prepare_performance_test()
+        # A busy host, way beyond the processes of a test sandbox
+        processes_count = 10000
+        # Only the stat handles stay open for most processes, but they have to fit in the limit
+        max_cached_handles = resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 100
+        with tempfile.TemporaryDirectory() as procfs_root:
+            self.synthetic_procfs(procfs_root, processes_count)
+            process_module.procfs_root = procfs_root
+            for cached_handles in 0, max_cached_handles:
+                process_module.max_cached_handles = cached_handles
+                process_module.flush(1)
+                self.assertEqual(len(process_module.processes), processes_count)
+                scans = 10
+                t = time.process_time()
+                for i in range(scans):
+                    process_module.flush(i)
+                    process_module.dst_pipes[0].clear()
+                t = time.process_time() - t
+                print("\nsynthetic process scan, max_cached_handles={}: {:.1f}us/process, {} processes".format(
+                    cached_handles, 1000000 * t / scans / processes_count, processes_count
+                ))
+                for p in process_module.processes.values():
+                    process_module.close_process(p)
+                process_module.processes = {}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,14 @@
 
 
 import re
+import sys
+import time
+import struct
 import unittest
+import tracemalloc
 from unittest.mock import patch
 import bucky3.prometheus as prometheus
+from helpers import PerformanceTestCase
 
 
 def prometheus_verify(prometheus_module, expected_values):
@@ -34,6 +39,55 @@ def prometheus_verify(prometheus_module, expected_values):
         assert False, "missing " + str(expected_values.pop())
 
 
+def decode_varint(buf, pos):
+    value, shift = 0, 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            return value, pos
+
+
+def decode_message(buf):
+    # Returns {field_number: [values]}, only wire types used by the exporter are handled.
+    fields, pos = {}, 0
+    while pos < len(buf):
+        key, pos = decode_varint(buf, pos)
+        field_number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = decode_varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = struct.unpack('<d', buf[pos:pos + 8])[0], pos + 8
+        elif wire_type == 2:
+            length, pos = decode_varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        else:
+            assert False, "unexpected wire type " + str(wire_type)
+        fields.setdefault(field_number, []).append(value)
+    return fields
+
+
+def prometheus_decode_protobuf(page):
+    found_values, pos = [], 0
+    while pos < len(page):
+        length, pos = decode_varint(page, pos)
+        family, pos = decode_message(page[pos:pos + length]), pos + length
+        assert family[3] == [3]
+        bucket_name = family[1][0].decode('utf-8')
+        for m in family[4]:
+            metric = decode_message(m)
+            metadata = {}
+            for l in metric.get(1, []):
+                label = decode_message(l)
+                metadata[label[1][0].decode('utf-8')] = label[2][0].decode('utf-8')
+            value = decode_message(metric[5][0])[1][0]
+            timestamp = metric[6][0] / 1000 if 6 in metric else None
+            found_values.append((bucket_name, metadata, value, timestamp))
+    return found_values
+
+
 def prometheus_setup(timestamps, **extra_cfg):
     def run(fun, self):
         with patch('time.time') as system_time:
@@ -59,7 +113,7 @@ def prometheus_setup(timestamps, **extra_cfg):
         return wrapper
 
 
-class TestPrometheusExporter(unittest.TestCase):
+class TestPrometheusExporter(PerformanceTestCase):
     @prometheus_setup(values_timeout=2, timestamps=range(1, 100))
     def test_simple_multi_values(self, prometheus_module):
         prometheus_module.process_values(1, 'val1', dict(x=1, y=2), 1, {})
@@ -137,6 +191,147 @@ class TestPrometheusExporter(unittest.TestCase):
             ('val1', dict(value='y', a='b', b='123'), 20, 1),
         ])
 
+    @prometheus_setup(timestamps=range(1, 100))
+    def test_openmetrics(self, prometheus_module):
+        prometheus_module.process_values(1, 'val1', dict(x=1, y=2.5), 1, dict(a='b'))
+        prometheus_module.process_values(1, 'val2', dict(x=3), None, dict(a='q"uo\\te'))
+        prometheus_module.process_values(1, 'val1', dict(x=4), 1.5, dict(a='c'))
+        lines = prometheus_module.get_page('openmetrics').split('\n')
+        self.assertEqual(lines, [
+            '# TYPE val1 unknown',
+            'val1{a="b",value="x"} 1 1',
+            'val1{a="b",value="y"} 2.5 1',
+            'val1{a="c",value="x"} 4 1.5',
+            '# TYPE val2 unknown',
+            'val2{a="q\\"uo\\\\te",value="x"} 3',
+            '# EOF',
+            '',
+        ])
+
+    @prometheus_setup(timestamps=range(1, 100))
+    def test_protobuf(self, prometheus_module):
+        prometheus_module.process_values(1, 'val1', dict(x=1, y=2.5), 1, dict(a='b', b='123'))
+        prometheus_module.process_values(1, 'val2', dict(x=-3), None, dict(foo='bär'))
+        prometheus_module.process_values(1, 'val1', dict(x=1000), 1234567890.123, dict(a='b', b='123'))
+        found_values = prometheus_decode_protobuf(prometheus_module.get_page('protobuf'))
+        self.assertEqual(sorted(found_values, key=str), sorted([
+            ('val1', dict(value='x', a='b', b='123'), 1000, 1234567890.123),
+            ('val1', dict(value='y', a='b', b='123'), 2.5, 1),
+            ('val2', dict(value='x', foo='bär'), -3, None),
+        ], key=str))
+
+    @prometheus_setup(timestamps=range(1, 100))
+    def test_format_negotiation(self, prometheus_module):
+        negotiate = prometheus_module.negotiate_format
+        self.assertEqual(negotiate(''), 'text')
+        self.assertEqual(negotiate('*/*'), 'text')
+        self.assertEqual(negotiate('text/plain;version=0.0.4'), 'text')
+        self.assertEqual(negotiate('application/json'), 'text')
+        self.assertEqual(negotiate(
+            'application/openmetrics-text;version=1.0.0,application/openmetrics-text;version=0.0.1;q=0.75,'
+            'text/plain;version=0.0.4;q=0.5,*/*;q=0.1'
+        ), 'openmetrics')
+        self.assertEqual(negotiate(
+            'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited;q=0.7,'
+            'text/plain;version=0.0.4;q=0.3,*/*;q=0.1'
+        ), 'protobuf')
+        self.assertEqual(negotiate('application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily'), 'text')
+
+    @prometheus_setup(timestamps=range(1, 100), exposition_formats=('text',))
+    def test_restricted_formats(self, prometheus_module):
+        self.assertEqual(prometheus_module.negotiate_format('application/openmetrics-text;version=1.0.0'), 'text')
+
+    @prometheus_setup(values_timeout=2, timestamps=range(1, 100))
+    def test_etag(self, prometheus_module):
+        etag1 = prometheus_module.get_etag('text', 'identity')
+        prometheus_module.process_values(1, 'val1', dict(x=1), 1, {})
+        etag2 = prometheus_module.get_etag('text', 'identity')
+        self.assertNotEqual(etag1, etag2)
+        self.assertEqual(etag2, prometheus_module.get_etag('text', 'identity'))
+        self.assertNotEqual(etag2, prometheus_module.get_etag('text', 'gzip'))
+        self.assertNotEqual(etag2, prometheus_module.get_etag('protobuf', 'identity'))
+        self.assertTrue(prometheus_module.check_etag(etag2, etag2))
+        self.assertTrue(prometheus_module.check_etag(etag2, '"foo", W/' + etag2))
+        self.assertFalse(prometheus_module.check_etag(etag2, etag1))
+        self.assertFalse(prometheus_module.check_etag(etag2, None))
+        prometheus_module.flush(2)
+        self.assertEqual(etag2, prometheus_module.get_etag('text', 'identity'))
+        prometheus_module.flush(4)
+        self.assertNotEqual(etag2, prometheus_module.get_etag('text', 'identity'))
+
+    @prometheus_setup(values_timeout=2, timestamps=range(1, 100))
+    def test_series_store(self, prometheus_module):
+        store = prometheus_module.buffer
+        prometheus_module.process_values(1, 'val1', dict(x=1, y=2, s='str'), 1, dict(a='b'))
+        prometheus_module.process_values(2, 'val1', dict(x=3, z=4), 2, dict(a='b'))
+        prometheus_module.process_values(1, 'val2', dict(x=5), None, dict(a='b'))
+        prometheus_module.process_values(1, 'val2', dict(s='str'), None, dict(a='c'))
+        self.assertEqual(len(store), 4)
+        self.assertEqual(len(store.label_sets), 1)
+        prometheus_module.flush(4)
+        self.assertEqual(len(store), 2)
+        prometheus_module.process_values(4, 'val3', dict(x=6, y=7), 4, {})
+        self.assertEqual(len(store), 4)
+        self.assertEqual(len(store.slot_rows), 4)
+        self.assertEqual(store.rows_count, 2)
+        prometheus_verify(prometheus_module, [
+            ('val1', dict(value='x', a='b'), 3, 2),
+            ('val1', dict(value='z', a='b'), 4, 2),
+            ('val3', dict(value='x'), 6, 4),
+            ('val3', dict(value='y'), 7, 4),
+        ])
+        prometheus_module.flush(10)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.label_sets, {})
+        self.assertEqual(store.families, {})
+        self.assertEqual(store.label_sets_bytes, 0)
+        self.assertEqual(store.rows_count, 0)
+
+    def memory_test_set(self, metrics_count, values_count):
+        for i in range(metrics_count):
+            metadata = dict(host='host' + str(i % 50), env='prod', app='webapp', name='cpu' + str(i))
+            values = {'field' + str(j): float(i * j) for j in range(values_count)}
+            yield 'system_cpu', values, metadata
+
+    def legacy_memory_usage(self, metrics_count, values_count):
+        # The layout used before the series store: {metric_str: (recv_timestamp, line_str)}
+        tracemalloc.start()
+        buffer = {}
+        for bucket, values, metadata in self.memory_test_set(metrics_count, values_count):
+            for k, v in values.items():
+                metadata['value'] = k
+                metric_str = bucket + '{' + ','.join(i + '="' + metadata[i] + '"' for i in sorted(metadata)) + '}'
+                buffer[metric_str] = 1.0, metric_str + ' ' + str(v) + ' 1000\n'
+        usage = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return usage
+
+    def store_memory_usage(self, prometheus_module, metrics_count, values_count):
+        tracemalloc.start()
+        for bucket, values, metadata in self.memory_test_set(metrics_count, values_count):
+            prometheus_module.process_values(1.0, bucket, values, 1.0, metadata)
+        usage = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return usage
+
+    @prometheus_setup(timestamps=range(1, 100))
+    def test_memory_performance(self, prometheus_module):
+        self.prepare_performance_test()
+        metrics_count, values_count = 100000, 10
+        series_count = metrics_count * values_count
+        legacy_usage = self.legacy_memory_usage(metrics_count, values_count)
+        store_usage = self.store_memory_usage(prometheus_module, metrics_count, values_count)
+        start_time = time.process_time()
+        page = prometheus_module.get_page()
+        time_delta = time.process_time() - start_time
+        print('\n{series_count:d} series: {legacy:.1f} bytes/series before, {store:.1f} bytes/series now '
+              '({reported:.1f} self reported), {page_len:d} bytes page rendered in {time_delta:.2f}s'.format(
+                  series_count=series_count, legacy=legacy_usage / series_count, store=store_usage / series_count,
+                  reported=prometheus_module.buffer.memory_usage() / series_count, page_len=len(page),
+                  time_delta=time_delta,
+              ), flush=True, file=sys.stderr)
+        self.assertLess(store_usage, legacy_usage / 2)
+
 
 if __name__ == '__main__':
     unittest.main()
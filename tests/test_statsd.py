@@ -1,6 +1,5 @@
 
 
-import os
 import io
 import sys
 import time
@@ -13,6 +12,7 @@ import itertools
 import statistics
 from unittest.mock import patch, MagicMock
 import bucky3.statsd as statsd
+from helpers import env_flag, PerformanceTestCase
 
 
 class RoughFloat(float):
@@ -119,7 +119,7 @@ def multiple_histogram_selector(key):
     if key['name'] == 'gurm': return gurm_selector
 
 
-class TestStatsDServer(unittest.TestCase):
+class TestStatsDServer(PerformanceTestCase):
     def malformed_entries(self, statsd_module, entry_type, check_numeric=True, check_rate=False):
         mock_pipe = statsd_module.dst_pipes[0]
 
@@ -687,14 +687,8 @@ class TestStatsDServer(unittest.TestCase):
         ])
 
     def prepare_performance_test(self):
-        flag = os.environ.get('TEST_PERFORMANCE', 'no').lower()
-        test_requested = flag in ('yes', 'true', '1')
-        if not test_requested:
-            self.skipTest("Performance test not requested")
-            return None
-        flag = os.environ.get('PROFILE_PERFORMANCE', 'no').lower()
-        profiler_requested = flag in ('yes', 'true', '1')
-        return cProfile.Profile() if profiler_requested else None
+        super().prepare_performance_test()
+        return cProfile.Profile() if env_flag('PROFILE_PERFORMANCE') else None
 
     def close_performance_test(self, profiler):
         if profiler: